@@ -0,0 +1,232 @@
+## End-to-end throughput benchmark.
+## Drives the real bentebot.on_message -> scheduler -> ollama client -> Response -> edit scheduler path with
+## synthetic conversations (N channels x M users, each user waits for the answer, thinks, asks again).
+## Ollama is bench/fake_ollama.py streaming at a fixed token rate, discord is bench/fake_discord.py with a
+## fixed API latency, and redis is fakeredis (default, offline) or a real instance via --redis-url.
+## Every run appends one JSON line (commit, parameters, results) to --output so commits can be compared;
+## keep the parameters identical between the runs you compare.
+##
+## Usage: python bench/bench_throughput.py [--channels 8] [--users 3] [--turns 5] [--token-rate 50] ...
+import sys, os, json, time, asyncio, argparse, logging, platform, subprocess, tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from fake_ollama import FakeOllama
+from fake_discord import FakeChannel, FakeGuild, FakeMessage, FakeUser, snowflake
+
+BENCH_MODEL = "bench-model:7b"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark with fake discord and fake ollama.")
+    parser.add_argument("--channels", type=int, default=8, help="Concurrent channels")
+    parser.add_argument("--users", type=int, default=3, help="Users talking in each channel")
+    parser.add_argument("--turns", type=int, default=5, help="Questions per user")
+    parser.add_argument("--think", type=float, default=0.5, help="Seconds a user waits after an answer before asking again")
+    parser.add_argument("--token-rate", type=float, default=50, help="Tokens/sec per fake ollama stream")
+    parser.add_argument("--reply-tokens", type=int, default=60, help="Tokens per answer")
+    parser.add_argument("--prompt-rate", type=float, default=2000, help="Prompt tokens/sec evaluated by fake ollama")
+    parser.add_argument("--concurrency", type=int, default=4, help="OLLAMA_MAX_CONCURRENT")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="Seconds per fake discord API call")
+    parser.add_argument("--edit-rate", type=float, default=10, help="DISCORD_EDIT_RATE")
+    parser.add_argument("--channel-edit-rate", type=float, default=1, help="DISCORD_CHANNEL_EDIT_RATE")
+    parser.add_argument("--redis-url", default=None, help="Real redis to use, e.g. redis://localhost:6379/15. The db is FLUSHED. Default: fakeredis")
+    parser.add_argument("--no-trace-memory", action="store_true", help="Skip tracemalloc (faster, no memory figure)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=os.path.join(ROOT, "bench_output.txt"), help="File the JSON result line is appended to")
+    return parser.parse_args()
+
+
+def configure_env(args: argparse.Namespace, ollama_url: str, guild_id: int) -> None:
+    # Set everything explicitly so a local .env can't change what is measured
+    os.environ.update({
+        "ENV": "bench",
+        "OLLAMA_HOST_URL": ollama_url,
+        "OLLAMA_DEFAULT_MODEL": BENCH_MODEL,
+        "OLLAMA_MAX_CONCURRENT": str(args.concurrency),
+        "OLLAMA_PROBE_INTERVAL": "3600",
+        "OLLAMA_NUM_CTX": "4096",
+        "DISCORD_SERVER_IDS": str(guild_id),
+        "SUPER_ADMINS": "",
+        "DISCORD_EDIT_RATE": str(args.edit_rate),
+        "DISCORD_EDIT_BURST": str(args.edit_rate),
+        "DISCORD_CHANNEL_EDIT_RATE": str(args.channel_edit_rate),
+        "DISCORD_CHANNEL_EDIT_BURST": "5",
+        "QUEUE_STATUS_INTERVAL": "3",
+        "RESPONSE_CACHE": "false",
+        "RETRIEVAL": "false",
+        "LATEST_MENTION_WINS": "false",
+        "METRICS_PORT": "0",
+        "SUMMARY_INTERVAL": "3600",
+    })
+
+
+def create_redis(args: argparse.Namespace):
+    if args.redis_url:
+        import redis.asyncio as aredis
+        return aredis.from_url(args.redis_url, decode_responses=True)
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("fakeredis is not installed: pip install -r bench/requirements.txt (or pass --redis-url)")
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+def pct(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)] if values else 0.0
+
+
+def git_revision() -> str:
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        return rev + ("-dirty" if dirty else "")
+    except OSError:
+        return "unknown"
+
+
+class Results:
+    def __init__(self):
+        self.replies: int = 0
+        self.errors: int = 0
+        self.first_edit: list = []   # seconds from on_message to the first visible reply
+        self.latency: list = []      # seconds from on_message to the finished reply
+        self.loop_lag: list = []
+        self.memory_peak: int = 0
+
+
+async def monitor_loop(stop: asyncio.Event, results: Results, trace_memory: bool, interval: float = 0.01) -> None:
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        results.loop_lag.append(max(loop.time() - expected, 0.0))
+        if trace_memory:
+            results.memory_peak = max(results.memory_peak, tracemalloc.get_traced_memory()[0])
+
+
+async def conversation(bot, bot_user: FakeUser, channel: FakeChannel, user: FakeUser, args: argparse.Namespace, results: Results) -> None:
+    for turn in range(args.turns):
+        message = FakeMessage(
+            channel, user,
+            f"{bot_user.mention} question {turn} from {user.name}: how does the queue handle {channel.name}?",
+            mentions=[bot_user],
+        )
+        started = time.perf_counter()
+        await bot.on_message(message)
+        entry = bot.ollama_conn.writing_tasks.get(message.id)
+        if entry is None:
+            results.errors += 1
+            continue
+        response, task = entry
+        await task
+        finished = time.perf_counter()
+        if response.sent and "💩" not in message.reactions:
+            results.replies += 1
+            results.first_edit.append(response.sent[0].created - started)
+            results.latency.append(finished - started)
+        else:
+            results.errors += 1
+        await asyncio.sleep(args.think)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    fake = FakeOllama(
+        {BENCH_MODEL: 4 * 1024 ** 3},
+        token_rate=args.token_rate,
+        reply_tokens=args.reply_tokens,
+        prompt_rate=args.prompt_rate,
+        seed=args.seed,
+    )
+    ollama_url = await fake.start()
+    guild = FakeGuild(snowflake())
+    configure_env(args, ollama_url, guild.id)
+
+    # The bot logs to bot.log on import; keep benchmark runs out of it
+    logging.basicConfig(filename=os.path.join(ROOT, "bench.log"), level=logging.WARNING, format='%(asctime)s %(message)s')
+    import discord
+    from discord.ext import commands
+    import context
+    import main
+    from src.bentebot import bentebot
+
+    redis_client = create_redis(args)
+    if args.redis_url:
+        await redis_client.flushdb()
+    disc = commands.Bot(command_prefix="/", intents=discord.Intents.default())
+    bot_user = FakeUser(snowflake(), "bentebot", bot=True)
+    disc._connection.user = bot_user
+    main.configure_context(disc, redis_client, main.create_ollama_pool())
+    bot = bentebot()
+    await bot.setup_hook()
+
+    channels = [FakeChannel(snowflake(), guild, bot_user, args.discord_latency) for _ in range(args.channels)]
+    users = [FakeUser(snowflake(), f"user{i}") for i in range(args.users)]
+    results = Results()
+    conversations = len(channels) * len(users)
+
+    trace_memory = not args.no_trace_memory
+    if trace_memory:
+        tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0] if trace_memory else 0
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(monitor_loop(stop, results, trace_memory))
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        conversation(bot, bot_user, channel, user, args, results)
+        for channel in channels for user in users
+    ))
+    duration = time.perf_counter() - started
+    stop.set()
+    await monitor
+    if trace_memory:
+        tracemalloc.stop()
+
+    report = {
+        "commit": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "redis": "real" if args.redis_url else "fakeredis",
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "redis_url")},
+        "conversations": conversations,
+        "replies": results.replies,
+        "errors": results.errors,
+        "duration_s": round(duration, 3),
+        "replies_per_s": round(results.replies / duration, 3) if duration else 0.0,
+        "first_edit_p50_ms": round(pct(results.first_edit, 0.5) * 1000, 1),
+        "first_edit_p99_ms": round(pct(results.first_edit, 0.99) * 1000, 1),
+        "reply_p50_ms": round(pct(results.latency, 0.5) * 1000, 1),
+        "reply_p99_ms": round(pct(results.latency, 0.99) * 1000, 1),
+        "loop_lag_p50_ms": round(pct(results.loop_lag, 0.5) * 1000, 2),
+        "loop_lag_p99_ms": round(pct(results.loop_lag, 0.99) * 1000, 2),
+        "loop_lag_max_ms": round(max(results.loop_lag, default=0.0) * 1000, 2),
+        "memory_per_conversation_kb": round((results.memory_peak - baseline) / conversations / 1024, 1) if trace_memory else None,
+        "ollama_max_streams": fake.max_streams,
+    }
+
+    # Stop background loops (authz listener, probes, edit scheduler, ...) before tearing down
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await fake.stop()
+    await redis_client.aclose()
+    return report
+
+
+def main() -> None:
+    args = parse_args()
+    report = asyncio.run(run(args))
+    width = max(len(k) for k in report)
+    for key, value in report.items():
+        if key != "params":
+            print(f"{key:<{width}}  {value}")
+    with open(args.output, "a", encoding="utf-8") as f:
+        f.write(json.dumps(report) + "\n")
+    print(f"\nAppended to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+## Minimal stand-ins for the discord.py objects the bot touches (messages, channels, users, guilds).
+## Sends and edits complete after a configurable latency and are timestamped so the benchmark can
+## measure time to first edit.
+import time
+import asyncio
+import itertools
+from typing import List, Optional
+
+DISCORD_EPOCH_MS = 1420070400000
+_sequence = itertools.count()
+
+
+def snowflake() -> int:
+    # Real layout (ms since the discord epoch << 22) so history ordering works as in production
+    return ((int(time.time() * 1000) - DISCORD_EPOCH_MS) << 22) | (next(_sequence) & 0x3FFFFF)
+
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str, bot: bool = False):
+        self.id: int = user_id
+        self.name: str = name
+        self.bot: bool = bot
+        self.mention: str = f"<@{user_id}>"
+
+    def __repr__(self) -> str:
+        return f"FakeUser({self.name})"
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, name: str = "bench"):
+        self.id: int = guild_id
+        self.name: str = name
+
+
+class FakeMessage:
+    def __init__(self, channel: "FakeChannel", author: FakeUser, content: str, mentions: Optional[List[FakeUser]] = None):
+        self.id: int = snowflake()
+        self.channel: FakeChannel = channel
+        self.guild: Optional[FakeGuild] = channel.guild
+        self.author: FakeUser = author
+        self.content: str = content
+        self.mentions: List[FakeUser] = mentions or []
+        self.attachments: list = []
+        self.created: float = time.perf_counter()
+        self.edits: int = 0
+        self.reactions: List[str] = []
+
+    async def edit(self, content: str = None, **kwargs) -> "FakeMessage":
+        await asyncio.sleep(self.channel.latency)
+        self.content = content
+        self.edits += 1
+        return self
+
+    async def delete(self) -> None:
+        await asyncio.sleep(self.channel.latency)
+
+    async def reply(self, content: str, **kwargs) -> "FakeMessage":
+        return await self.channel.send(content)
+
+    async def add_reaction(self, emoji: str) -> None:
+        await asyncio.sleep(self.channel.latency)
+        self.reactions.append(emoji)
+
+    async def remove_reaction(self, emoji: str, member) -> None:
+        await asyncio.sleep(self.channel.latency)
+        if emoji in self.reactions:
+            self.reactions.remove(emoji)
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, guild: Optional[FakeGuild], bot_user: FakeUser, latency: float = 0.05):
+        self.id: int = channel_id
+        self.name: str = f"bench-{channel_id}"
+        self.guild: Optional[FakeGuild] = guild
+        self.bot_user: FakeUser = bot_user
+        self.latency: float = latency # simulated discord API round trip
+        self.sent: int = 0
+
+    async def send(self, content: str, **kwargs) -> FakeMessage:
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+        return FakeMessage(self, self.bot_user, content)
@@ -0,0 +1,183 @@
+## Stand-in ollama server for benchmarks: speaks just enough of the HTTP API for the real
+## ollama.AsyncClient (tags, ps, show, chat, generate, embed) and streams tokens at a fixed rate.
+## Runs on plain asyncio streams so the benchmark works offline without extra dependencies.
+import json
+import time
+import random
+import asyncio
+import hashlib
+import datetime
+from typing import Dict, Optional, Set
+
+WORDS = (
+    "the bot answers every question with a short and friendly reply about redis ollama discord "
+    "models tokens queues latency cache history channel message stream python async"
+).split()
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+class FakeOllama:
+    def __init__(
+        self,
+        models: Dict[str, int],
+        token_rate: float = 50.0,
+        reply_tokens: int = 60,
+        prompt_rate: float = 2000.0,
+        context_length: int = 8192,
+        embed_dim: int = 64,
+        seed: int = 0
+    ):
+        self.models: Dict[str, int] = models # name -> size in bytes
+        self.token_rate: float = token_rate
+        self.reply_tokens: int = reply_tokens
+        self.prompt_rate: float = prompt_rate # prompt tokens evaluated per second
+        self.context_length: int = context_length
+        self.embed_dim: int = embed_dim
+        self.random: random.Random = random.Random(seed)
+        self.loaded: Set[str] = set()
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.requests: Dict[str, int] = {}
+        self.active_streams: int = 0
+        self.max_streams: int = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self.server = await asyncio.start_server(self._handle, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    ## HTTP plumbing
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                method, path, _ = request.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+                payload = json.loads(body) if body else {}
+                self.requests[path] = self.requests.get(path, 0) + 1
+                await self._route(method, path, payload, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _send_json(self, writer: asyncio.StreamWriter, data, status: str = "200 OK") -> None:
+        body = json.dumps(data).encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    async def _start_stream(self, writer: asyncio.StreamWriter) -> None:
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n\r\n")
+        await writer.drain()
+
+    async def _send_chunk(self, writer: asyncio.StreamWriter, data) -> None:
+        line = json.dumps(data).encode() + b"\n"
+        writer.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        await writer.drain()
+
+    async def _end_stream(self, writer: asyncio.StreamWriter) -> None:
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _route(self, method: str, path: str, payload: dict, writer: asyncio.StreamWriter) -> None:
+        if path == "/api/tags":
+            return await self._send_json(writer, {"models": [self._model(name) for name in self.models]})
+        if path == "/api/ps":
+            return await self._send_json(writer, {"models": [self._model(name) for name in self.loaded]})
+        if path == "/api/show":
+            return await self._send_json(writer, {
+                "modelfile": "", "parameters": "", "template": "",
+                "details": self._model(payload.get("model", ""))["details"],
+                "model_info": {"general.architecture": "llama", "llama.context_length": self.context_length},
+            })
+        if path == "/api/embed":
+            inputs = payload.get("input") or []
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            return await self._send_json(writer, {"model": payload.get("model"), "embeddings": [self._embed(t) for t in inputs]})
+        if path in ("/api/chat", "/api/generate"):
+            return await self._generate(path == "/api/chat", payload, writer)
+        await self._send_json(writer, {"error": f"unknown endpoint {path}"}, "404 Not Found")
+
+    ## API
+
+    def _model(self, name: str) -> dict:
+        return {
+            "name": name, "model": name, "modified_at": _now(), "size": self.models.get(name, 0),
+            "digest": hashlib.sha256(name.encode()).hexdigest(),
+            "details": {"format": "gguf", "family": "llama", "parameter_size": "7B", "quantization_level": "Q4_0"},
+        }
+
+    def _embed(self, text: str) -> list:
+        rng = random.Random(hashlib.sha256(text.encode()).digest())
+        return [rng.uniform(-1, 1) for _ in range(self.embed_dim)]
+
+    async def _generate(self, chat: bool, payload: dict, writer: asyncio.StreamWriter) -> None:
+        model = payload.get("model", "")
+        if model not in self.models:
+            return await self._send_json(writer, {"error": f"model '{model}' not found"}, "404 Not Found")
+        if payload.get("keep_alive") == 0:
+            self.loaded.discard(model)
+        else:
+            self.loaded.add(model)
+
+        if chat:
+            prompt = "".join(m.get("content", "") for m in payload.get("messages", []))
+        else:
+            prompt = payload.get("prompt", "")
+        prompt_tokens = len(prompt) // 4 + 1
+        reply_tokens = self.reply_tokens if prompt else 0
+        started = time.perf_counter()
+
+        def frame(content: str, done: bool, **extra) -> dict:
+            base = {"model": model, "created_at": _now(), "done": done, **extra}
+            if chat:
+                base["message"] = {"role": "assistant", "content": content}
+            else:
+                base["response"] = content
+            return base
+
+        if not payload.get("stream", True):
+            text = " ".join(self.random.choice(WORDS) for _ in range(reply_tokens))
+            return await self._send_json(writer, frame(text, True, done_reason="stop"))
+
+        self.active_streams += 1
+        self.max_streams = max(self.max_streams, self.active_streams)
+        try:
+            await self._start_stream(writer)
+            await asyncio.sleep(prompt_tokens / self.prompt_rate)
+            eval_started = time.perf_counter()
+            for i in range(reply_tokens):
+                await self._send_chunk(writer, frame(("" if i == 0 else " ") + self.random.choice(WORDS), False))
+                await asyncio.sleep(1 / self.token_rate)
+            eval_duration = int((time.perf_counter() - eval_started) * 1e9)
+            await self._send_chunk(writer, frame("", True,
+                done_reason="stop",
+                total_duration=int((time.perf_counter() - started) * 1e9),
+                load_duration=0,
+                prompt_eval_count=prompt_tokens,
+                prompt_eval_duration=int(prompt_tokens / self.prompt_rate * 1e9),
+                eval_count=reply_tokens,
+                eval_duration=eval_duration,
+            ))
+            await self._end_stream(writer)
+        finally:
+            self.active_streams -= 1
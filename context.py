@@ -1,11 +1,50 @@
 ## File for accessing contextual variables from main.py into bentebot.py
-import ollama
+from typing import Optional
 from discord.ext import commands
-import redis as rediss
+import redis.asyncio as aredis
+from src.history_cache import HistoryCache
+from src.authz import Authorizer
+from src.scheduler import GenerationScheduler
+from src.ollama_pool import OllamaPool
+from src.edit_scheduler import EditScheduler
+from src.residency import ModelResidency
+from src.model_catalog import ModelCatalog
+from src.prompt_builder import PrefixTracker
+from src.summarizer import HistorySummarizer
+from src.response_cache import ResponseCache
+from src.retrieval import RetrievalMemory
+from src.metrics import Metrics
+from src.retention import RetentionSweeper
+from src.ingest_buffer import IngestBuffer
+from src.ingest_filter import IngestFilter
+from src.attachments import AttachmentStore
 
-redis: Optional[rediss.Redis] = None
-llama: Optional[ollama.AsyncClient] = None
+redis: Optional[aredis.Redis] = None
+llama: Optional[OllamaPool] = None
 discord: Optional[commands.Bot] = None
 llama_default_model: str = None
+llama_num_ctx: int = 4096
+llama_response_reserve: int = 512
 super_admin_ids: Optional[str] = None
-discord_server_ids: Optional[str] = None
\ No newline at end of file
+discord_server_ids: Optional[str] = None
+history_max_messages: int = 1000
+history_window: int = 100
+history_cache: Optional[HistoryCache] = None
+authz: Optional[Authorizer] = None
+scheduler: Optional[GenerationScheduler] = None
+edit_scheduler: Optional[EditScheduler] = None
+residency: Optional[ModelResidency] = None
+model_catalog: Optional[ModelCatalog] = None
+prefix_tracker: Optional[PrefixTracker] = None
+summarizer: Optional[HistorySummarizer] = None
+latest_mention_wins: bool = False
+response_cache: Optional[ResponseCache] = None
+retrieval: Optional[RetrievalMemory] = None
+metrics: Optional[Metrics] = None
+metrics_host: str = "127.0.0.1"
+metrics_port: int = 0 # 0 = no prometheus endpoint
+log_path: str = "bot.log"
+retention: Optional[RetentionSweeper] = None
+ingest: Optional[IngestBuffer] = None # None = messages are written one by one
+ingest_filter: Optional[IngestFilter] = None
+attachments: Optional[AttachmentStore] = None
\ No newline at end of file
@@ -1,10 +1,27 @@
 import sys, os, logging
-import ollama
+from urllib.parse import urlparse
 import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 from src.bentebot import bentebot
-import redis
+from src.redis_client import redis_settings_from_env, create_async_redis
+from src.history_cache import HistoryCache
+from src.authz import Authorizer
+from src.scheduler import GenerationScheduler
+from src.ollama_pool import OllamaBackend, OllamaPool
+from src.edit_scheduler import EditScheduler
+from src.residency import ModelResidency
+from src.model_catalog import ModelCatalog
+from src.prompt_builder import PrefixTracker
+from src.summarizer import HistorySummarizer
+from src.response_cache import ResponseCache
+from src.retrieval import RetrievalMemory
+from src.metrics import Metrics
+from src.retention import HistoryArchive, RetentionPolicy, RetentionSweeper
+from src.ingest_buffer import IngestBuffer
+from src.ingest_filter import IngestFilter
+from src.attachments import AttachmentStore
+from src.log_files import setup_logging
 
 import context
 
@@ -13,13 +30,168 @@ import context
 THIS_PATH = os.path.dirname(os.path.realpath(__file__))
 
 load_dotenv('.env')
-logging.basicConfig(filename=f'bot.log', level=logging.INFO, format='%(asctime)s %(message)s')
+LOG_PATH = os.getenv("LOG_FILE", "bot.log")
+setup_logging(
+    LOG_PATH,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    max_bytes=int(float(os.getenv("LOG_MAX_MB", "10")) * 1024 * 1024),
+    backups=int(os.getenv("LOG_BACKUPS", "5")),
+    max_age=float(os.getenv("LOG_ROTATE_HOURS", "24")) * 3600,
+    json_records=os.getenv("LOG_JSON", "false").lower() in ("1", "true"),
+    rate_limit_interval=float(os.getenv("LOG_RATE_LIMIT_SECONDS", "60")),
+)
 
 os.environ["OMP_NUM_THREADS"] = "4"
 ENVIRONMENT = str(os.getenv("ENV"))
 print(ENVIRONMENT, file=sys.stdout, flush=True)
 
 
+def create_ollama_backend(suffix: str = "") -> OllamaBackend:
+    host = str(os.getenv(f"OLLAMA_HOST_URL{suffix}"))
+    auth_name = os.getenv(f"BASIC_AUTH_USERNAME{suffix}")
+    auth_pass = os.getenv(f"BASIC_AUTH_PASSWORD{suffix}")
+    verify_ssl = os.getenv(f"VERIFY_SSL{suffix}", "True")
+    if verify_ssl.isdigit():
+        verify_ssl = bool(int(verify_ssl))
+    else:
+        verify_ssl = verify_ssl.lower() == "true" # converts to bool
+    max_concurrent = int(os.getenv(f"OLLAMA_MAX_CONCURRENT{suffix}", os.getenv("OLLAMA_MAX_CONCURRENT", "2")))
+    return OllamaBackend(
+        name=urlparse(host).netloc or host,
+        host=host,
+        max_concurrent=max_concurrent,
+        auth=(auth_name, auth_pass) if auth_name and auth_pass else None,
+        verify=verify_ssl,
+    )
+
+
+def route_job(job) -> list:
+    # Run each job on the best host for its model that has a free slot. A channel sticks to the host
+    # that served it last (as long as that host is healthy and has the model) so its KV cache is reused.
+    candidates = context.llama.candidates(job.model) or context.llama.backends
+    sticky = context.prefix_tracker.backend(job.channel_id) if context.prefix_tracker else None
+    if sticky and any(b.name == sticky for b in candidates):
+        return [sticky]
+    return [b.name for b in candidates]
+
+
+def create_ollama_pool() -> OllamaPool:
+    # The first host is configured by OLLAMA_HOST_URL / BASIC_AUTH_* / VERIFY_SSL / OLLAMA_MAX_CONCURRENT,
+    # additional hosts by the same variables suffixed with _2, _3, ...
+    backends = []
+    suffix = ""
+    while os.getenv(f"OLLAMA_HOST_URL{suffix}"):
+        backends.append(create_ollama_backend(suffix))
+        suffix = f"_{len(backends) + 1}"
+    return OllamaPool(
+        backends,
+        probe_interval=float(os.getenv("OLLAMA_PROBE_INTERVAL", "15")),
+        max_backoff=float(os.getenv("OLLAMA_PROBE_MAX_BACKOFF", "300")),
+    )
+
+
+def configure_context(
+    disc: commands.Bot, 
+    redis_client, 
+    llama: OllamaPool
+) -> None:
+    """Build every context.* singleton from the environment. Also used by bench/ to run the real wiring."""
+    context.log_path = LOG_PATH
+    context.metrics = Metrics()
+    context.metrics_host = os.getenv("METRICS_HOST", "127.0.0.1")
+    context.metrics_port = int(os.getenv("METRICS_PORT", "0") or 0)
+    if redis_client is not None:
+        redis_client.observer = context.metrics.observe_redis
+    context.redis = redis_client
+    context.llama = llama
+    context.discord = disc
+    context.llama_default_model = str(os.getenv("OLLAMA_DEFAULT_MODEL", "phi"))
+    context.llama_num_ctx = int(os.getenv("OLLAMA_NUM_CTX", "4096"))
+    context.llama_response_reserve = int(os.getenv("OLLAMA_RESPONSE_RESERVE", "512"))
+    context.super_admin_ids = os.getenv("SUPER_ADMINS")
+    context.discord_server_ids = os.getenv("DISCORD_SERVER_IDS")
+    context.authz = Authorizer(context.super_admin_ids, context.discord_server_ids)
+    context.ingest_filter = IngestFilter()
+    context.scheduler = GenerationScheduler(
+        limit=int(os.getenv("OLLAMA_MAX_CONCURRENT", "2")),
+        limits={b.name: b.max_concurrent for b in llama.backends},
+        status_interval=float(os.getenv("QUEUE_STATUS_INTERVAL", "3")),
+    )
+    context.scheduler.backend_for = route_job
+    context.prefix_tracker = PrefixTracker(low_water=float(os.getenv("PROMPT_LOW_WATER", "0.5")))
+    context.residency = ModelResidency(
+        min_keep_alive=float(os.getenv("OLLAMA_MIN_KEEP_ALIVE", "300")),
+        max_keep_alive=float(os.getenv("OLLAMA_MAX_KEEP_ALIVE", "3600")),
+        max_large_resident=int(os.getenv("OLLAMA_MAX_LARGE_RESIDENT", "1")),
+        large_model_bytes=int(float(os.getenv("OLLAMA_LARGE_MODEL_GB", "8")) * 1024 ** 3),
+    )
+    llama.probe_listeners.append(context.residency.on_probe)
+    context.model_catalog = ModelCatalog(ttl=float(os.getenv("MODEL_CATALOG_TTL", "300")))
+    context.edit_scheduler = EditScheduler(
+        global_rate=float(os.getenv("DISCORD_EDIT_RATE", "10")),
+        global_burst=float(os.getenv("DISCORD_EDIT_BURST", "10")),
+        channel_rate=float(os.getenv("DISCORD_CHANNEL_EDIT_RATE", "1")),
+        channel_burst=float(os.getenv("DISCORD_CHANNEL_EDIT_BURST", "5")),
+    )
+    context.history_max_messages = int(os.getenv("HISTORY_MAX_MESSAGES", "1000"))
+    context.history_window = int(os.getenv("HISTORY_WINDOW", "100"))
+    if os.getenv("RESPONSE_CACHE", "false").lower() in ("1", "true"):
+        context.response_cache = ResponseCache(
+            ttl=int(os.getenv("RESPONSE_CACHE_TTL", "86400")),
+            max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000")),
+            scope=os.getenv("RESPONSE_CACHE_SCOPE", "guild"),
+        )
+    if os.getenv("RETRIEVAL", "false").lower() in ("1", "true"):
+        context.retrieval = RetrievalMemory(
+            model=os.getenv("RETRIEVAL_MODEL", "nomic-embed-text"),
+            directory=os.getenv("RETRIEVAL_DIR", "data/vectors"),
+            top_k=int(os.getenv("RETRIEVAL_TOP_K", "6")),
+            recent_turns=int(os.getenv("RETRIEVAL_RECENT_TURNS", "8")),
+            max_vectors=context.history_max_messages,
+        )
+    if os.getenv("IMAGES", "false").lower() in ("1", "true"):
+        context.attachments = AttachmentStore(
+            directory=os.getenv("IMAGE_DIR", "data/images"),
+            max_bytes=int(float(os.getenv("IMAGE_MAX_MB", "20")) * 1024 * 1024),
+            max_side=int(os.getenv("IMAGE_MAX_SIDE", "1024")),
+            recent_turns=int(os.getenv("IMAGE_RECENT_TURNS", "4")),
+            tokens_per_image=int(os.getenv("IMAGE_PROMPT_TOKENS", "768")),
+            memory_bytes=int(os.getenv("IMAGE_CACHE_MB", "64")) * 1024 * 1024,
+        )
+    context.latest_mention_wins = os.getenv("LATEST_MENTION_WINS", "false").lower() in ("1", "true")
+    context.summarizer = HistorySummarizer(
+        keep_recent=int(os.getenv("SUMMARY_KEEP_RECENT", "40")),
+        min_batch=int(os.getenv("SUMMARY_MIN_BATCH", "20")),
+        max_batch=int(os.getenv("SUMMARY_MAX_BATCH", "60")),
+        interval=float(os.getenv("SUMMARY_INTERVAL", "30")),
+        model=os.getenv("SUMMARY_MODEL") or None,
+    )
+    context.retention = RetentionSweeper(
+        HistoryArchive(
+            os.getenv("ARCHIVE_DIR", "data/archive"),
+            segment_bytes=int(float(os.getenv("ARCHIVE_SEGMENT_MB", "16")) * 1024 * 1024),
+        ),
+        RetentionPolicy(
+            max_age_days=float(os.getenv("RETENTION_MAX_AGE_DAYS", "0")),
+            max_count=int(os.getenv("RETENTION_MAX_COUNT", "0")),
+            max_bytes=int(float(os.getenv("RETENTION_MAX_MB", "0")) * 1024 * 1024),
+        ),
+        interval=float(os.getenv("RETENTION_INTERVAL", "3600")),
+        hold_seconds=int(float(os.getenv("RETENTION_RESTORE_HOLD_HOURS", "24")) * 3600),
+        archive_enabled=os.getenv("ARCHIVE", "true").lower() in ("1", "true"),
+    )
+    if os.getenv("INGEST_BUFFER", "true").lower() in ("1", "true"):
+        context.ingest = IngestBuffer(
+            max_batch=int(os.getenv("INGEST_BATCH_SIZE", "100")),
+            max_delay=float(os.getenv("INGEST_FLUSH_MS", "250")) / 1000,
+        )
+    context.history_cache = HistoryCache(
+        max_channels=int(os.getenv("HISTORY_CACHE_CHANNELS", "256")),
+        max_bytes=int(os.getenv("HISTORY_CACHE_MB", "64")) * 1024 * 1024,
+        window=min(context.history_window, context.history_max_messages) if context.history_max_messages > 0 else context.history_window,
+    )
+
+
 if __name__ == '__main__':
     intents = discord.Intents.default()
     intents.message_content = True
@@ -30,34 +202,17 @@ if __name__ == '__main__':
     # Redis initialization
     redis_client = None
     if ENVIRONMENT != "dev":
-        redis_host = str(os.getenv("REDIS_HOST"))
-        redis_port = os.getenv("REDIS_PORT")
-        if not redis_host == "" and redis_port:
-            redis_client = redis.Redis(host=redis_host, port=int(redis_port), db=0, decode_responses=True)
+        redis_settings = redis_settings_from_env()
+        if redis_settings is not None:
+            redis_host, redis_port = redis_settings
+            redis_pool_size = int(os.getenv("REDIS_POOL_SIZE", "20"))
+            redis_pool_timeout = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+            redis_client = create_async_redis(redis_host, redis_port, redis_pool_size, redis_pool_timeout)
     
     # Ollama initialization
-    host = str(os.getenv("OLLAMA_HOST_URL"))
-    llama_default_model = str(os.getenv("OLLAMA_DEFAULT_MODEL", "phi"))
-    auth_name = os.getenv("BASIC_AUTH_USERNAME")
-    auth_pass = os.getenv("BASIC_AUTH_PASSWORD")
-    verify_ssl = os.getenv("VERIFY_SSL", "True")
-    if verify_ssl.isdigit():
-        verify_ssl = bool(int(verify_ssl))
-    else:
-        verify_ssl = verify_ssl.lower() == "true" # converts to bool
-    llama = None
-    if auth_name and auth_pass:
-        llama = ollama.AsyncClient(host, auth=(auth_name, auth_pass), verify=verify_ssl)
-    else:
-        llama = ollama.AsyncClient(host, verify=verify_ssl)
-    
+    llama = create_ollama_pool()
     
     ## Set contextual variables for bentebot to function
-    context.redis = redis_client
-    context.llama = llama
-    context.discord = disc
-    context.llama_default_model = llama_default_model
-    context.super_admin_ids = os.getenv("SUPER_ADMINS")
-    context.discord_server_ids = os.getenv("DISCORD_SERVER_IDS")
+    configure_context(disc, redis_client, llama)
         
     bentebot().run(os.getenv("DISCORD_TOKEN"))
\ No newline at end of file
@@ -0,0 +1,98 @@
+## One-shot migration of channel history from the old unordered `messages:{channel_id}` hashes
+## to the ordered layout used by src/redis_conn.py (record hash + `history:{channel_id}` sorted set index).
+##
+## Safe to re-run: already indexed messages are simply re-added with the same score.
+## Messages over the cap are queued for the retention archive like the live cap does (ARCHIVE=true, the
+## default), or kept with --keep-trimmed.
+## Usage: python scripts/migrate_history.py [--cap N] [--keep-trimmed] [--dry-run]
+import sys, os, argparse
+from dotenv import load_dotenv
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from src.redis_client import sync_redis_from_env
+from src.records import snowflake_to_ms
+
+BATCH_SIZE = 1000
+
+
+def migrate_channel(r, hash_key: str, cap, archive: bool, dry_run: bool) -> tuple:
+    """Index a channel's messages and apply its cap (None = keep everything). Returns (indexed, trimmed)."""
+    channel_id = hash_key.split(":", 1)[1]
+    index_key = f"history:{channel_id}"
+    channel_cap = r.hget("history_caps", channel_id) if cap is not None else None
+    if channel_cap:
+        cap = int(channel_cap)
+
+    indexed = 0
+    batch = {}
+    for message_id, _ in r.hscan_iter(hash_key, count=BATCH_SIZE):
+        if not str(message_id).isdigit():
+            continue
+        batch[message_id] = snowflake_to_ms(message_id)
+        if len(batch) >= BATCH_SIZE:
+            if not dry_run:
+                r.zadd(index_key, batch)
+            indexed += len(batch)
+            batch = {}
+    if batch:
+        if not dry_run:
+            r.zadd(index_key, batch)
+        indexed += len(batch)
+
+    # Enforce the cap the same way save_message_redis does: drop the oldest entries, handing their
+    # records to the archive first ("<id>:<record>" in archive_pending, drained by the retention sweeper)
+    trimmed = 0
+    if cap and indexed > cap and not dry_run:
+        excess = r.zcard(index_key) - cap
+        while excess > 0:
+            old = r.zrange(index_key, 0, min(excess, BATCH_SIZE) - 1)
+            if not old:
+                break
+            pipe = r.pipeline()
+            if archive:
+                records = r.hmget(hash_key, old)
+                entries = [f"{mid}:{record}" for mid, record in zip(old, records) if record]
+                if entries:
+                    pipe.rpush(f"archive_pending:{channel_id}", *entries)
+            pipe.zrem(index_key, *old)
+            pipe.hdel(hash_key, *old)
+            pipe.execute()
+            trimmed += len(old)
+            excess -= len(old)
+    elif cap and indexed > cap:
+        trimmed = indexed - cap
+
+    return indexed, trimmed
+
+
+def main():
+    load_dotenv('.env')
+    parser = argparse.ArgumentParser(description="Index and cap stored channel history.")
+    parser.add_argument("--cap", type=int, default=int(os.getenv("HISTORY_MAX_MESSAGES", "1000")), help="Default per-channel cap (0 = unbounded)")
+    parser.add_argument("--keep-trimmed", action="store_true", help="Don't apply the cap, keep every message")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would change")
+    args = parser.parse_args()
+
+    r = sync_redis_from_env()
+    if r is None:
+        print("REDIS_HOST / REDIS_PORT not set.", file=sys.stderr)
+        sys.exit(1)
+
+    archive = os.getenv("ARCHIVE", "true").lower() in ("1", "true")
+    channels = 0
+    total_indexed = 0
+    total_trimmed = 0
+    for hash_key in r.scan_iter(match="messages:*", count=BATCH_SIZE):
+        if r.type(hash_key) != "hash":
+            continue
+        indexed, trimmed = migrate_channel(r, hash_key, None if args.keep_trimmed else args.cap, archive, args.dry_run)
+        channels += 1
+        total_indexed += indexed
+        total_trimmed += trimmed
+        print(f"{hash_key}: indexed {indexed}, trimmed {trimmed}")
+
+    print(f"Done. {channels} channels, {total_indexed} messages indexed, {total_trimmed} trimmed{' (dry run)' if args.dry_run else ''}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+## Bytes per stored message in the v1 (JSON object) and current (compact) record encodings.
+## For each channel the records are written, in each encoding, to a scratch copy of `messages:{channel_id}`
+## and measured with MEMORY USAGE, so the numbers include redis' own per-field overhead. The channel keys
+## themselves are not modified; the scratch keys are deleted right after measuring.
+##
+## Usage: python scripts/record_size_report.py [--channels 20] [--min-messages 50]
+import sys, os, argparse
+from dotenv import load_dotenv
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from src.redis_client import sync_redis_from_env
+from src.records import RECORD_VERSION, encode_record, decode_record
+
+SCRATCH_KEY = "record_size_report:scratch"
+BATCH_SIZE = 1000
+
+
+def measure(r, records: dict, version: int) -> int:
+    r.delete(SCRATCH_KEY)
+    items = list(records.items())
+    for start in range(0, len(items), BATCH_SIZE):
+        r.hset(SCRATCH_KEY, mapping={mid: encode_record(rec, version) for mid, rec in items[start:start + BATCH_SIZE]})
+    usage = r.memory_usage(SCRATCH_KEY, samples=0) or 0
+    r.delete(SCRATCH_KEY)
+    return usage
+
+
+def main():
+    load_dotenv('.env')
+    parser = argparse.ArgumentParser(description="Compare stored message size per record encoding.")
+    parser.add_argument("--channels", type=int, default=20, help="Largest N channels to measure")
+    parser.add_argument("--min-messages", type=int, default=50, help="Skip channels with fewer messages")
+    args = parser.parse_args()
+
+    r = sync_redis_from_env()
+    if r is None:
+        print("REDIS_HOST / REDIS_PORT not set.", file=sys.stderr)
+        sys.exit(1)
+
+    sizes = []
+    for key in r.scan_iter(match="messages:*", count=BATCH_SIZE):
+        if r.type(key) == "hash":
+            sizes.append((r.hlen(key), key))
+    sizes = [s for s in sorted(sizes, reverse=True) if s[0] >= args.min_messages][:args.channels]
+    if not sizes:
+        print("No channels with enough messages.")
+        return
+
+    total_messages = total_current = total_v1 = total_compact = 0
+    print(f"{'channel':<32}{'messages':>10}{'stored B/msg':>14}{'v1 B/msg':>10}{f'v{RECORD_VERSION} B/msg':>10}{'saved':>8}")
+    for count, key in sizes:
+        records = {mid: decode_record(raw, mid) for mid, raw in r.hscan_iter(key, count=BATCH_SIZE)}
+        current = r.memory_usage(key, samples=0) or 0
+        v1 = measure(r, records, 1)
+        compact = measure(r, records, RECORD_VERSION)
+        n = len(records)
+        print(f"{key:<32}{n:>10}{current / n:>14.0f}{v1 / n:>10.0f}{compact / n:>10.0f}{1 - compact / v1:>8.0%}")
+        total_messages += n
+        total_current += current
+        total_v1 += v1
+        total_compact += compact
+
+    print(
+        f"\nTotal: {total_messages} messages, stored {total_current / total_messages:.0f} B/msg, "
+        f"v1 {total_v1 / total_messages:.0f} B/msg, v{RECORD_VERSION} {total_compact / total_messages:.0f} B/msg "
+        f"({1 - total_compact / total_v1:.0%} smaller)"
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,177 @@
-from typing import Optional
+from typing import List, Optional
 import io
+import re
+import asyncio
 import discord
+import context
+
+MAX_MESSAGE_LENGTH = 2000
+FENCE = '```'
+FENCE_LINE = re.compile(r'^```([^`\s]*)[^`]*$')
+MAX_FENCE_INFO = 32
+
+
+def split_point(
+    text: str, 
+    limit: int
+) -> int:
+    """Where to cut `text` so the head fits in `limit` chars: after a paragraph, else a line, else a word."""
+    window = text[:limit]
+    minimum = limit // 4 # don't produce tiny messages just to hit a boundary
+    for sep in ('\n\n', '\n', ' '):
+        i = window.rfind(sep)
+        if i >= minimum:
+            return i + len(sep)
+    return limit
+
+
+def open_fence(
+    text: str
+) -> Optional[str]:
+    """Info string (language) of the code block left open at the end of `text`, None if all are closed."""
+    lang = None
+    for line in text.split('\n'):
+        # ``` plus an optional info word; a line with more backticks is inline code, not a fence
+        match = FENCE_LINE.match(line.strip())
+        if match is None:
+            continue
+        if lang is None:
+            # Re-opened at the top of every continuation message, so a long info string would eat the limit
+            lang = match.group(1) if len(match.group(1)) <= MAX_FENCE_INFO else ''
+        elif not match.group(1):
+            lang = None # only a bare fence closes a block
+    return lang
+
 
 class Response:
     def __init__(self, message: discord.Message):
         self.message: discord.Message = message
         self.channel: Optional[discord.abc.Messageable] = message.channel
         self.author: Optional[discord.abc.Messageable] = message.author
+        self.channel_id: int = message.channel.id
 
-        self.r: Optional[discord.Message] = None
+        # The whole answer is appended to one buffer; the current discord message is the text from
+        # `start` on, prefixed with `prefix` (a re-opened code fence) when a split landed inside a code block.
         self.sb: io.StringIO = io.StringIO()
+        self.length: int = 0
+        self.start: int = 0
+        self.prefix: str = ''
+        self.finished: List[str] = []           # final text of earlier messages, computed once at split time
+        self.end: str = ''
+        self.closed: bool = False
+
+        self.sent: List[discord.Message] = []   # discord messages, parallel to finished + current
+        self.published: List[str] = []          # content last sent for each of them
+        self.final: int = 0                     # leading messages whose final text is published
+
+        # Publishing is driven by context.edit_scheduler
+        self.dirty: bool = False
+        self.publishing: bool = False
+        self.failures: int = 0
+        self.discarded: bool = False
+        self.cancel_reason: Optional[str] = None # why the generation was cancelled (deleted/edited/superseded)
+        self.idle: asyncio.Event = asyncio.Event()
+        self.idle.set()
 
-    async def write(self, s: str, end: str='') -> None:
-        if self.sb.seek(0, io.SEEK_END) + len(s) + len(end) > 2000:
-            self.r = None
-            self.sb.seek(0, io.SEEK_SET)
-            self.sb.truncate()
+    @property
+    def r(self) -> Optional[discord.Message]:
+        return self.sent[-1] if self.sent else None
 
+    def write(self, s: str, end: str='') -> None:
+        """Append to the buffer; the edit scheduler publishes it when the rate budget allows."""
         self.sb.write(s)
+        self.length += len(s)
+        self.end = end
+        # Keep room for the `end` marker, or for closing a code block the model never closed
+        while self.length - self.start + len(self.prefix) + max(len(end), len(FENCE) + 1) > MAX_MESSAGE_LENGTH:
+            self._split()
+        self._changed()
+
+    async def close(self) -> None:
+        """Drop the `end` marker and wait until the final content has been published."""
+        self.closed = True
+        self.end = ''
+        self._changed()
+        await self.idle.wait()
+
+    async def discard(self) -> None:
+        """Stop publishing and delete what was already sent, for when the question itself is gone."""
+        self.discarded = True
+        self.dirty = False
+        await self.idle.wait()
+        for m in self.sent:
+            try:
+                await m.delete()
+            except discord.HTTPException:
+                pass
+        self.sent.clear()
+        self.published.clear()
+
+    @property
+    def urgent(self) -> bool:
+        # Nothing visible yet: send right away for fast time-to-first-token
+        return not self.sent
+
+    def _changed(self) -> None:
+        self.dirty = True
+        self.idle.clear()
+        context.edit_scheduler.notify(self)
+
+    def _current(self) -> str:
+        self.sb.seek(self.start)
+        text = self.sb.read()
+        self.sb.seek(0, io.SEEK_END)
+        return text
+
+    def _split(self) -> None:
+        text = self._current()
+        # Leave room to close a code block that is still open at the cut
+        cut = split_point(text, MAX_MESSAGE_LENGTH - len(self.prefix) - len(FENCE) - 1)
+        head = self.prefix + text[:cut]
+        lang = open_fence(head)
+        if lang is not None:
+            head = head.rstrip('\n') + '\n' + FENCE
+            self.prefix = FENCE + lang + '\n'
+        else:
+            self.prefix = ''
+        if head.strip():
+            self.finished.append(head.strip())
+        self.start += cut
+
+    def _current_content(self) -> str:
+        current = self._current().strip()
+        if not current:
+            return ''
+        return (self.prefix + current + ('\n' + FENCE if self.closed and open_fence(self.prefix + current) is not None else '')) + self.end
 
-        value = self.sb.getvalue().strip()
-        if not value:
-            return
-            
-        if self.r:
-            await self.r.edit(content=value + end)
-            return
-
-        if self.channel:
-            self.r = await self.channel.send(value)
-        elif self.author:
-            self.r = await self.author.send(value)
\ No newline at end of file
+    async def publish(self) -> bool:
+        """Send or edit at most one discord message. Returns False if nothing had to change."""
+        self.dirty = False
+        if self.discarded:
+            return False
+        total = len(self.finished) + 1
+        for i in range(self.final, total):
+            content = self.finished[i] if i < len(self.finished) else self._current_content()
+            if not content:
+                continue
+            if i < len(self.sent):
+                if self.published[i] == content:
+                    if i == self.final and i < len(self.finished):
+                        self.final += 1
+                    continue
+                await self.sent[i].edit(content=content)
+                self.published[i] = content
+            elif self.channel:
+                self.sent.append(await self.channel.send(content))
+                self.published.append(content)
+            elif self.author:
+                self.sent.append(await self.author.send(content))
+                self.published.append(content)
+            else:
+                continue
+            if i == self.final and i < len(self.finished):
+                self.final += 1 # finished messages are never edited again
+            # One api call per publish; there may be more to do
+            self.dirty = self.dirty or i < total - 1
+            return True
+        return False
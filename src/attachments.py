@@ -0,0 +1,223 @@
+## Image attachments for vision models (opt-in, IMAGES=true).
+## Images are fetched over one shared aiohttp session, capped at `max_bytes`, and stored content-addressed:
+##  <directory>/<hash[:2]>/<hash>.jpg          the original downscaled once to `max_side` and re-encoded as JPEG
+##  <directory>/<hash[:2]>/<hash>-<side>.b64   ready-to-send base64 for a model's input resolution
+##  <directory>/urls/<sha256(url path)>        hash of the content behind an attachment URL
+## Discord attachment URLs are signed and expire, so images are prefetched when the message is saved; prompts
+## then only read the cache. URLs are keyed without their query string, which is what changes on re-signing.
+import io
+import os
+import base64
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+import aiohttp
+from PIL import Image
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".gif", ".bmp")
+
+
+def is_image_url(
+    url: str
+) -> bool:
+    return urlsplit(url).path.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _downscale(data: bytes, max_side: int, quality: int) -> bytes:
+    with Image.open(io.BytesIO(data)) as image:
+        image.seek(0) # first frame of animations
+        image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, format="JPEG", quality=quality, optimize=True)
+        return out.getvalue()
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _read(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class AttachmentStore:
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 20 * 1024 * 1024,
+        max_side: int = 1024,
+        quality: int = 85,
+        recent_turns: int = 4,
+        tokens_per_image: int = 768,
+        memory_bytes: int = 64 * 1024 * 1024,
+        timeout: float = 15
+    ):
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+        self.max_side: int = max_side
+        self.quality: int = quality
+        self.recent_turns: int = recent_turns # only images of the last K turns are sent
+        self.tokens_per_image: int = tokens_per_image # prompt budget reserved per attached image
+        self.memory_bytes: int = memory_bytes
+        self.timeout: float = timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.encoded: "OrderedDict[tuple, str]" = OrderedDict() # (url key, side) -> base64, LRU
+        self.encoded_bytes: int = 0
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.tasks: set = set()
+        self.downloads: int = 0
+        self.downloaded_bytes: int = 0
+        self.hits: int = 0
+        self.errors: int = 0
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            # One session: keep-alive connections to the CDN are reused across downloads
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=8),
+            )
+        return self.session
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+    ## Paths
+
+    def _url_key(self, url: str) -> str:
+        parts = urlsplit(url)
+        return hashlib.sha256(f"{parts.netloc}{parts.path}".encode()).hexdigest()
+
+    def _ref_path(self, url_key: str) -> str:
+        return os.path.join(self.directory, "urls", url_key)
+
+    def _image_path(self, digest: str, suffix: str) -> str:
+        return os.path.join(self.directory, digest[:2], f"{digest}{suffix}")
+
+    ## Fetching
+
+    async def _download(self, url: str) -> bytes:
+        async with self._session().get(url) as response:
+            response.raise_for_status()
+            if response.content_length and response.content_length > self.max_bytes:
+                raise ValueError(f"attachment is {response.content_length} bytes, over the {self.max_bytes} limit")
+            chunks = []
+            size = 0
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise ValueError(f"attachment is over the {self.max_bytes} byte limit")
+                chunks.append(chunk)
+        self.downloads += 1
+        self.downloaded_bytes += size
+        return b"".join(chunks)
+
+    def _store(self, url_key: str, data: bytes) -> str:
+        """Downscaled master copy of downloaded bytes, stored once per content hash. Returns the hash."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._image_path(digest, ".jpg")
+        if not os.path.exists(path):
+            _write_atomic(path, _downscale(data, self.max_side, self.quality))
+        _write_atomic(self._ref_path(url_key), digest.encode())
+        return digest
+
+    async def _master(self, url: str, url_key: str) -> Optional[str]:
+        """Content hash of the cached master copy for `url`, downloading it if needed."""
+        ref = await asyncio.to_thread(_read, self._ref_path(url_key))
+        if ref:
+            return ref.decode()
+        data = await self._download(url)
+        return await asyncio.to_thread(self._store, url_key, data)
+
+    async def _fetch(self, url: str, url_key: str) -> Optional[str]:
+        try:
+            return await self._master(url, url_key)
+        except Exception:
+            self.errors += 1
+            logging.error(f"Error fetching image attachment {urlsplit(url).path}", exc_info=True)
+            return None
+        finally:
+            self.inflight.pop(url_key, None)
+
+    def _master_task(self, url: str) -> asyncio.Task:
+        # Single flight per attachment
+        url_key = self._url_key(url)
+        task = self.inflight.get(url_key)
+        if task is None:
+            task = self.inflight[url_key] = asyncio.create_task(self._fetch(url, url_key))
+        return task
+
+    def prefetch(self, urls: List[str]) -> None:
+        """Cache image attachments in the background while their URLs are still valid."""
+        for url in urls:
+            if is_image_url(url):
+                task = self._master_task(url)
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    ## Encoded images
+
+    def _encode(self, digest: str, side: int) -> Optional[str]:
+        path = self._image_path(digest, f"-{side}.b64")
+        cached = _read(path)
+        if cached is not None:
+            return cached.decode()
+        master = _read(self._image_path(digest, ".jpg"))
+        if master is None:
+            return None
+        data = master if side >= self.max_side else _downscale(master, side, self.quality)
+        encoded = base64.b64encode(data)
+        _write_atomic(path, encoded)
+        return encoded.decode()
+
+    def _remember(self, key: tuple, encoded: str) -> None:
+        self.encoded[key] = encoded
+        self.encoded_bytes += len(encoded)
+        while self.encoded_bytes > self.memory_bytes and len(self.encoded) > 1:
+            _, dropped = self.encoded.popitem(last=False)
+            self.encoded_bytes -= len(dropped)
+
+    async def image_b64(self, url: str, side: Optional[int] = None) -> Optional[str]:
+        """Base64 JPEG of an image attachment, at most `side` pixels on its longer edge. None if unavailable."""
+        side = min(side or self.max_side, self.max_side)
+        key = (self._url_key(url), side)
+        encoded = self.encoded.get(key)
+        if encoded is not None:
+            self.encoded.move_to_end(key)
+            self.hits += 1
+            return encoded
+        # Shielded: the download is shared with the prefetch and other prompts, cancelling this one mustn't stop it
+        digest = await asyncio.shield(self._master_task(url))
+        if digest is None:
+            return None
+        try:
+            encoded = await asyncio.to_thread(self._encode, digest, side)
+        except Exception:
+            self.errors += 1
+            logging.error("Error encoding image attachment", exc_info=True)
+            return None
+        if encoded is not None:
+            self._remember(key, encoded)
+        return encoded
+
+    def stats(self) -> dict:
+        return {
+            "downloads": self.downloads,
+            "downloaded_bytes": self.downloaded_bytes,
+            "memory_hits": self.hits,
+            "cached": len(self.encoded),
+            "errors": self.errors,
+        }
@@ -0,0 +1,139 @@
+## In-memory authorization state.
+## Superadmins/trusted servers from env are parsed once, the redis sets are loaded once at startup,
+## and every change made through redis_conn is published on AUTHZ_CHANNEL so all bot processes
+## apply it to their local sets. Checks on the message hot path never touch the network.
+## The ingest rule sets (src/ingest_filter.py) are kept in sync the same way.
+import json
+import asyncio
+import logging
+from typing import Dict, Optional, Set
+import redis.asyncio as aredis
+import context
+
+AUTHZ_CHANNEL = "authz:changes"
+RECONNECT_DELAY = 5
+INGEST_RULE_KEYS = ("ingest:ignore", "ingest:allow", "ingest:ignore_bots", "ingest:ignore_webhooks")
+
+
+def parse_ids(
+    ids: Optional[str]
+) -> Set[int]:
+    if not ids:
+        return set()
+    return {int(id.strip()) for id in ids.split(",") if id.strip()}
+
+
+class Authorizer:
+    def __init__(self, super_admin_ids: Optional[str] = None, discord_server_ids: Optional[str] = None):
+        self.env_super_admins: Set[int] = parse_ids(super_admin_ids)
+        self.env_trusted_servers: Set[int] = parse_ids(discord_server_ids)
+
+        # redis backed sets, keyed the same way as in redis
+        self.sets: Dict[str, Set[int]] = {
+            "super_admins": set(),
+            "dm_whitelist": set(),
+            "trusted_servers": set(),
+            **{key: set() for key in INGEST_RULE_KEYS},
+        }
+        self.loaded: bool = False
+        self.listener: Optional[asyncio.Task] = None
+
+    def is_superadmin(self, user_id: int) -> bool:
+        return user_id in self.env_super_admins or user_id in self.sets["super_admins"]
+
+    def is_admin(self, user_id: int, guild_id: Optional[int] = None) -> bool:
+        if self.is_superadmin(user_id):
+            return True
+        if guild_id is not None:
+            return user_id in self.sets.get(f"admins:{guild_id}", ())
+        return False
+
+    def is_dm_allowed(self, user_id: int) -> bool:
+        return self.is_admin(user_id) or user_id in self.sets["dm_whitelist"]
+
+    def is_trusted_server(self, server_id: int) -> bool:
+        return server_id in self.env_trusted_servers or server_id in self.sets["trusted_servers"]
+
+    def apply(self, op: str, key: str, member: int) -> None:
+        members = self.sets.setdefault(key, set())
+        if op == "add":
+            members.add(int(member))
+        elif op == "remove":
+            members.discard(int(member))
+            if not members and key.startswith("admins:"):
+                del self.sets[key]
+
+    async def load(self) -> None:
+        if not context.redis:
+            return
+        sets: Dict[str, Set[int]] = {}
+        for key in ("super_admins", "dm_whitelist", "trusted_servers") + INGEST_RULE_KEYS:
+            sets[key] = {int(m) for m in await context.redis.smembers(key)}
+        async for key in context.redis.scan_iter(match="admins:*", count=500):
+            sets[key] = {int(m) for m in await context.redis.smembers(key)}
+        self.sets = sets
+        self.loaded = True
+        logging.info(
+            f"Authorization loaded: {len(sets['super_admins'])} superadmins, "
+            f"{sum(len(v) for k, v in sets.items() if k.startswith('admins:'))} server admins, "
+            f"{len(sets['dm_whitelist'])} whitelisted DM users, {len(sets['trusted_servers'])} trusted servers, "
+            f"{sum(len(sets[k]) for k in INGEST_RULE_KEYS)} ingest rules"
+        )
+
+    async def publish(self, op: str, key: str, member: int) -> None:
+        # Apply locally right away, other processes pick it up through pub/sub
+        self.apply(op, key, member)
+        if context.redis:
+            await context.redis.publish(AUTHZ_CHANNEL, json.dumps({"op": op, "key": key, "member": int(member)}))
+
+    async def start(self) -> None:
+        """Subscribe and load before returning; only the change listener keeps running in the background."""
+        if not context.redis or self.listener is not None:
+            return
+        pubsub = context.redis.pubsub()
+        try:
+            # Subscribe before loading so no change can slip in between
+            await pubsub.subscribe(AUTHZ_CHANNEL)
+            await self.load()
+        except Exception:
+            logging.error("Could not load authorization, retrying in the background", exc_info=True)
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+            pubsub = None
+        self.listener = asyncio.create_task(self.listen(pubsub))
+
+    async def listen(self, pubsub=None) -> None:
+        """Apply published changes. `pubsub` is an already subscribed and loaded connection, if any."""
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = context.redis.pubsub()
+                    # Subscribe before (re)loading so no change can slip in between
+                    await pubsub.subscribe(AUTHZ_CHANNEL)
+                    await self.load()
+                async for msg in pubsub.listen():
+                    if msg.get("type") != "message":
+                        continue
+                    try:
+                        change = json.loads(msg["data"])
+                        self.apply(change["op"], change["key"], change["member"])
+                    except (ValueError, KeyError, TypeError):
+                        logging.error(f"Invalid authorization change: {msg['data']!r}")
+            except asyncio.CancelledError:
+                raise
+            except (aredis.ConnectionError, aredis.TimeoutError, OSError):
+                logging.error("Authorization listener lost redis connection, reloading", exc_info=True)
+                await asyncio.sleep(RECONNECT_DELAY)
+            except Exception:
+                # Nothing watches this task: anything else must not silently end syncing either
+                logging.error("Authorization listener failed, reloading", exc_info=True)
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                if pubsub is not None:
+                    try:
+                        await pubsub.aclose()
+                    except Exception:
+                        pass
+                    pubsub = None
@@ -10,6 +10,7 @@ sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 import context
 from src.redis_conn import (
     save_message_redis,
+    build_message_record,
     get_messages,
     get_message,
     get_all_message_ids,
@@ -27,8 +28,21 @@ from src.redis_conn import (
     add_trusted_server,
     remove_trusted_server,
     set_current_model,
-    get_current_model
+    get_current_model,
+    set_latest_wins,
+    get_history_cap,
+    set_history_cap,
+    get_latest_wins,
+    add_ingest_rule,
+    remove_ingest_rule,
+    get_history_usage,
+    get_retention_policies,
+    set_retention_policy,
+    snowflake_to_ms,
+    reencode_history
 )
+from src.metrics import percentile
+from src.log_files import tail_records, list_archives, filter_to_file, log_ids, stop_logging, truncate_log
 from src.ollama_conn import (
     ollama_conn,
     get_model_list
@@ -41,14 +55,53 @@ class bentebot:
         # register event handlers
         context.discord.event(self.on_ready)
         context.discord.event(self.on_message)
+        context.discord.event(self.on_message_edit)
+        context.discord.event(self.on_raw_message_delete)
+        context.discord.event(self.on_raw_bulk_message_delete)
+        context.discord.setup_hook = self.setup_hook
+        self.discord_close = context.discord.close
+        context.discord.close = self.close
         
         self.register_slash_commands()
         
+    async def setup_hook(self):
+        # Runs once before connecting to the gateway; awaited so authorization is loaded before the first message
+        await context.authz.start()
+        # Probe all ollama hosts once so the first request is routed with real model lists
+        await asyncio.gather(*(context.llama.probe(b) for b in context.llama.backends))
+        context.llama.start()
+        asyncio.create_task(context.residency.preload_startup())
+        context.model_catalog.start()
+        context.summarizer.generate = self.ollama_conn.generate
+        context.summarizer.start()
+        context.retention.start()
+        if context.ingest:
+            context.ingest.start()
+        # Converts records stored in an older encoding; a no-op once it has completed
+        asyncio.create_task(reencode_history())
+        if context.retrieval:
+            context.retrieval.start()
+        if context.metrics_port:
+            await context.metrics.serve(context.metrics_host, context.metrics_port)
+        
+    async def close(self):
+        # discord.Client.run calls this on shutdown, while the event loop is still running
+        try:
+            await self.discord_close()
+        finally:
+            if context.ingest:
+                # Messages seen in the last flush interval
+                await context.ingest.close()
+            if context.attachments:
+                await context.attachments.close()
+        
     def run(self, token:str):
         try:
             context.discord.run(token)
         except Exception:
             logging.exception('Discord client encountered an error')
+        finally:
+            stop_logging()
 
 
 
@@ -87,30 +140,77 @@ class bentebot:
             trusted_server = is_trusted_server(message.guild.id)
             if not trusted_server:
                 return
-            ## TODO: Before saving msg to redis, check if this channel is on a ignore list
-            ##      TODO 2: Create ignore list logic. Redis getters & setters and implementation
-            save_message_redis(message_id, message_content, author, channel_id, attachments)
+            mentioned = context.discord.user in message.mentions
+            # Ignore rules only apply to messages we aren't asked to answer; checked in memory, no I/O
+            if not mentioned and not context.ingest_filter.should_store(message):
+                return
+            if context.ingest:
+                # Written in a later batch; prompts flush the channel before reading its history
+                context.ingest.add(channel_id, build_message_record(message_id, message_content, author, attachments))
+            else:
+                await save_message_redis(message_id, message_content, author, channel_id, attachments)
             
             ## Check if we are mentioned in this message.
-            if context.discord.user not in message.mentions:
+            if not mentioned:
                 return
             
             await self.on_channel_message(message)
         else: # if DM
             dm_allowed = is_dm_allowed(message.author.id)
             if not dm_allowed:
-                logging.info(f"{message.author.id} tried to DM me '{message_content}' without DM permission...")
+                # Rate limited per user: anyone can trigger this as often as they like
+                logging.info(
+                    f"{message.author.id} tried to DM me '{message_content}' without DM permission...",
+                    extra=log_ids(message, rate_key=f"dm_rejected:{message.author.id}"),
+                )
                 await message.add_reaction('🚫')
                 return
             
-            save_message_redis(message_id, message_content, author, channel_id, attachments)
+            await save_message_redis(message_id, message_content, author, channel_id, attachments)
             await self.on_direct_message(message)
         
         
     
     
     
+    async def on_message_edit(self, before:discord.Message, after:discord.Message):
+        # Embeds resolving also fire edits, only react to changed text
+        if context.discord.user == after.author or before.content == after.content:
+            return
+        # Answer again only if the edit interrupted an answer in progress or newly asks us;
+        # fixing a typo in a question answered long ago must not post a second answer
+        cancelled = self.ollama_conn.cancel_task(after.id, "edited")
+        newly_mentioned = context.discord.user in after.mentions and context.discord.user not in before.mentions
+        if cancelled or newly_mentioned:
+            await self.on_message(after)
+            return
+        # Otherwise only the stored text changes, so later prompts show what the message says now
+        if after.guild is not None:
+            if not is_trusted_server(after.guild.id):
+                return
+            if context.discord.user not in after.mentions and context.ingest_filter.skip_reason(after) is not None:
+                return
+            if context.ingest:
+                # A buffered copy of the old text must not be written over the edit
+                await context.ingest.flush(after.channel.id)
+        elif not is_dm_allowed(after.author.id):
+            return
+        message_content = after.content.replace(f'<@{context.discord.user.id}>', '').strip()
+        await save_message_redis(after.id, message_content, after.author, after.channel.id, after.attachments)
+    
+    
+    async def on_raw_message_delete(self, payload:discord.RawMessageDeleteEvent):
+        self.ollama_conn.cancel_task(payload.message_id, "deleted")
+    
+    
+    async def on_raw_bulk_message_delete(self, payload:discord.RawBulkMessageDeleteEvent):
+        for message_id in payload.message_ids:
+            self.ollama_conn.cancel_task(message_id, "deleted")
+    
+    
     async def on_channel_message(self, message:discord.Message):
+        if await get_latest_wins(message.channel.id):
+            self.ollama_conn.cancel_superseded(message)
         ## Create and start writing task with ollama chatbot
         self.ollama_conn.add_task(message)
     
@@ -141,13 +241,13 @@ class bentebot:
         )
         
         # /model
-        context.discord.tree.add_command(
-            app_commands.Command(
-                name="model",
-                description="Variety of model commands. Set, Get, List, Pull, Delete, Help",
-                callback=self.slash_model,
-            )
+        model_command = app_commands.Command(
+            name="model",
+            description="Variety of model commands. Set, Get, List, Pull, Delete, Help",
+            callback=self.slash_model,
         )
+        model_command.autocomplete("model")(self.model_autocomplete)
+        context.discord.tree.add_command(model_command)
         
         # /trust_server
         context.discord.tree.add_command(
@@ -185,6 +285,60 @@ class bentebot:
             )
         )
         
+        # /latest_wins
+        context.discord.tree.add_command(
+            app_commands.Command(
+                name="latest_wins",
+                description="Cancel a user's running answer when they ask again. Use `action:help` for usage.",
+                callback=self.slash_latest_wins,
+            )
+        )
+        
+        # /history_cap
+        context.discord.tree.add_command(
+            app_commands.Command(
+                name="history_cap",
+                description="How many messages this channel remembers. Use `action:help` for usage.",
+                callback=self.slash_history_cap,
+            )
+        )
+        
+        # /cache
+        context.discord.tree.add_command(
+            app_commands.Command(
+                name="cache",
+                description="Response cache hit rates. Use `action:help` for usage.",
+                callback=self.slash_cache,
+            )
+        )
+        
+        # /ingest
+        context.discord.tree.add_command(
+            app_commands.Command(
+                name="ingest",
+                description="Choose which channels and authors are remembered. Use `action:help` for usage.",
+                callback=self.slash_ingest,
+            )
+        )
+        
+        # /retention
+        context.discord.tree.add_command(
+            app_commands.Command(
+                name="retention",
+                description="History retention and archive restore. Use `action:help` for usage.",
+                callback=self.slash_retention,
+            )
+        )
+        
+        # /stats
+        context.discord.tree.add_command(
+            app_commands.Command(
+                name="stats",
+                description="Inference and bot latency summary for the last hour (Superadmin only).",
+                callback=self.slash_stats,
+            )
+        )
+        
         # /wipe
         context.discord.tree.add_command(
             app_commands.Command(
@@ -195,13 +349,13 @@ class bentebot:
         )
         
         # /logs
-        context.discord.tree.add_command(
-            app_commands.Command(
-                name="logs",
-                description="Read/Download/Clear logs",
-                callback=self.slash_logs,
-            )
+        logs_command = app_commands.Command(
+            name="logs",
+            description="Read/Download/Clear logs",
+            callback=self.slash_logs,
         )
+        logs_command.autocomplete("archive")(self.archive_autocomplete)
+        context.discord.tree.add_command(logs_command)
         
     
     
@@ -220,7 +374,7 @@ class bentebot:
             msg = "Can't trust DM."
         else: # Server or group
             if action == "add":
-                result = add_trusted_server(interaction.guild.id)
+                result = await add_trusted_server(interaction.guild.id)
                 msg = f"✅ Added {interaction.guild.name} to trusted servers." if result else f"Redis is not connected."
                 if result:
                     logging.info(
@@ -228,7 +382,7 @@ class bentebot:
                         f"{interaction.guild.name} ({interaction.guild.id})"
                     )
             elif action == "remove":
-                result = remove_trusted_server(interaction.guild.id)
+                result = await remove_trusted_server(interaction.guild.id)
                 msg = f"🗑️ Removed {interaction.guild.name} from trusted servers." if result else f"Redis is not connected."
                 if result:
                     logging.info(
@@ -261,7 +415,7 @@ class bentebot:
             return
         action = action.lower()
         if action == "add":
-            result = add_dm_whitelist(tagged_user.id)
+            result = await add_dm_whitelist(tagged_user.id)
             msg = f"✅ Added {tagged_user.mention} to DM whitelist." if result else f"Redis is not connected."
             if result:
                 logging.info(
@@ -269,7 +423,7 @@ class bentebot:
                     f"{tagged_user.name} ({tagged_user.id})"
                 )
         elif action == "remove":
-            result = remove_dm_whitelist(tagged_user.id)
+            result = await remove_dm_whitelist(tagged_user.id)
             msg = f"🗑️ Removed {tagged_user.mention} from DM whitelist." if result else "Redis is not connected."
             if result:
                 logging.info(
@@ -303,7 +457,7 @@ class bentebot:
         action = action.lower()
         user_id = tagged_user.id
         if action == "add":
-            result = add_server_admin(user_id, interaction.guild.id)
+            result = await add_server_admin(user_id, interaction.guild.id)
             msg = f"✅ Added {tagged_user.mention} to server admin." if result else f"Redis is not connected."
             if result:
                 logging.info(
@@ -311,7 +465,7 @@ class bentebot:
                     f"{tagged_user.name} ({tagged_user.id}) - ({interaction.guild.name}) ({interaction.guild.id})"
                 )
         elif action == "remove":
-            result = remove_server_admin(user_id, interaction.guild.id)
+            result = await remove_server_admin(user_id, interaction.guild.id)
             msg = f"🗑️ Removed {tagged_user.mention} from server admin." if result else "Redis is not connected."
             if result:
                 logging.info(
@@ -345,7 +499,7 @@ class bentebot:
         action = action.lower()
         user_id = tagged_user.id
         if action == "add":
-            result = add_super_admin(user_id)
+            result = await add_super_admin(user_id)
             msg = f"✅ Added {tagged_user.mention} to super admin." if result else f"Redis is not connected."
             if result:
                 logging.info(
@@ -353,7 +507,7 @@ class bentebot:
                     f"{tagged_user.name} ({tagged_user.id})"
                 )
         elif action == "remove":
-            result = remove_super_admin(user_id)
+            result = await remove_super_admin(user_id)
             msg = f"🗑️ Removed {tagged_user.mention} from super admin." if result else "Redis is not connected."
             if result:
                 logging.info(
@@ -376,10 +530,382 @@ class bentebot:
         
         
     
+    async def slash_latest_wins(self, interaction: discord.Interaction, action:str="status"):
+        admin_check = is_admin(interaction.user.id, interaction.guild.id if interaction.guild else None)
+        if not admin_check:
+            await interaction.response.send_message(
+                "Not authorized.",
+                ephemeral=True
+            )
+            return
+        action = action.lower()
+        if action in ("on", "off"):
+            result = await set_latest_wins(interaction.channel_id, action == "on")
+            msg = f"✅ Latest mention wins is now **{action}** in this channel." if result else "Redis is not connected."
+            if result:
+                logging.info(
+                    f"Latest mention wins set {action} by {interaction.user.name} ({interaction.user.id}) "
+                    f"in channel ({interaction.channel_id})"
+                )
+        elif action == "status":
+            enabled = await get_latest_wins(interaction.channel_id)
+            stats = self.ollama_conn.cancel_stats()
+            counts = ", ".join(f"{reason}: {s['count']} ({s['tokens']} tokens)" for reason, s in stats.items()) or "none"
+            msg = (
+                f"**Latest mention wins:** {'on' if enabled else 'off'}\n"
+                f"**Cancelled generations:** {counts}"
+            )
+        elif action == "help":
+                msg = (
+                    "ℹ️ **Latest Wins Command Help**\n"
+                    "When on, a new mention cancels the same user's answer that is still being generated in this channel.\n\n"
+                    "**Usage:** `/latest_wins action:<on|off|status|help>`\n"
+                    "- `on` → Enables it for the current channel.\n"
+                    "- `off` → Disables it for the current channel.\n"
+                    "- `status` → Shows the setting and how many generations were cancelled.\n"
+                    "- `help` → Displays this help message."
+                )
+        else:
+            msg = "⚠️ Invalid action. Use `/latest_wins action:help` for usage info."
+        
+        await interaction.response.send_message(msg, ephemeral=True)
+        
+    
+    async def slash_history_cap(self, interaction: discord.Interaction, action:str="status", messages:int=None):
+        admin_check = is_admin(interaction.user.id, interaction.guild.id if interaction.guild else None)
+        if not admin_check:
+            await interaction.response.send_message(
+                "Not authorized.",
+                ephemeral=True
+            )
+            return
+        action = action.lower()
+        if action == "set":
+            if messages is None or messages < 0:
+                msg = "⚠️ `messages` must be 0 (unbounded) or more."
+            else:
+                result = await set_history_cap(interaction.channel_id, messages)
+                msg = f"✅ This channel now keeps the last **{messages or 'unbounded'}** messages." if result else "Redis is not connected."
+                if result:
+                    logging.info(
+                        f"History cap set to {messages} by {interaction.user.name} ({interaction.user.id}) "
+                        f"in channel ({interaction.channel_id})"
+                    )
+        elif action == "clear":
+            result = await set_history_cap(interaction.channel_id, None)
+            msg = f"✅ This channel uses the default cap again ({context.history_max_messages or 'unbounded'})." if result else "Redis is not connected."
+            if result:
+                logging.info(
+                    f"History cap cleared by {interaction.user.name} ({interaction.user.id}) "
+                    f"in channel ({interaction.channel_id})"
+                )
+        elif action == "status":
+            cap = await get_history_cap(interaction.channel_id)
+            usage = await get_history_usage(interaction.channel_id)
+            effective = context.history_max_messages if cap is None else cap
+            msg = (
+                f"**History cap:** {effective or 'unbounded'} ({'this channel' if cap is not None else 'default'})\n"
+                f"**Stored messages:** {usage['count']}"
+            )
+        elif action == "help":
+                msg = (
+                    "ℹ️ **History Cap Command Help**\n"
+                    "Caps how many messages are kept for this channel; older ones are trimmed on the next save "
+                    "(and archived when the archive is on).\n\n"
+                    "**Usage:** `/history_cap action:<set|clear|status|help> [messages]`\n"
+                    "- `set` → Keeps the last `messages` messages in this channel (0 = unbounded).\n"
+                    "- `clear` → Goes back to the default cap.\n"
+                    "- `status` → Shows the cap in effect and how many messages are stored.\n"
+                    "- `help` → Displays this help message."
+                )
+        else:
+            msg = "⚠️ Invalid action. Use `/history_cap action:help` for usage info."
+        
+        await interaction.response.send_message(msg, ephemeral=True)
+        
+    
+    async def slash_cache(self, interaction: discord.Interaction, action:str="status"):
+        admin_check = is_admin(interaction.user.id, interaction.guild.id if interaction.guild else None)
+        if not admin_check:
+            await interaction.response.send_message(
+                "Not authorized.",
+                ephemeral=True
+            )
+            return
+        action = action.lower()
+        if action == "status":
+            if not context.response_cache:
+                msg = "Response cache is disabled (`RESPONSE_CACHE=false`)."
+            else:
+                s = context.response_cache.stats()
+                msg = (
+                    f"**Response cache** ({context.response_cache.scope})\n"
+                    f"Hits: {s['hits']} · Misses: {s['misses']} · Hit rate: {s['hit_rate']:.1%}\n"
+                    f"Stored: {s['stores']} · Evicted: {s['evictions']}"
+                )
+        elif action == "help":
+                msg = (
+                    "ℹ️ **Cache Command Help**\n"
+                    "Identical prompts are answered from the response cache instead of generating again. "
+                    "`/wipe` drops the current channel's cached answers.\n\n"
+                    "**Usage:** `/cache action:<status|help>`\n"
+                    "- `status` → Shows hit and miss rates.\n"
+                    "- `help` → Displays this help message."
+                )
+        else:
+            msg = "⚠️ Invalid action. Use `/cache action:help` for usage info."
+        
+        await interaction.response.send_message(msg, ephemeral=True)
+        
+    
+    async def slash_ingest(self, interaction: discord.Interaction, action:str="status", scope:str="channel"):
+        guild_id = interaction.guild.id if interaction.guild else None
+        admin_check = guild_id is not None and is_admin(interaction.user.id, guild_id)
+        if not admin_check:
+            await interaction.response.send_message(
+                "Not authorized.",
+                ephemeral=True
+            )
+            return
+        action = action.lower()
+        scope = scope.lower()
+        channel = interaction.channel
+        scope_ids = {
+            "channel": interaction.channel_id,
+            "category": getattr(channel, "category_id", None),
+            "server": guild_id,
+        }
+        scope_id = scope_ids.get(scope)
+        if scope_id is None:
+            await interaction.response.send_message("⚠️ `scope` must be `channel`, `category` (if this channel has one) or `server`.", ephemeral=True)
+            return
+        
+        if action in ("ignore", "allow"):
+            # A scope is either ignored or allowed
+            await remove_ingest_rule("allow" if action == "ignore" else "ignore", scope_id)
+            result = await add_ingest_rule(action, scope_id)
+            msg = (
+                f"✅ Messages in this {scope} are now **{'not stored' if action == 'ignore' else 'stored'}**"
+                f"{' (mentions of me are always stored)' if action == 'ignore' else ''}."
+            ) if result else "Redis is not connected."
+        elif action in ("ignore_bots", "ignore_webhooks"):
+            result = await add_ingest_rule(action, scope_id)
+            msg = f"✅ Messages from {action.split('_')[1]} in this {scope} are no longer stored." if result else "Redis is not connected."
+        elif action == "reset":
+            result = True
+            for rule in context.ingest_filter.rules_for(scope_id):
+                result = await remove_ingest_rule(rule, scope_id) and result
+            msg = f"✅ Ingest rules for this {scope} removed." if result else "Redis is not connected."
+        elif action == "status":
+            lines = []
+            for name, sid in scope_ids.items():
+                if sid is None:
+                    continue
+                rules = [rule for rule, on in context.ingest_filter.rules_for(sid).items() if on]
+                lines.append(f"- {name}: {', '.join(rules) if rules else 'no rules'}")
+            stats = context.ingest_filter.stats()
+            skipped = ", ".join(f"{k} {v}" for k, v in stats.items() if k not in ("stored", "skipped"))
+            msg = (
+                "**Ingest rules here**\n" + "\n".join(lines) + "\n"
+                f"**Since start:** {stats['stored']} stored, {stats['skipped']} skipped" + (f" ({skipped})" if skipped else "")
+            )
+        elif action == "help":
+                msg = (
+                    "ℹ️ **Ingest Command Help**\n"
+                    "Controls which messages are remembered as conversation history. The most specific rule wins "
+                    "(channel, then category, then server). Messages that mention me are always stored.\n\n"
+                    "**Usage:** `/ingest action:<status|ignore|allow|ignore_bots|ignore_webhooks|reset|help> [scope:<channel|category|server>]`\n"
+                    "- `status` → Shows the rules that apply here and how many messages were stored or skipped.\n"
+                    "- `ignore` → Stops storing messages in the scope.\n"
+                    "- `allow` → Stores messages in the scope even if a wider scope is ignored.\n"
+                    "- `ignore_bots` / `ignore_webhooks` → Stops storing bot / webhook messages in the scope.\n"
+                    "- `reset` → Removes the scope's rules.\n"
+                    "- `help` → Displays this help message."
+                )
+        else:
+            msg = "⚠️ Invalid action. Use `/ingest action:help` for usage info."
+        
+        if action in ("ignore", "allow", "ignore_bots", "ignore_webhooks", "reset") and msg.startswith("✅"):
+            logging.info(
+                f"Ingest rule {action} for {scope} ({scope_id}) set by {interaction.user.name} ({interaction.user.id})"
+            )
+        await interaction.response.send_message(msg, ephemeral=True)
+        
+    
+    async def slash_retention(
+        self, 
+        interaction: discord.Interaction, 
+        action:str="status", 
+        scope:str="channel", 
+        max_age_days:float=None, 
+        max_count:int=None, 
+        max_mb:float=None, 
+        since:str=None, 
+        until:str=None
+    ):
+        guild_id = interaction.guild.id if interaction.guild else None
+        admin_check = is_admin(interaction.user.id, guild_id)
+        if not admin_check:
+            await interaction.response.send_message(
+                "Not authorized.",
+                ephemeral=True
+            )
+            return
+        action = action.lower()
+        scope = scope.lower()
+        if scope not in ("channel", "server") or (scope == "server" and guild_id is None):
+            await interaction.response.send_message("⚠️ `scope` must be `channel`, or `server` inside a server.", ephemeral=True)
+            return
+        scope_id = guild_id if scope == "server" else interaction.channel_id
+        retention = context.retention
+        
+        if action == "status":
+            await interaction.response.defer(ephemeral=True, thinking=True)
+            policies = await get_retention_policies()
+            policy = retention.policy_for(interaction.channel_id, policies, guild_id)
+            usage = await get_history_usage(interaction.channel_id)
+            archive = await retention.usage(interaction.channel_id)
+            stats = retention.stats()
+            oldest = datetime.datetime.fromtimestamp(snowflake_to_ms(usage["oldest"]) / 1000).strftime('%Y-%m-%d') if usage["oldest"] else "-"
+            msg = (
+                f"**Retention for this channel:** {policy.describe()}\n"
+                f"**Stored:** {usage['count']} messages (oldest {oldest})\n"
+                f"**Archive:** {archive['segments']} segments, {archive['bytes'] / 1024:.0f} KB"
+                f"{'' if retention.archive else ' (archiving disabled)'}\n"
+                f"**Sweeper:** {stats['sweeps']} sweeps, {stats['archived']} archived, {stats['restored']} restored"
+            )
+            await interaction.followup.send(msg, ephemeral=True)
+            return
+        elif action == "set":
+            fields = {"max_age_days": max_age_days, "max_count": max_count,
+                      "max_bytes": int(max_mb * 1024 * 1024) if max_mb is not None else None}
+            fields = {k: v for k, v in fields.items() if v is not None}
+            if not fields or any(v < 0 for v in fields.values()):
+                msg = "⚠️ Give at least one of `max_age_days`, `max_count`, `max_mb` (0 = no limit)."
+            else:
+                policy = (await get_retention_policies()).get(scope_id, {})
+                policy.update(fields)
+                result = await set_retention_policy(scope_id, policy)
+                msg = f"✅ Retention for this {scope} updated." if result else "Redis is not connected."
+                if result:
+                    logging.info(
+                        f"Retention for {scope} ({scope_id}) set to {policy} by {interaction.user.name} ({interaction.user.id})"
+                    )
+        elif action == "clear":
+            result = await set_retention_policy(scope_id, None)
+            msg = f"✅ This {scope} now uses the {'server' if scope == 'channel' and guild_id else 'default'} retention." if result else "Redis is not connected."
+        elif action == "restore":
+            try:
+                start = datetime.datetime.strptime(since, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc) if since else None
+                # `until` is inclusive: the archive's end bound is exclusive, so stop at the next midnight
+                end = datetime.datetime.strptime(until, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc) + datetime.timedelta(days=1) if until else None
+            except ValueError:
+                await interaction.response.send_message("⚠️ `since`/`until` must be dates like 2024-05-31.", ephemeral=True)
+                return
+            await interaction.response.defer(ephemeral=True, thinking=True)
+            try:
+                restored = await retention.restore(interaction.channel_id, start, end)
+            except Exception:
+                logging.error("Error restoring archived history", exc_info=True)
+                await interaction.followup.send("Error restoring archived history.", ephemeral=True)
+                return
+            logging.info(
+                f"{restored} archived messages restored by {interaction.user.name} ({interaction.user.id}) "
+                f"in channel ({interaction.channel_id}), {since or 'start'} to {until or 'now'}"
+            )
+            hold = f" Retention is paused here for {retention.hold_seconds // 3600}h." if restored else ""
+            await interaction.followup.send(f"✅ Restored {restored} archived messages.{hold}", ephemeral=True)
+            return
+        elif action == "help":
+                msg = (
+                    "ℹ️ **Retention Command Help**\n"
+                    "Messages outside the retention policy are moved from memory to a compressed archive on disk "
+                    "by a periodic sweep. A channel policy overrides the server policy, which overrides the default.\n\n"
+                    "**Usage:** `/retention action:<status|set|clear|restore|help> [scope:<channel|server>]`\n"
+                    "- `status` → Shows the policy, stored messages and archive size of this channel.\n"
+                    "- `set` → Sets `max_age_days`, `max_count` and/or `max_mb` for the scope (0 = no limit).\n"
+                    "- `clear` → Removes the scope's own policy.\n"
+                    "- `restore` → Brings archived messages of this channel back, optionally `since`/`until` (YYYY-MM-DD).\n"
+                    "- `help` → Displays this help message."
+                )
+        else:
+            msg = "⚠️ Invalid action. Use `/retention action:help` for usage info."
+        
+        await interaction.response.send_message(msg, ephemeral=True)
+        
+    
+    async def slash_stats(self, interaction: discord.Interaction):
+        admin_check = is_superadmin(interaction.user.id)
+        if not admin_check:
+            await interaction.response.send_message(
+                "Not authorized.",
+                ephemeral=True
+            )
+            return
+        
+        metrics = context.metrics
+        summary = metrics.summary(3600)
+        rows = [
+            ("Time to first token", "bentebot_ttft_seconds", "s"),
+            ("Tokens/sec", "bentebot_tokens_per_second", ""),
+            ("Prompt tokens", "bentebot_prompt_tokens", ""),
+            ("Queue wait", "bentebot_queue_wait_seconds", "s"),
+            ("Model load", "bentebot_model_load_seconds", "s"),
+            ("Discord edit", "bentebot_discord_edit_seconds", "s"),
+            ("Redis call", "bentebot_redis_seconds", "s"),
+            ("Ingest delay", "bentebot_ingest_delay_seconds", "s"),
+        ]
+        lines = [f"{'':<20}{'count':>7}{'p50':>10}{'p95':>10}{'max':>10}"]
+        for label, name, unit in rows:
+            h = summary[name]
+            fmt = (lambda v: f"{v * 1000:.0f}ms" if v < 1 else f"{v:.1f}s") if unit == "s" else (lambda v: f"{v:.0f}")
+            lines.append(f"{label:<20}{h['count']:>7}{fmt(h['p50']):>10}{fmt(h['p95']):>10}{fmt(h['max']):>10}")
+        
+        per_model = metrics.by_label(metrics.tokens_per_second, "model")
+        if per_model:
+            lines.append("")
+            lines.append("Tokens/sec by model (p50)")
+            lines.extend(f"  {model[:30]:<30}{percentile(v, 0.5):>8.1f}  n={len(v)}" for model, v in sorted(per_model.items()))
+        
+        queue = context.scheduler.stats()
+        prefix = context.prefix_tracker.stats()
+        history = context.history_cache.stats()
+        lines.append("")
+        lines.append(f"Queue: {queue['depth']} waiting, {queue['running']} running")
+        lines.append(f"Prefix reuse: {prefix['prefix_reuse']:.0%} · History cache hits: {history['hit_rate']:.0%}")
+        lines.append(f"Trimmed prompts: {prefix['trimmed']} (~{prefix['dropped_tokens']} tokens, {prefix['dropped_messages']} msgs dropped)")
+        if context.response_cache:
+            lines.append(f"Response cache hits: {context.response_cache.stats()['hit_rate']:.0%}")
+        residency = context.residency.stats()
+        if residency:
+            lines.append("Models: " + ", ".join(
+                f"{model[:24]} {r['loads']} loads/{r['unloads']} unloads/{r['cold_starts']} cold ({r['cold_start_seconds']}s)"
+                for model, r in residency.items()
+            ))
+        summaries = context.summarizer.stats()
+        lines.append(f"Summaries: {summaries['runs']} runs, {summaries['summarized_messages']} msgs folded, {summaries['pending_channels']} channels pending, {summaries['yielded']} yielded to replies")
+        ingest_filter = context.ingest_filter.stats()
+        lines.append(f"Ingest rules: {ingest_filter['stored']} stored, {ingest_filter['skipped']} skipped")
+        if context.ingest:
+            ingest = context.ingest.stats()
+            lines.append(f"Ingest: {ingest['records']} msgs in {ingest['batches']} batches (avg {ingest['avg_batch']:.1f}), {ingest['forced']} forced flushes, {ingest['pending']} pending, {ingest['retried']} retried, {ingest['errors']} dropped")
+        if context.attachments:
+            images = context.attachments.stats()
+            lines.append(f"Images: {images['downloads']} downloaded ({images['downloaded_bytes'] / 1024 / 1024:.1f} MB), {images['memory_hits']} memory hits, {images['errors']} errors")
+        cancelled = self.ollama_conn.cancel_stats()
+        if cancelled:
+            lines.append("Cancelled: " + ", ".join(f"{reason} {c['count']} ({c['tokens']} tok)" for reason, c in cancelled.items()))
+        
+        content = "\n".join(lines)
+        if len(content) > 1900:
+            content = content[:1900] + "\n…"
+        await interaction.response.send_message(f"📊 **Last hour**\n```\n{content}\n```", ephemeral=True)
+        
+    
     async def slash_wipe_redis(self, interaction: discord.Interaction):
         if interaction.guild is None: # DM
             if is_dm_allowed(interaction.user.id) or is_admin(interaction.user.id):
-                result = delete_messages(interaction.channel_id)
+                result = await delete_messages(interaction.channel_id)
                 msg = "Memory Wiped..."
                 if result:
                     logging.info(
@@ -389,7 +915,7 @@ class bentebot:
                 msg = "Not authorized..."
         else: # Server or group
             if is_admin(interaction.user.id):
-                result = delete_messages(interaction.channel_id)
+                result = await delete_messages(interaction.channel_id)
                 msg = "Memory Wiped..."
                 if result:
                     logging.info(
@@ -403,8 +929,19 @@ class bentebot:
             
     
     
-    ## TODO: Create slash command to pull new models - (Superadmin only)
-    ## TODO: Create slash command to delete models - (Superadmin only)
+    async def model_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        # Answered from the cached catalog, no round-trip to the inference hosts per keystroke
+        if not is_admin(interaction.user.id, interaction.guild.id if interaction.guild else None):
+            return []
+        current = (current or "").lower()
+        entries = [e for e in context.model_catalog.cached() if current in e.name.lower()]
+        entries.sort(key=lambda e: (not e.name.lower().startswith(current), e.name))
+        return [
+            app_commands.Choice(name=f"{e.name} ({e.describe()})"[:100], value=e.name)
+            for e in entries[:25]
+        ]
+    
+    
     async def slash_model(self, interaction: discord.Interaction, action: str = "current", model: str = None):
         admin_check = is_admin(interaction.user.id, interaction.guild.id if interaction.guild else None)
         if not admin_check:
@@ -417,15 +954,15 @@ class bentebot:
         action = action.lower()
         ## slash command to see current Ollama Model being used - (Admin only)
         if action == "current":
-            current_model = get_current_model(interaction.channel_id)
+            current_model = await context.residency.model_for(interaction.channel_id)
             msg = f"**Current model:** {current_model}"
         ## slash command to list available models which are downloaded already - (Admin only)
         elif action == "list":
-            model_list = await get_model_list()
-            if not model_list:
+            catalog = await context.model_catalog.get()
+            if not catalog:
                 msg = "**No models available.**"
             else:
-                formatted = "\n".join(f"{i+1}. {name}" for i, name in enumerate(model_list))
+                formatted = "\n".join(f"{i+1}. {name} ({catalog[name].describe()})" for i, name in enumerate(sorted(catalog)))
                 msg = f"**Available Models:**\n```\n{formatted}\n```"
         ## slash command to change current model - (Admin only)
         elif action == "set":
@@ -436,19 +973,48 @@ class bentebot:
                 if model not in model_list:
                     msg = f"**Error:** Model `{model}` not found. Use `/model list` to see available models."
                 else:
-                    success = set_current_model(interaction.channel_id, model)
+                    success = await set_current_model(interaction.channel_id, model)
                     if success:
+                        context.residency.set_channel_model(interaction.channel_id, model)
+                        # Load it now so the first answer doesn't pay the cold start
+                        asyncio.create_task(context.residency.preload(model))
                         msg = f"✅ **Model set to:** {model}"
                     else:
                         msg = "**Error:** Could not save model. Redis may not be available."
+        ## slash command to pull new models / delete models - (Superadmin only)
+        elif action in ("pull", "delete"):
+            if not is_superadmin(interaction.user.id):
+                msg = "Not authorized."
+            elif not model:
+                msg = f"**Error:** You must provide a model name to {action}."
+            else:
+                # Pulling can take minutes, answer later
+                await interaction.response.defer(ephemeral=True, thinking=True)
+                try:
+                    if action == "pull":
+                        failed = await context.llama.pull(model)
+                    else:
+                        failed = await context.llama.delete(model)
+                except Exception as e:
+                    logging.error(f"Error running model {action}", exc_info=True)
+                    failed = [str(e)]
+                context.model_catalog.invalidate()
+                if failed:
+                    msg = f"⚠️ Model `{model}` {action} failed on: {', '.join(failed)}"
+                else:
+                    msg = f"✅ Model `{model}` {'pulled' if action == 'pull' else 'deleted'}."
+                    logging.info(f"Model {model} {action} by {interaction.user.name} ({interaction.user.id})")
+                return await interaction.followup.send(msg, ephemeral=True)
         elif action == "help":
                 msg = (
                     "ℹ️ **Model Command Help**\n"
                     "Use this command to manage the Ollama models.\n\n"
-                    "**Usage:** `/model action:<current|list|set|help> model:<model_name>`\n"
+                    "**Usage:** `/model action:<current|list|set|pull|delete|help> model:<model_name>`\n"
                     "- `current` → Shows the current model in use.\n"
                     "- `list` → Lists all available models.\n"
                     "- `set` → Sets the current model. Must provide a model name.\n"
+                    "- `pull` → Downloads a model on all hosts (Superadmin only).\n"
+                    "- `delete` → Deletes a model from all hosts (Superadmin only).\n"
                     "- `help` → Displays this help message."
                 )
         else:
@@ -458,11 +1024,12 @@ class bentebot:
  
  
  
-    async def slash_logs(self, interaction: discord.Interaction, action: str, lines:int=50):
+    async def slash_logs(self, interaction: discord.Interaction, action: str, lines:int=50, level:str=None, contains:str=None, archive:str=None):
         """
         Slash command handler for log management.
-        - 'read': shows recent lines from bot.log
-        - 'download': sends the file as an attachment
+        - 'read': shows the last matching lines of the current log
+        - 'download': sends the current log or an archive, filtered if level/contains are given
+        - 'archives': lists the rotated archives
         """
         admin_check = is_superadmin(interaction.user.id)
         if not admin_check:
@@ -471,18 +1038,23 @@ class bentebot:
                 ephemeral=True
             )
         action = action.lower()
-        log_path = 'bot.log'
+        log_path = context.log_path
+        min_level = None
+        if level:
+            min_level = logging.getLevelName(level.upper())
+            if not isinstance(min_level, int):
+                return await interaction.response.send_message(f"⚠️ Unknown level `{level}`. Use DEBUG, INFO, WARNING, ERROR or CRITICAL.", ephemeral=True)
+        await interaction.response.defer(ephemeral=True, thinking=True)
         if not os.path.exists(log_path):
             return await interaction.followup.send("No log file found.", ephemeral=True)
         
         if action == "read":
             try:
-                # Read last 50 lines for brevity
-                with open(log_path, "r", encoding="utf-8") as f:
-                    lines_read = f.readlines()[-lines:]
-                content = "".join(lines_read).strip()
+                # Reads backwards from the end of the file, off the event loop
+                records = await asyncio.to_thread(tail_records, log_path, max(min(lines, 500), 1), min_level, contains)
+                content = "\n".join(records).strip()
                 if not content:
-                    content = "(Log file is empty.)"
+                    content = "(No matching log lines.)" if (min_level or contains) else "(Log file is empty.)"
 
                 # Discord messages have a 2000 char limit
                 if len(content) > 1900:
@@ -497,7 +1069,20 @@ class bentebot:
             except Exception as e:
                 logging.error("Error reading logs", exc_info=True)
                 return await interaction.followup.send(f"Error reading log file: {e}", ephemeral=True)
+        elif action == "archives":
+            archives = await asyncio.to_thread(list_archives, log_path)
+            if not archives:
+                return await interaction.followup.send("No log archives yet.", ephemeral=True)
+            directory = os.path.dirname(os.path.abspath(log_path))
+            formatted = "\n".join(f"{name} ({os.path.getsize(os.path.join(directory, name)) / 1024:.0f} KB)" for name in archives)
+            return await interaction.followup.send(f"🗄️ **Log archives** (newest first):\n```\n{formatted}\n```", ephemeral=True)
         elif action == "download":
+            source = log_path
+            if archive:
+                # Only names from the archive listing, never arbitrary paths
+                if archive not in await asyncio.to_thread(list_archives, log_path):
+                    return await interaction.followup.send(f"⚠️ Unknown archive `{archive}`. Use `/logs action:archives`.", ephemeral=True)
+                source = os.path.join(os.path.dirname(os.path.abspath(log_path)), archive)
             # Try to open DM channel
             try:
                 dm = await interaction.user.create_dm()
@@ -507,19 +1092,29 @@ class bentebot:
                     "❌ Could not open DM channel — please allow DMs from server members.",
                     ephemeral=True
             )
+            filtered = None
             try:
-                await dm.send(
-                    "📦 Here is your logfile:",
-                    file=discord.File(log_path)
-                )
+                if min_level or contains:
+                    # Filter record by record into a temporary file instead of loading the log
+                    filtered = f"{log_path}.filtered.{interaction.id}.txt"
+                    kept = await asyncio.to_thread(filter_to_file, source, filtered, min_level, contains)
+                    file = discord.File(filtered, filename=f"{os.path.basename(source)}.filtered.txt")
+                    note = f"📦 Here is your logfile ({kept} matching records):"
+                else:
+                    file = discord.File(source)
+                    note = "📦 Here is your logfile:"
+                await dm.send(note, file=file)
                 return await interaction.followup.send(f"Logs sent to your DMs", ephemeral=True)
             except Exception as e:
                 logging.error("Error sending log file", exc_info=True)
                 return await interaction.followup.send(f"Error sending log file: {e}", ephemeral=True)
+            finally:
+                if filtered and os.path.exists(filtered):
+                    os.remove(filtered)
         elif action == "clear":
             try:
                 # Truncate (clear contents) but keep the file existing
-                open(log_path, "w").close()
+                await asyncio.to_thread(truncate_log, log_path)
                 logging.info(f"Logs cleared by {interaction.user} ({interaction.user.id})")
                 return await interaction.followup.send(f"🧹 **logs** has been cleared successfully.", ephemeral=True)
             except Exception as e:
@@ -529,10 +1124,12 @@ class bentebot:
                 msg = (
                     "ℹ️ **Logs Command Help**\n"
                     "Use this command to read/download/clear logs.\n\n"
-                    "**Usage:** `/logs action:<read|download|clear>`\n"
-                    "- `read` → Read the last n amount of lines in logfile.\n"
-                    "- `download` → Sends downloadable logfile to DM.\n"
+                    "**Usage:** `/logs action:<read|download|archives|clear> lines:<n> level:<level> contains:<text> archive:<name>`\n"
+                    "- `read` → Read the last n matching lines in the logfile.\n"
+                    "- `download` → Sends the logfile, or `archive`, to DM.\n"
+                    "- `archives` → Lists the rotated, compressed logfiles.\n"
                     "- `clear` → Clears the logfile.\n"
+                    "- `level` / `contains` → Only records at or above a level / containing a text.\n"
                     "- `help` → Displays this help message."
                 )
                 return await interaction.followup.send(msg, ephemeral=True)
@@ -541,6 +1138,12 @@ class bentebot:
             return await interaction.followup.send(msg, ephemeral=True)
         
         
+    async def archive_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        if not is_superadmin(interaction.user.id):
+            return []
+        archives = await asyncio.to_thread(list_archives, context.log_path)
+        return [app_commands.Choice(name=name, value=name) for name in archives if (current or "") in name][:25]
+        
         
  
     async def slash_hello(self, interaction: discord.Interaction):
@@ -560,14 +1163,14 @@ class bentebot:
         
         channel_id = interaction.channel.id
         if message_id.isdigit():
-            stored_msg = get_message(channel_id, message_id)
+            stored_msg = await get_message(channel_id, message_id)
             if stored_msg is not None:
                 await interaction.response.send_message(f"Message ID {message_id} content: {stored_msg['content']}", ephemeral=True)
             else:
                 await interaction.response.send_message(f"Message ID {message_id} not found.", ephemeral=True)
         else:
             # Then check if its an "?", if so, we want to respond with a comma seperated list of message_ids stored in redis.
-            message_ids = get_all_message_ids(channel_id)
+            message_ids = await get_all_message_ids(channel_id)
             if message_ids:
                 await interaction.response.send_message(
                     ", ".join(message_ids), ephemeral=True
@@ -0,0 +1,147 @@
+## Publishes Response buffers to discord independently of token streaming.
+## Writers only append to their Response and notify us; one loop decides when each Response gets
+## to send/edit, sharing a global and a per-channel edit budget (token buckets) so that many
+## concurrent answers don't trip discord's 429s. Whatever text is pending at publish time is sent,
+## so bursts of tokens collapse into a single edit. A Response's first message skips the budget
+## check so the first tokens show up as fast as possible.
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+import context
+
+MAX_PUBLISH_FAILURES = 3
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate: float = rate
+        self.burst: float = burst
+        self.tokens: float = burst
+        self.updated: float = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until one token is available (0 if available now)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        # May go negative for urgent sends, which simply delays the next edits
+        self._refill(now)
+        self.tokens -= 1
+
+
+class EditScheduler:
+    def __init__(self, global_rate: float = 10.0, global_burst: float = 10.0, channel_rate: float = 1.0, channel_burst: float = 5.0):
+        self.global_bucket: TokenBucket = TokenBucket(global_rate, global_burst)
+        self.channel_rate: float = channel_rate
+        self.channel_burst: float = channel_burst
+        self.channel_buckets: Dict[int, TokenBucket] = {}
+
+        self.pending: "OrderedDict[int, object]" = OrderedDict() # id(response) -> Response
+        self.wakeup: asyncio.Event = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+        self.latencies: Deque[tuple] = deque(maxlen=2000) # (time, seconds)
+        self.published: int = 0
+        self.skipped: int = 0
+        self.coalesced: int = 0
+
+    def notify(self, response) -> None:
+        key = id(response)
+        if key in self.pending:
+            self.coalesced += 1
+        else:
+            self.pending[key] = response
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def bucket(self, channel_id: int) -> TokenBucket:
+        b = self.channel_buckets.get(channel_id)
+        if b is None:
+            b = self.channel_buckets[channel_id] = TokenBucket(self.channel_rate, self.channel_burst)
+        return b
+
+    async def run(self) -> None:
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                self._prune_buckets()
+                await self.wakeup.wait()
+                continue
+
+            self.wakeup.clear()
+            now = time.monotonic()
+            next_wait = None
+            for key, response in list(self.pending.items()):
+                if response.publishing:
+                    continue # picked up again when the running publish finishes
+                channel_bucket = self.bucket(response.channel_id)
+                wait = 0.0 if response.urgent else max(self.global_bucket.wait_time(now), channel_bucket.wait_time(now))
+                if wait > 0:
+                    next_wait = wait if next_wait is None else min(next_wait, wait)
+                    continue
+                self.global_bucket.take(now)
+                channel_bucket.take(now)
+                del self.pending[key]
+                response.publishing = True
+                asyncio.create_task(self._publish(response))
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=next_wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _publish(self, response) -> None:
+        started = time.monotonic()
+        try:
+            sent = await response.publish()
+            if sent:
+                self.published += 1
+                latency = time.monotonic() - started
+                self.latencies.append((time.time(), latency))
+                if context.metrics:
+                    guild = response.message.guild
+                    context.metrics.discord_edit.observe(latency, guild=str(guild.id) if guild else "dm")
+            else:
+                self.skipped += 1
+        except Exception:
+            logging.error("Error publishing response", exc_info=True)
+            # Retry a couple of times (after the usual budget wait), then give up on this state
+            response.failures += 1
+            if response.failures < MAX_PUBLISH_FAILURES:
+                response.dirty = True
+        finally:
+            response.publishing = False
+            if response.dirty:
+                self.notify(response)
+            else:
+                response.idle.set()
+            self.wakeup.set()
+
+    def _prune_buckets(self) -> None:
+        # Idle channels have full buckets again, no need to keep them around
+        now = time.monotonic()
+        for channel_id, b in list(self.channel_buckets.items()):
+            if b.wait_time(now) == 0 and b.tokens >= b.burst:
+                del self.channel_buckets[channel_id]
+
+    def stats(self, window: float = 3600) -> Dict[str, float]:
+        cutoff = time.time() - window
+        latencies = sorted(l for t, l in self.latencies if t >= cutoff)
+        return {
+            "pending": len(self.pending),
+            "published": self.published,
+            "skipped": self.skipped,
+            "coalesced": self.coalesced,
+            "edit_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+            "edit_max": latencies[-1] if latencies else 0.0,
+        }
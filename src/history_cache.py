@@ -0,0 +1,139 @@
+## In-process write-through cache of formatted prompt entries per channel.
+## save_message_redis appends to it and delete_messages invalidates it, so replying in an
+## active channel needs no redis read and no json parsing at all.
+import sys
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+ENTRY_OVERHEAD_BYTES = 120 # dict + ints, rough
+
+
+def entry_size(
+    entry: dict
+) -> int:
+    return sys.getsizeof(entry["content"]) + ENTRY_OVERHEAD_BYTES
+
+
+class ChannelHistory:
+    def __init__(self, entries: List[dict]):
+        # entries are kept sorted by message id (= chronological)
+        self.entries: List[dict] = sorted(entries, key=lambda e: int(e["id"]))
+        self.ids: List[int] = [int(e["id"]) for e in self.entries]
+        self.size: int = sum(entry_size(e) for e in self.entries)
+
+
+class HistoryCache:
+    def __init__(self, max_channels: int = 256, max_bytes: int = 64 * 1024 * 1024, window: int = 100):
+        self.max_channels: int = max_channels
+        self.max_bytes: int = max_bytes
+        self.window: int = window
+
+        self.channels: "OrderedDict[int, ChannelHistory]" = OrderedDict()
+        # channel_id -> [loads in flight, written during load]. A write that lands while the window
+        # is being read from redis would be missing from it, so such a load must not be cached.
+        self.loading: Dict[int, list] = {}
+        self.total_bytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    def get(self, channel_id: int) -> Optional[List[dict]]:
+        channel_id = int(channel_id)
+        history = self.channels.get(channel_id)
+        if history is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.channels.move_to_end(channel_id)
+        return list(history.entries)
+
+    def begin_load(self, channel_id: int) -> None:
+        state = self.loading.setdefault(int(channel_id), [0, False])
+        state[0] += 1
+
+    def end_load(self, channel_id: int, entries: Optional[List[dict]]) -> None:
+        """Finish a begin_load; caches `entries` unless the channel was written to meanwhile."""
+        channel_id = int(channel_id)
+        state = self.loading.get(channel_id)
+        dirty = False
+        if state is not None:
+            state[0] -= 1
+            dirty = state[1]
+            if state[0] <= 0:
+                del self.loading[channel_id]
+        if entries is not None and not dirty:
+            self.put(channel_id, entries)
+
+    def put(self, channel_id: int, entries: List[dict]) -> None:
+        """Cache the full recent window of a channel (as read from redis)."""
+        channel_id = int(channel_id)
+        old = self.channels.pop(channel_id, None)
+        if old is not None:
+            self.total_bytes -= old.size
+        history = ChannelHistory(entries[-self.window:] if self.window > 0 else entries)
+        self.channels[channel_id] = history
+        self.total_bytes += history.size
+        self._evict()
+
+    def append(self, channel_id: int, entry: dict) -> None:
+        """Write-through of a newly saved message. Ignored if the channel isn't cached."""
+        channel_id = int(channel_id)
+        history = self.channels.get(channel_id)
+        if history is None:
+            if channel_id in self.loading:
+                self.loading[channel_id][1] = True
+            return
+
+        # Replies are saved once they finish streaming, after newer user messages, so insert by id
+        message_id = int(entry["id"])
+        pos = bisect_right(history.ids, message_id)
+        if pos > 0 and history.ids[pos - 1] == message_id:
+            old = history.entries[pos - 1]
+            history.entries[pos - 1] = entry
+            delta = entry_size(entry) - entry_size(old)
+        else:
+            history.entries.insert(pos, entry)
+            history.ids.insert(pos, message_id)
+            delta = entry_size(entry)
+        history.size += delta
+        self.total_bytes += delta
+
+        while self.window > 0 and len(history.entries) > self.window:
+            old = history.entries.pop(0)
+            history.ids.pop(0)
+            history.size -= entry_size(old)
+            self.total_bytes -= entry_size(old)
+
+        self.channels.move_to_end(channel_id)
+        self._evict()
+
+    def invalidate(self, channel_id: int) -> None:
+        channel_id = int(channel_id)
+        if channel_id in self.loading:
+            self.loading[channel_id][1] = True
+        history = self.channels.pop(channel_id, None)
+        if history is not None:
+            self.total_bytes -= history.size
+
+    def clear(self) -> None:
+        self.channels.clear()
+        self.total_bytes = 0
+
+    def _evict(self) -> None:
+        # Least recently used channels go first; always keep the most recent one
+        while len(self.channels) > 1 and (len(self.channels) > self.max_channels or self.total_bytes > self.max_bytes):
+            _, history = self.channels.popitem(last=False)
+            self.total_bytes -= history.size
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "channels": len(self.channels),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
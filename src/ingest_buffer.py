@@ -0,0 +1,140 @@
+## Write-behind buffer for passively ingested channel messages.
+## Messages in trusted channels are saved for context even when they don't mention the bot. Instead of one
+## redis round-trip per chat line, they are collected here and written in pipelined batches once
+## `max_batch` messages are waiting or the oldest has waited `max_delay` seconds. Anything that reads a
+## channel's history for a prompt calls `flush(channel_id)` first, so a prompt never misses a message.
+## A batch whose write fails is queued again once, then dropped; `close()` writes what is left on shutdown.
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import context
+from src.redis_conn import save_message_records
+
+
+class IngestBuffer:
+    def __init__(
+        self,
+        max_batch: int = 100,
+        max_delay: float = 0.25
+    ):
+        self.max_batch: int = max_batch
+        self.max_delay: float = max_delay
+        self.pending: "OrderedDict[int, List[Tuple[float, dict, int]]]" = OrderedDict() # channel_id -> [(queued at, record, attempts)]
+        self.size: int = 0
+        self.lock: asyncio.Lock = asyncio.Lock() # one write at a time keeps each channel's messages in order
+        self.wakeup: asyncio.Event = asyncio.Event()
+        self.loop_task: Optional[asyncio.Task] = None
+        self.tasks: set = set()
+        self.batches: int = 0
+        self.records: int = 0
+        self.forced: int = 0
+        self.retried: int = 0
+        self.errors: int = 0
+
+    def start(self) -> None:
+        if self.loop_task is None:
+            self.loop_task = asyncio.create_task(self.run())
+
+    def add(self, channel_id: int, record: dict) -> None:
+        self.pending.setdefault(int(channel_id), []).append((time.monotonic(), record, 0))
+        self.size += 1
+        if self.loop_task is None:
+            # Not started, write through
+            task = asyncio.create_task(self.flush())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        elif self.size >= self.max_batch:
+            self.wakeup.set()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if self.size:
+                # Shielded: stopping the loop on shutdown must not abandon a write half way
+                await asyncio.shield(self.flush())
+
+    def _take(self, channel_id: Optional[int]) -> List[Tuple[int, float, dict, int]]:
+        if channel_id is None:
+            channels = list(self.pending.items())
+            self.pending.clear()
+        else:
+            records = self.pending.pop(int(channel_id), None)
+            channels = [(int(channel_id), records)] if records else []
+        batch = [(cid, *entry) for cid, records in channels for entry in records]
+        self.size -= len(batch)
+        return batch
+
+    async def flush(self, channel_id: Optional[int] = None) -> int:
+        """Write what is waiting (only `channel_id`'s if given) and wait for any write already in flight."""
+        async with self.lock:
+            batch = self._take(channel_id)
+            if not batch:
+                return 0
+            if channel_id is not None:
+                self.forced += 1
+            retry = []
+            for start in range(0, len(batch), self.max_batch):
+                chunk = batch[start:start + self.max_batch]
+                started = time.monotonic()
+                try:
+                    await save_message_records([(cid, record) for cid, _, record, _ in chunk])
+                except Exception:
+                    again = [entry for entry in chunk if entry[3] == 0]
+                    retry.extend(again)
+                    self.retried += len(again)
+                    self.errors += len(chunk) - len(again)
+                    logging.error(
+                        "Error writing %s buffered messages, %s queued again",
+                        len(chunk), len(again), exc_info=True
+                    )
+                    continue
+                self.batches += 1
+                self.records += len(chunk)
+                if context.metrics:
+                    done = time.monotonic()
+                    context.metrics.ingest_batch.observe(len(chunk))
+                    context.metrics.ingest_write.observe(done - started)
+                    for _, queued, _, _ in chunk:
+                        context.metrics.ingest_delay.observe(done - queued)
+            self._requeue(retry)
+            return len(batch)
+
+    def _requeue(self, entries: List[Tuple[int, float, dict, int]]) -> None:
+        """Put entries back in front of their channel's newer messages, counting the failed attempt."""
+        channels: "OrderedDict[int, list]" = OrderedDict()
+        for cid, queued, record, attempts in entries:
+            channels.setdefault(cid, []).append((queued, record, attempts + 1))
+        for cid, records in channels.items():
+            self.pending[cid] = records + self.pending.get(cid, [])
+            self.size += len(records)
+
+    async def close(self) -> None:
+        """Stop the background loop and write everything still waiting, retrying a failed batch once."""
+        if self.loop_task is not None:
+            self.loop_task.cancel()
+            self.loop_task = None
+        await self.flush()
+        if self.size:
+            # What failed above was queued again once
+            await self.flush()
+
+    def discard(self, channel_id: int) -> None:
+        """Drop a channel's unwritten messages (the channel is being wiped)."""
+        self.size -= len(self.pending.pop(int(channel_id), []))
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "pending": self.size,
+            "batches": self.batches,
+            "records": self.records,
+            "avg_batch": self.records / self.batches if self.batches else 0.0,
+            "forced": self.forced,
+            "retried": self.retried,
+            "errors": self.errors,
+        }
@@ -0,0 +1,69 @@
+## Which passively seen messages get stored.
+## Rules are ids in the `ingest:*` redis sets, mirrored in memory by the Authorizer, so a check is a few set
+## lookups and a skipped message costs no I/O. An id can be a guild, category, channel or thread parent:
+##  ingest:ignore / ingest:allow    -> the most specific scope with a rule wins (channel > parent > category > guild)
+##  ingest:ignore_bots / _webhooks  -> skip messages from bots / webhooks anywhere under the scope
+## Messages that mention the bot are always stored, otherwise it couldn't answer them.
+from collections import Counter
+from typing import Dict, Optional, Tuple
+import discord
+import context
+from src.authz import INGEST_RULE_KEYS
+
+
+def message_scopes(
+    message: discord.Message
+) -> Tuple[int, ...]:
+    """Ids a message falls under, most specific first."""
+    channel = message.channel
+    scopes = [channel.id]
+    parent_id = getattr(channel, "parent_id", None) # threads
+    if parent_id:
+        scopes.append(parent_id)
+    category_id = getattr(channel, "category_id", None)
+    if category_id:
+        scopes.append(category_id)
+    if message.guild is not None:
+        scopes.append(message.guild.id)
+    return tuple(scopes)
+
+
+class IngestFilter:
+    def __init__(self):
+        self.counts: Counter = Counter() # stored / ignored / bot / webhook
+
+    def _rules(self, key: str):
+        return context.authz.sets.get(key, ())
+
+    def skip_reason(self, message: discord.Message) -> Optional[str]:
+        """None if the message should be stored, otherwise why it is skipped."""
+        scopes = message_scopes(message)
+        ignore, allow = self._rules("ingest:ignore"), self._rules("ingest:allow")
+        for scope in scopes:
+            if scope in allow:
+                break
+            if scope in ignore:
+                return "ignored"
+        if message.webhook_id is not None:
+            if any(scope in self._rules("ingest:ignore_webhooks") for scope in scopes):
+                return "webhook"
+        elif message.author.bot:
+            if any(scope in self._rules("ingest:ignore_bots") for scope in scopes):
+                return "bot"
+        return None
+
+    def should_store(self, message: discord.Message) -> bool:
+        reason = self.skip_reason(message)
+        result = reason or "stored"
+        self.counts[result] += 1
+        if context.metrics:
+            context.metrics.ingest_messages.inc(result=result)
+        return reason is None
+
+    def rules_for(self, scope_id: int) -> Dict[str, bool]:
+        return {key.split(":", 1)[1]: scope_id in self._rules(key) for key in INGEST_RULE_KEYS}
+
+    def stats(self) -> Dict[str, int]:
+        stored = self.counts["stored"]
+        skipped = sum(v for k, v in self.counts.items() if k != "stored")
+        return {"stored": stored, "skipped": skipped, **{k: v for k, v in self.counts.items() if k != "stored"}}
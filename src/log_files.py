@@ -0,0 +1,293 @@
+## Log file handling.
+## Logging calls only put the record on a queue; a QueueListener thread does the formatting and file I/O,
+## so nothing on the asyncio thread waits on the disk. Records can be written as JSON lines carrying the
+## guild/channel/message/model IDs passed in `extra`, and records with a `rate_key` are rate limited.
+## bot.log rolls over by size or age into gzip archives (bot.log.1.gz newest, up to `backups`), and the
+## /logs helpers read it without loading whole files: tails are read backwards from the end in blocks, and
+## filters are applied record by record while streaming. These are blocking file operations, so callers
+## run them through asyncio.to_thread.
+import os
+import re
+import copy
+import gzip
+import json
+import time
+import queue
+import atexit
+import shutil
+import logging
+import datetime
+import logging.handlers
+from collections import OrderedDict
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+# A record starts with the asctime of LOG_FORMAT (or is a JSON line); other lines (tracebacks) continue the previous record.
+# Logs written before the level was added are just '<asctime> <message>', so the level is only taken if it is a level name.
+LEVEL_NAMES = "CRITICAL|ERROR|WARNING|INFO|DEBUG"
+RECORD_START = re.compile(
+    rf'^(?:\d{{4}}-\d{{2}}-\d{{2}} \d{{2}}:\d{{2}}:\d{{2}},\d{{3}} (?:({LEVEL_NAMES}) )?|\{{"time": "[^"]*", "level": "(\w+)")'
+)
+BLOCK_SIZE = 8192
+# `extra` keys copied into JSON records
+CONTEXT_FIELDS = ("guild_id", "channel_id", "message_id", "user_id", "model", "backend")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets one record per `rate_key` through every `interval` seconds and counts the rest."""
+    MAX_KEYS = 4096
+
+    def __init__(self, interval: float = 60):
+        super().__init__()
+        self.interval: float = interval
+        self.windows: "OrderedDict[str, Tuple[float, int]]" = OrderedDict() # key -> (window start, suppressed)
+        self.suppressed: int = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "rate_key", None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        started, suppressed = self.windows.get(key, (None, 0))
+        if started is not None and now - started < self.interval:
+            self.windows[key] = (started, suppressed + 1)
+            self.suppressed += 1
+            return False
+        if suppressed:
+            # An attribute, not an edited msg: other handlers see the record as it was logged
+            record.suppressed_similar = suppressed
+        self.windows[key] = (now, 0)
+        self.windows.move_to_end(key)
+        while len(self.windows) > self.MAX_KEYS:
+            self.windows.popitem(last=False)
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Merges the args and renders the traceback on the calling thread (they reference live objects), but leaves
+    the formatting to the listener's handler so JSON records keep their fields."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        suppressed = getattr(record, "suppressed_similar", 0)
+        if suppressed:
+            record.msg = f"{record.msg} (+{suppressed} similar suppressed)"
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_exception_formatter = logging.Formatter()
+
+
+def log_ids(
+    message=None,
+    **fields
+) -> Dict[str, object]:
+    """`extra` for logging calls about a discord message: its guild, channel, message and author IDs."""
+    extra = {}
+    if message is not None:
+        extra["guild_id"] = message.guild.id if message.guild else None
+        extra["channel_id"] = message.channel.id
+        extra["message_id"] = message.id
+        extra["user_id"] = message.author.id
+    extra.update(fields)
+    return extra
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotates when the file exceeds `max_bytes` or `max_age` seconds after start or the last rotation; rotated files are gzipped."""
+
+    def __init__(self, filename: str, max_bytes: int, backups: int, max_age: float = 0, encoding: str = "utf-8"):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding=encoding)
+        self.max_age: float = max_age
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._compress
+        # Counted from when the handler started, not the file's mtime, which a touch or copy would move
+        self.rollover_at: float = time.time() + max_age if max_age else float("inf")
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if time.time() >= self.rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self.rollover_at = time.time() + self.max_age if self.max_age else float("inf")
+
+    @staticmethod
+    def _compress(source: str, dest: str) -> None:
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+
+def setup_logging(
+    path: str = "bot.log",
+    level: str = "INFO",
+    max_bytes: int = 10 * 1024 * 1024,
+    backups: int = 5,
+    max_age: float = 0,
+    json_records: bool = False,
+    rate_limit_interval: float = 60
+) -> None:
+    global _listener
+    # Leave an already configured root logger alone (bench/ logs elsewhere)
+    if logging.getLogger().handlers:
+        return
+    handler = CompressingRotatingFileHandler(path, max_bytes, backups, max_age)
+    handler.setFormatter(JsonFormatter() if json_records else logging.Formatter(LOG_FORMAT))
+
+    # Unbounded queue: a full queue would block the caller, which is what this avoids
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rate_limit_interval))
+    logging.basicConfig(level=level, handlers=[queue_handler])
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging) # registered after logging's own atexit hook, so it runs first
+
+
+def truncate_log(path: str) -> None:
+    """Clear the log but keep the file, the handler keeps appending to it. Blocking, call through asyncio.to_thread."""
+    open(path, "w").close()
+
+
+def stop_logging() -> None:
+    """Write out everything still queued and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        listener.stop()
+        for handler in listener.handlers:
+            handler.flush()
+
+
+def list_archives(
+    path: str
+) -> List[str]:
+    """Archive file names of `path`, newest first."""
+    directory, base = os.path.split(os.path.abspath(path))
+    pattern = re.compile(re.escape(base) + r"\.(\d+)\.gz$")
+    found = []
+    for name in os.listdir(directory or "."):
+        match = pattern.match(name)
+        if match:
+            found.append((int(match.group(1)), name))
+    return [name for _, name in sorted(found)]
+
+
+def record_matches(
+    record: str,
+    level: Optional[int] = None,
+    contains: Optional[str] = None
+) -> bool:
+    if contains and contains.lower() not in record.lower():
+        return False
+    if level:
+        match = RECORD_START.match(record)
+        name = match.group(1) or match.group(2) if match else None
+        # Records without a level (older logs) can't be ranked, so they aren't filtered out
+        record_level = logging.getLevelName(name) if name else None
+        if isinstance(record_level, int) and record_level < level:
+            return False
+    return True
+
+
+def _reverse_lines(f: IO[bytes]) -> Iterator[str]:
+    """Lines of a file from the last to the first, reading fixed size blocks backwards."""
+    f.seek(0, os.SEEK_END)
+    position = f.tell()
+    tail = b""
+    while position > 0:
+        step = min(BLOCK_SIZE, position)
+        position -= step
+        f.seek(position)
+        block = f.read(step) + tail
+        lines = block.split(b"\n")
+        tail = lines.pop(0) # may be cut, completed by the next block
+        for line in reversed(lines):
+            yield line.decode("utf-8", errors="replace")
+    if tail:
+        yield tail.decode("utf-8", errors="replace")
+
+
+def tail_records(
+    path: str,
+    count: int,
+    level: Optional[int] = None,
+    contains: Optional[str] = None
+) -> List[str]:
+    """The last `count` log records (multi-line records kept whole) that match the filter, oldest first."""
+    if count <= 0 or not os.path.exists(path):
+        return []
+    records: List[str] = []
+    pending: List[str] = []
+    with open(path, "rb") as f:
+        for line in _reverse_lines(f):
+            if not line and not pending:
+                continue # trailing newline
+            pending.append(line)
+            if RECORD_START.match(line):
+                record = "\n".join(reversed(pending))
+                pending = []
+                if record_matches(record, level, contains):
+                    records.append(record)
+                    if len(records) >= count:
+                        break
+    return list(reversed(records))
+
+
+def iter_records(
+    f: IO[str]
+) -> Iterator[str]:
+    record: List[str] = []
+    for line in f:
+        if RECORD_START.match(line) and record:
+            yield "".join(record)
+            record = []
+        record.append(line)
+    if record:
+        yield "".join(record)
+
+
+def filter_to_file(
+    source: str,
+    dest: str,
+    level: Optional[int] = None,
+    contains: Optional[str] = None
+) -> int:
+    """Stream `source` (plain or .gz) into `dest`, keeping matching records. Returns the number kept."""
+    opener = gzip.open if source.endswith(".gz") else open
+    kept = 0
+    with opener(source, "rt", encoding="utf-8", errors="replace") as src, open(dest, "w", encoding="utf-8") as dst:
+        for record in iter_records(src):
+            if record_matches(record, level, contains):
+                dst.write(record)
+                kept += 1
+    return kept
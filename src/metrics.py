@@ -0,0 +1,186 @@
+## In-process metrics.
+## Histograms use fixed cumulative buckets per label set, which is what the Prometheus text format wants,
+## and also keep a bounded deque of recent samples so `/stats` can report percentiles for the last hour.
+## The optional endpoint (METRICS_PORT) is a tiny asyncio HTTP server serving GET /metrics.
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def percentile(values: List[float], p: float) -> float:
+    """`values` must be sorted."""
+    return values[min(int(p * len(values)), len(values) - 1)] if values else 0.0
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...], max_recent: int = 20000):
+        self.name: str = name
+        self.help: str = help
+        self.buckets: Tuple[float, ...] = buckets
+        self.series: Dict[Labels, list] = {} # labels -> [bucket counts..., +Inf count, sum]
+        self.recent: Deque[Tuple[float, Labels, float]] = deque(maxlen=max_recent)
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+        self.recent.append((time.time(), key, value))
+
+    def window(self, seconds: float, **match) -> List[float]:
+        """Sorted samples of the last `seconds` whose labels include `match`."""
+        cutoff = time.time() - seconds
+        wanted = set(_labels(match))
+        return sorted(v for t, key, v in self.recent if t >= cutoff and wanted <= set(key))
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', repr(float(bound))))} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name: str = name
+        self.help: str = help
+        self.values: Dict[Labels, float] = defaultdict(float)
+
+    def inc(self, value: float = 1, **labels) -> None:
+        self.values[_labels(labels)] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_format_labels(key)} {value}" for key, value in self.values.items())
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self.ttft = Histogram("bentebot_ttft_seconds", "Time from dispatch to the first streamed token", LATENCY_BUCKETS)
+        self.tokens_per_second = Histogram("bentebot_tokens_per_second", "Generation speed, eval_count / eval_duration", (1, 2, 5, 10, 20, 30, 50, 80, 120, 200))
+        self.prompt_tokens = Histogram("bentebot_prompt_tokens", "Estimated prompt size sent to ollama", (256, 512, 1024, 2048, 4096, 8192, 16384, 32768))
+        self.dropped_tokens = Histogram("bentebot_prompt_dropped_tokens", "Estimated history tokens left out of a prompt to fit the budget", (64, 256, 1024, 4096, 16384, 65536, 262144))
+        self.load = Histogram("bentebot_model_load_seconds", "Model load time reported by ollama (load_duration)", LATENCY_BUCKETS)
+        self.generation = Histogram("bentebot_generation_seconds", "Total generation time reported by ollama (total_duration)", LATENCY_BUCKETS + (120, 300))
+        self.queue_wait = Histogram("bentebot_queue_wait_seconds", "Time a job waited for a generation slot", LATENCY_BUCKETS + (120, 300))
+        self.discord_edit = Histogram("bentebot_discord_edit_seconds", "Latency of a discord send/edit call", LATENCY_BUCKETS)
+        self.redis = Histogram("bentebot_redis_seconds", "Latency of a redis command", LATENCY_BUCKETS)
+        self.ingest_batch = Histogram("bentebot_ingest_batch_size", "Messages per buffered ingest write", (1, 2, 5, 10, 20, 50, 100, 200, 500))
+        self.ingest_write = Histogram("bentebot_ingest_write_seconds", "Duration of a pipelined ingest write", LATENCY_BUCKETS)
+        self.ingest_delay = Histogram("bentebot_ingest_delay_seconds", "Time a message waited in the ingest buffer before it was written", LATENCY_BUCKETS)
+        self.generations = Counter("bentebot_generations_total", "Finished generations")
+        self.eval_tokens = Counter("bentebot_eval_tokens_total", "Generated tokens (eval_count)")
+        self.prompt_eval_tokens = Counter("bentebot_prompt_eval_tokens_total", "Prompt tokens ollama had to evaluate (prompt_eval_count)")
+        self.ingest_messages = Counter("bentebot_ingest_messages_total", "Channel messages stored or skipped by the ingest rules")
+        self.model_loads = Counter("bentebot_model_loads_total", "Models seen loaded on a host between probes")
+        self.model_unloads = Counter("bentebot_model_unloads_total", "Models seen unloaded from a host between probes")
+        self.cold_starts = Counter("bentebot_cold_starts_total", "Replies that had to wait for the model to load")
+        self.histograms = [self.ttft, self.tokens_per_second, self.prompt_tokens, self.dropped_tokens, self.load, self.generation,
+                           self.queue_wait, self.discord_edit, self.redis, self.ingest_batch, self.ingest_write, self.ingest_delay]
+        self.counters = [self.generations, self.eval_tokens, self.prompt_eval_tokens, self.ingest_messages,
+                         self.model_loads, self.model_unloads, self.cold_starts]
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def record_done(self, part, model: str, host: Optional[str], guild: str, prompt_tokens: int) -> None:
+        """Timing fields of ollama's final `done` part. Durations are in nanoseconds."""
+        labels = {"model": model, "host": host, "guild": guild}
+        eval_count = part.get('eval_count') or 0
+        eval_duration = part.get('eval_duration') or 0
+        self.generations.inc(**labels)
+        self.eval_tokens.inc(eval_count, **labels)
+        self.prompt_eval_tokens.inc(part.get('prompt_eval_count') or 0, **labels)
+        self.prompt_tokens.observe(prompt_tokens, **labels)
+        if eval_count and eval_duration:
+            self.tokens_per_second.observe(eval_count / (eval_duration / 1e9), **labels)
+        if part.get('load_duration'):
+            self.load.observe(part['load_duration'] / 1e9, model=model, host=host)
+        if part.get('total_duration'):
+            self.generation.observe(part['total_duration'] / 1e9, **labels)
+
+    def observe_redis(self, command: str, seconds: float) -> None:
+        self.redis.observe(seconds, command=command.upper())
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.histograms + self.counters:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self, window: float = 3600) -> Dict[str, Dict[str, float]]:
+        """count/p50/p95/max per histogram over the last `window` seconds."""
+        result = {}
+        for h in self.histograms:
+            values = h.window(window)
+            result[h.name] = {
+                "count": len(values),
+                "p50": percentile(values, 0.5),
+                "p95": percentile(values, 0.95),
+                "max": values[-1] if values else 0.0,
+            }
+        return result
+
+    def by_label(self, histogram: Histogram, label: str, window: float = 3600) -> Dict[str, List[float]]:
+        cutoff = time.time() - window
+        groups: Dict[str, List[float]] = defaultdict(list)
+        for t, key, v in histogram.recent:
+            if t >= cutoff:
+                groups[dict(key).get(label, "")].append(v)
+        return {k: sorted(v) for k, v in groups.items()}
+
+    ## Prometheus text endpoint
+
+    async def serve(self, host: str, port: int) -> None:
+        self.server = await asyncio.start_server(self._handle, host, port)
+        logging.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Headers are not needed, but drain them so the client sees a clean response
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", self.render().encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception:
+            logging.error("Error serving metrics", exc_info=True)
+        finally:
+            writer.close()
@@ -0,0 +1,92 @@
+## TTL cache of the models available across the ollama pool.
+## `/model list`, `/model set` and the `model` autocomplete read from here instead of calling
+## /api/tags on every invocation (or keystroke). Stale entries are served while a background
+## refresh runs; pulls and deletes invalidate the cache right away.
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import context
+
+
+@dataclass
+class CatalogEntry:
+    name: str
+    size: int
+    family: str
+    parameter_size: str
+    quantization: str
+
+    def describe(self) -> str:
+        parts = [p for p in (self.parameter_size, self.family, self.quantization) if p]
+        parts.append(f"{self.size / 1024 ** 3:.1f} GB")
+        return " · ".join(parts)
+
+
+class ModelCatalog:
+    def __init__(self, ttl: float = 300):
+        self.ttl: float = ttl
+        self.entries: Dict[str, CatalogEntry] = {}
+        self.expires_at: float = 0.0
+        self.loaded: bool = False
+        self.refresh_task: Optional[asyncio.Task] = None
+        self.loop_task: Optional[asyncio.Task] = None
+
+    @property
+    def stale(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    async def refresh(self) -> None:
+        model_list = await context.llama.list()
+        entries = {}
+        for model in model_list['models']:
+            details = getattr(model, "details", None)
+            entries[model.model] = CatalogEntry(
+                name=model.model,
+                size=int(model.size or 0),
+                family=getattr(details, "family", None) or "",
+                parameter_size=getattr(details, "parameter_size", None) or "",
+                quantization=getattr(details, "quantization_level", None) or "",
+            )
+        self.entries = entries
+        self.loaded = True
+        self.expires_at = time.monotonic() + self.ttl
+
+    def refresh_soon(self) -> asyncio.Task:
+        # Single flight: concurrent callers share one refresh
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self._safe_refresh())
+        return self.refresh_task
+
+    async def _safe_refresh(self) -> None:
+        try:
+            await self.refresh()
+        except Exception:
+            logging.error("Error refreshing model catalog", exc_info=True)
+
+    async def get(self) -> Dict[str, CatalogEntry]:
+        if not self.loaded:
+            await self.refresh_soon()
+        elif self.stale:
+            self.refresh_soon()
+        return self.entries
+
+    def cached(self) -> List[CatalogEntry]:
+        """Whatever is cached right now, never waits on the network."""
+        if self.stale:
+            self.refresh_soon()
+        return list(self.entries.values())
+
+    def invalidate(self) -> None:
+        self.expires_at = 0.0
+        self.refresh_soon()
+
+    def start(self) -> None:
+        if self.loop_task is None:
+            self.loop_task = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await self.refresh_soon()
+            await asyncio.sleep(max(self.expires_at - time.monotonic(), 1))
@@ -1,28 +1,131 @@
-import sys, os, io, datetime
+import sys, os, io, time, datetime
 import asyncio
 import logging
 import discord
+from collections import Counter
+from contextlib import aclosing
 from typing import List, Dict, Any, AsyncGenerator
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 import context
 from src.Response import Response
 from src.redis_conn import (
     save_message_redis,
-    get_messages
+    is_admin
 )
+from src.prompt_builder import PromptContext, build_prompt
+from src.response_cache import fingerprint
+from src.log_files import log_ids
+
+def guild_label(message:discord.Message) -> str:
+    return str(message.guild.id) if message.guild else "dm"
+
 
 class ollama_conn:
     def __init__(self):
         self.writing_tasks = {}
+        # Generations stopped early, and the tokens they had streamed so far, per reason
+        self.cancelled: Counter = Counter()
+        self.cancelled_tokens: Counter = Counter()
         
     def add_task(self, message:discord.Message):
         r = Response(message)
-        writing_task = asyncio.create_task(self.writing(r))
+        writing_task = asyncio.create_task(self.scheduled_writing(r))
         self.writing_tasks[message.id] = (r, writing_task)
     
-    def remove_task(self, message_id:int):
-        del self.writing_tasks[message_id] # Remove the task from the dictionary
-
+    def remove_task(self, message_id:int, task:asyncio.Task|None=None):
+        # An edited message may already have a newer task under the same ID
+        entry = self.writing_tasks.get(message_id)
+        if entry is not None and (task is None or entry[1] is task):
+            del self.writing_tasks[message_id] # Remove the task from the dictionary
+    
+    def cancel_task(self, message_id:int, reason:str) -> bool:
+        """Cancel the generation answering `message_id`. Cancelling closes the upstream ollama stream."""
+        entry = self.writing_tasks.get(message_id)
+        if entry is None:
+            return False
+        r, task = entry
+        if task.done() or (r.closed and reason != "deleted"):
+            return False # already answered, only publishing is left
+        r.cancel_reason = reason
+        task.cancel()
+        return True
+    
+    def cancel_superseded(self, message:discord.Message) -> int:
+        """Latest mention wins: cancel the author's older, still running questions in this channel."""
+        cancelled = 0
+        for message_id, (r, task) in list(self.writing_tasks.items()):
+            if message_id != message.id and r.channel_id == message.channel.id and r.message.author.id == message.author.id:
+                cancelled += self.cancel_task(message_id, "superseded")
+        return cancelled
+    
+    async def on_cancelled(self, response:Response, tokens:int=0):
+        reason = response.cancel_reason or "shutdown"
+        self.cancelled[reason] += 1
+        self.cancelled_tokens[reason] += tokens
+        logging.info(f"Generation for message {response.message.id} cancelled ({reason}) after {tokens} tokens", extra=log_ids(response.message))
+        if reason == "deleted":
+            await response.discard()
+            return
+        try:
+            await response.message.add_reaction('❌')
+        except discord.HTTPException:
+            pass
+    
+    def cancel_stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            reason: {"count": count, "tokens": self.cancelled_tokens[reason]}
+            for reason, count in self.cancelled.items()
+        }
+    
+    async def scheduled_writing(self, response:Response):
+        message = response.message
+        priority = is_admin(message.author.id, message.guild.id if message.guild else None)
+        model = None
+        try:
+            model = await context.residency.model_for(message.channel.id)
+            if context.ingest:
+                # The question itself (and chatter just before it) may still be buffered
+                await context.ingest.flush(response.channel_id)
+            prompt = await build_prompt(message, model)
+            cache_key = None
+            if context.response_cache:
+                cache_key = fingerprint(model, prompt.options, prompt.messages)
+                cached = await context.response_cache.get(message, cache_key)
+                if cached:
+                    # Identical prompt answered before: sent right away, without queueing for a generation slot
+                    await self.send_cached(response, cached)
+                    return
+            async with context.scheduler.slot(message, priority, model) as job:
+                if context.metrics:
+                    context.metrics.queue_wait.observe(job.wait_time, model=model, guild=guild_label(message))
+                await self.writing(response, model=model, backend=job.backend, prompt=prompt, cache_key=cache_key)
+        except asyncio.CancelledError:
+            # Still queued, nothing was generated
+            await self.on_cancelled(response)
+        except Exception:
+            await message.add_reaction('💩')
+            logging.error("Error answering", exc_info=True, extra=log_ids(message, model=model))
+        finally:
+            self.remove_task(message.id, asyncio.current_task())
+    
+    async def send_cached(self, response:Response, cached:str):
+        try:
+            response.write(cached)
+            await response.close()
+        finally:
+            await self.save_reply(response, cached)
+    
+    async def save_reply(self, response:Response, full_response:str):
+        bot_msg = response.r
+        if bot_msg and not response.discarded:
+            await save_message_redis(
+                message_id=bot_msg.id,
+                message_content=full_response,
+                author=bot_msg.author,
+                channel_id=bot_msg.channel.id,
+                attachments=[],
+                # attachments=bot_msg.attachments,
+            )
     
     async def think(self, message:discord.Message, timeout:int=999):
         try:
@@ -31,61 +134,79 @@ class ollama_conn:
             pass
         except Exception as e:
             await message.add_reaction('💩')
-            logging.error("Error thinking", exc_info=True)
+            logging.error("Error thinking", exc_info=True, extra=log_ids(message))
             pass
         finally:
             await message.remove_reaction('🤔', context.discord.user)
             
             
-    async def writing(self, response:Response):
+    async def writing(self, response:Response, model:str|None=None, backend:str|None=None, prompt:PromptContext|None=None, cache_key:str|None=None):
         full_response = ""
+        tokens = 0
+        dispatched = time.monotonic()
+        guild = guild_label(response.message)
         try:
             thinking = asyncio.create_task(self.think(response.message))
-            messages = get_messages(response.message, True)
+            if model is None:
+                model = context.llama_default_model
+            if prompt is None:
+                # Called directly: scheduled_writing builds the prompt and checks the cache before queueing
+                if context.ingest:
+                    await context.ingest.flush(response.channel_id)
+                prompt = await build_prompt(response.message, model)
+            context.prefix_tracker.bind_backend(response.channel_id, backend)
+            context.residency.record_request(model, backend)
+            await context.residency.prepare(model, backend)
             
-            async for part in self.chat(messages, context.llama_default_model):
-                # sys.stdout.write(part['message']['content'])
-                # sys.stdout.flush()
-                
-                part_content = part['message']['content']
-                full_response += part_content
-                await response.write(part_content, end='...')
+            # Only buffer here; context.edit_scheduler publishes to discord at its own pace.
+            # aclosing: a cancel between parts still closes the upstream HTTP stream right away
+            async with aclosing(self.chat(prompt.messages, model, milliseconds=None, options=prompt.options, backend=backend)) as stream:
+                async for part in stream:
+                    # sys.stdout.write(part['message']['content'])
+                    # sys.stdout.flush()
+                    
+                    part_content = part['message']['content']
+                    if tokens == 0 and part_content and context.metrics:
+                        context.metrics.ttft.observe(time.monotonic() - dispatched, model=model, host=backend, guild=guild)
+                    full_response += part_content
+                    tokens += 1 # ollama streams one token per part
+                    response.write(part_content, end='...')
+                    if part['done']:
+                        context.prefix_tracker.record_eval(response.channel_id, prompt.prompt_tokens, part.get('prompt_eval_count'))
+                        if context.metrics:
+                            context.metrics.record_done(part, model, backend, guild, prompt.prompt_tokens)
+                        if cache_key and part.get('done_reason') in (None, 'stop'): # not cut off by num_predict
+                            await context.response_cache.put(response.message, cache_key, full_response)
                     
-            await response.write('')
+            await response.close()
         except asyncio.CancelledError:
-            await response.message.add_reaction('❌')
+            await self.on_cancelled(response, tokens)
         except Exception as e:
             await response.message.add_reaction('💩')
-            logging.error("Error answering", exc_info=True)
+            logging.error("Error answering", exc_info=True, extra=log_ids(response.message, model=model, backend=backend))
             pass
         finally:
             if thinking is not None and not thinking.done():
                 thinking.cancel()
-            self.remove_task(response.message.id)
             # save bot reply
-            bot_msg = response.r
-            if bot_msg:
-                save_message_redis(
-                    message_id=bot_msg.id,
-                    message_content=full_response,
-                    author=bot_msg.author,
-                    channel_id=bot_msg.channel.id,
-                    attachments=[],
-                    # attachments=bot_msg.attachments,
-                )
+            await self.save_reply(response, full_response)
     
     async def chat(self, 
                    messages: List[Dict[str, Any]], 
                    model:str|None=None, 
-                   milliseconds:int=1000
+                   milliseconds:int=1000,
+                   options:Dict[str, Any]|None=None,
+                   backend:str|None=None
     ) -> AsyncGenerator[Dict[str, Any], None]:
         if model is None:
             model = context.llama_default_model
         sb = io.StringIO() # create new StringIO object that can write and read from a string buffer
         t = datetime.datetime.now()
         try:
-            generator = await context.llama.chat(model, messages=messages, stream=True)
+            generator = await context.llama.chat(model, messages=messages, stream=True, options=options, backend=backend, keep_alive=context.residency.keep_alive(model))
             async for part in generator:
+                if part['done']:
+                    context.residency.record_done(model, part)
                 sb.write(part['message']['content']) # write content to StringIO buffer
                 # sys.stdout.write(part['message']['content'])
                 # sys.stdout.flush()
@@ -107,13 +228,13 @@ class ollama_conn:
             logging.error("Error getting AI chat response", exc_info=True)
         
         
-    async def generate(self, content, model=None):
+    async def generate(self, content, model=None, keep_alive=-1):
         if model is None:
             model = context.llama_default_model
         sb = io.StringIO()
         t = datetime.datetime.now()
         try:
-            generator = await context.llama.generate(model=model, prompt=content, keep_alive=-1, stream=True)
+            generator = await context.llama.generate(model=model, prompt=content, keep_alive=keep_alive, stream=True)
             async for part in generator:
                 sb.write(part['response'])
 
@@ -129,9 +250,5 @@ class ollama_conn:
             
 
 async def get_model_list() -> List[str]:
-    model_list: Dict[str, Any] = await context.llama.list()
-    available_models: List[str] = []
-    for model in model_list['models']:
-        # Use the correct attribute
-        available_models.append(model.model)  
-    return available_models
\ No newline at end of file
+    # Served from the TTL cached catalog, not a live /api/tags call
+    return sorted(await context.model_catalog.get())
\ No newline at end of file
@@ -0,0 +1,238 @@
+## Pool of ollama hosts behind one AsyncClient-like interface (context.llama).
+## Every call is routed by model: healthy hosts that have the model, preferring hosts that already
+## have it loaded (per /api/ps), then the one with the fewest requests in flight.
+## A probe loop keeps each host's model/loaded lists fresh; hosts that fail are ejected and
+## re-probed with exponential backoff until they answer again.
+import time
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set
+import httpx
+import ollama
+
+TRANSPORT_ERRORS = (ConnectionError, httpx.TransportError)
+
+
+class OllamaBackend:
+    def __init__(self, name: str, host: str, max_concurrent: int = 2, auth: Optional[tuple] = None, verify: bool = True, timeout: Optional[float] = None):
+        self.name: str = name
+        self.host: str = host
+        self.max_concurrent: int = max_concurrent
+        kwargs = {"verify": verify}
+        if auth:
+            kwargs["auth"] = auth
+        if timeout:
+            kwargs["timeout"] = timeout
+        self.client: ollama.AsyncClient = ollama.AsyncClient(host, **kwargs)
+
+        self.healthy: bool = True
+        self.in_flight: int = 0
+        self.models: Set[str] = set()   # available on disk (/api/tags)
+        self.loaded: Set[str] = set()   # resident in memory (/api/ps)
+        self.model_sizes: Dict[str, int] = {}
+        self.failures: int = 0
+        self.next_probe: float = 0.0
+        self.last_error: Optional[str] = None
+
+
+class OllamaPool:
+    def __init__(self, backends: List[OllamaBackend], probe_interval: float = 15.0, max_backoff: float = 300.0, probe_timeout: float = 5.0):
+        self.backends: List[OllamaBackend] = backends
+        self.by_name: Dict[str, OllamaBackend] = {b.name: b for b in backends}
+        self.probe_interval: float = probe_interval
+        self.max_backoff: float = max_backoff
+        self.probe_timeout: float = probe_timeout
+        self.probe_task: Optional[asyncio.Task] = None
+        # Called as listener(backend, loaded_before, loaded_after) after every successful probe
+        self.probe_listeners: List[Callable] = []
+
+    ## Routing
+
+    def candidates(self, model: Optional[str] = None) -> List[OllamaBackend]:
+        """Healthy backends able to serve `model`, best first."""
+        healthy = [b for b in self.backends if b.healthy]
+        if model:
+            with_model = [b for b in healthy if model in b.models]
+            # If no host reports the model (lists not probed yet), let any healthy host try
+            if with_model:
+                healthy = with_model
+        return sorted(healthy, key=lambda b: (model not in b.loaded, b.in_flight / max(b.max_concurrent, 1)))
+
+    def pick(self, model: Optional[str] = None, backend: Optional[str] = None, exclude: Set[str] = frozenset()) -> Optional[OllamaBackend]:
+        preferred = self.by_name.get(backend) if backend else None
+        if preferred is not None and preferred.healthy and preferred.name not in exclude:
+            return preferred
+        for b in self.candidates(model):
+            if b.name not in exclude:
+                return b
+        return None
+
+    def mark_unhealthy(self, backend: OllamaBackend, error: BaseException) -> None:
+        backend.failures += 1
+        backend.last_error = str(error) or type(error).__name__
+        backend.next_probe = time.monotonic() + min(self.probe_interval * 2 ** (backend.failures - 1), self.max_backoff)
+        if backend.healthy:
+            backend.healthy = False
+            logging.error(f"Ollama host {backend.name} ejected: {backend.last_error}")
+
+    def mark_healthy(self, backend: OllamaBackend) -> None:
+        if not backend.healthy:
+            logging.info(f"Ollama host {backend.name} is back after {backend.failures} failed probes")
+        backend.healthy = True
+        backend.failures = 0
+        backend.last_error = None
+        backend.next_probe = time.monotonic() + self.probe_interval
+
+    ## AsyncClient compatible calls
+
+    async def chat(self, model: str = '', messages=None, *, stream: bool = False, backend: Optional[str] = None, **kwargs):
+        call = lambda client: client.chat(model, messages=messages, stream=stream, **kwargs)
+        if stream:
+            return self._stream(model, backend, call)
+        return await self._call(model, backend, call)
+
+    async def generate(self, model: str = '', prompt: str = '', *, stream: bool = False, backend: Optional[str] = None, **kwargs):
+        call = lambda client: client.generate(model=model, prompt=prompt, stream=stream, **kwargs)
+        if stream:
+            return self._stream(model, backend, call)
+        return await self._call(model, backend, call)
+
+    async def embed(self, model: str = '', input='', *, backend: Optional[str] = None, **kwargs):
+        return await self._call(model, backend, lambda client: client.embed(model=model, input=input, **kwargs))
+
+    async def show(self, model: str):
+        return await self._call(model, None, lambda client: client.show(model))
+
+    async def list(self) -> Dict[str, List[Any]]:
+        """Union of the models available on all healthy hosts."""
+        results = await asyncio.gather(
+            *(b.client.list() for b in self.backends if b.healthy),
+            return_exceptions=True,
+        )
+        models: Dict[str, Any] = {}
+        for result in results:
+            if isinstance(result, BaseException):
+                logging.error(f"Error listing ollama models: {result}")
+                continue
+            for m in result.models:
+                models.setdefault(m.model, m)
+        return {"models": [models[name] for name in sorted(models)]}
+
+    async def ps(self) -> Dict[str, List[Any]]:
+        results = await asyncio.gather(*(b.client.ps() for b in self.backends if b.healthy), return_exceptions=True)
+        loaded = []
+        for result in results:
+            if not isinstance(result, BaseException):
+                loaded.extend(result.models)
+        return {"models": loaded}
+
+    async def pull(self, model: str) -> List[str]:
+        """Pull `model` onto every healthy host. Returns the hosts that failed."""
+        backends = [b for b in self.backends if b.healthy]
+        results = await asyncio.gather(*(b.client.pull(model) for b in backends), return_exceptions=True)
+        failed = []
+        for b, result in zip(backends, results):
+            if isinstance(result, BaseException):
+                logging.error(f"Error pulling {model} on {b.name}: {result}")
+                failed.append(b.name)
+        await asyncio.gather(*(self.probe(b) for b in backends))
+        return failed
+
+    async def delete(self, model: str) -> List[str]:
+        """Delete `model` from every healthy host that has it. Returns the hosts that failed."""
+        backends = [b for b in self.backends if b.healthy and model in b.models]
+        results = await asyncio.gather(*(b.client.delete(model) for b in backends), return_exceptions=True)
+        failed = []
+        for b, result in zip(backends, results):
+            if isinstance(result, BaseException):
+                logging.error(f"Error deleting {model} on {b.name}: {result}")
+                failed.append(b.name)
+        await asyncio.gather(*(self.probe(b) for b in backends))
+        return failed
+
+    async def _call(self, model: str, backend: Optional[str], call: Callable):
+        tried: Set[str] = set()
+        while True:
+            b = self.pick(model, backend, tried)
+            if b is None:
+                raise ConnectionError(f"No healthy ollama host available for model {model or '(any)'}")
+            b.in_flight += 1
+            try:
+                result = await call(b.client)
+                if model:
+                    b.loaded.add(model)
+                return result
+            except TRANSPORT_ERRORS as e:
+                self.mark_unhealthy(b, e)
+                tried.add(b.name)
+            finally:
+                b.in_flight -= 1
+
+    async def _stream(self, model: str, backend: Optional[str], call: Callable) -> AsyncIterator[Any]:
+        tried: Set[str] = set()
+        while True:
+            b = self.pick(model, backend, tried)
+            if b is None:
+                raise ConnectionError(f"No healthy ollama host available for model {model or '(any)'}")
+            b.in_flight += 1
+            try:
+                # Every exit below undoes the increment, including a failing call()
+                generator = await call(b.client)
+                # The request only goes out on the first iteration, so connection failures surface here
+                first = await generator.__anext__()
+            except StopAsyncIteration:
+                b.in_flight -= 1
+                return
+            except TRANSPORT_ERRORS as e:
+                b.in_flight -= 1
+                self.mark_unhealthy(b, e)
+                tried.add(b.name)
+                continue
+            except BaseException:
+                b.in_flight -= 1
+                raise
+            break
+
+        try:
+            if model:
+                b.loaded.add(model)
+            yield first
+            async for part in generator:
+                yield part
+        finally:
+            b.in_flight -= 1
+            await generator.aclose()
+
+    ## Health probes
+
+    def start(self) -> None:
+        if self.probe_task is None:
+            self.probe_task = asyncio.create_task(self.probe_loop())
+
+    async def probe_loop(self) -> None:
+        while True:
+            now = time.monotonic()
+            due = [b for b in self.backends if b.next_probe <= now]
+            if due:
+                await asyncio.gather(*(self.probe(b) for b in due))
+            await asyncio.sleep(1)
+
+    async def probe(self, backend: OllamaBackend) -> bool:
+        try:
+            tags, ps = await asyncio.wait_for(
+                asyncio.gather(backend.client.list(), backend.client.ps()),
+                timeout=self.probe_timeout,
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.mark_unhealthy(backend, e)
+            return False
+        before = backend.loaded
+        backend.models = {m.model for m in tags.models}
+        backend.model_sizes = {m.model: int(m.size or 0) for m in tags.models}
+        backend.loaded = {m.model for m in ps.models}
+        self.mark_healthy(backend)
+        for listener in self.probe_listeners:
+            listener(backend, before, backend.loaded)
+        return True
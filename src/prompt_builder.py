@@ -0,0 +1,387 @@
+## Token-budgeted prompt assembly.
+## Ollama silently truncates the *front* of the prompt once it exceeds num_ctx, which drops the
+## system instruction first. We build the prompt ourselves so that never happens: the system
+## message and newest turns are always kept, older turns fill whatever budget is left.
+##
+## Prompts are also kept prefix-stable so ollama can reuse its KV cache between turns: the oldest
+## message in a channel's prompt (the anchor) stays fixed and new turns are only appended, until
+## the budget or history window runs out. Then the anchor jumps forward far enough (low water) to
+## leave room for many more appended turns. Each channel also sticks to one backend and num_ctx.
+## For vision models the images of the last few turns are attached, already scaled to the model's input size,
+## and stay on their turn until the next re-anchor so the prefix doesn't change.
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+from dataclasses import dataclass, field
+import discord
+import context
+from src.tokens import estimate_tokens
+from src.redis_conn import (
+    SYSTEM_INSTRUCTION,
+    format_summary,
+    get_formatted_history,
+    get_formatted_messages
+)
+
+
+@dataclass
+class PromptContext:
+    messages: List[dict]
+    num_ctx: int
+    prompt_tokens: int = 0
+    dropped_tokens: int = 0
+    dropped_messages: int = 0
+    options: Dict[str, int] = field(default_factory=dict)
+    reanchored: bool = False
+    retrieved: int = 0
+    images: int = 0
+
+
+@dataclass
+class ChannelPrefix:
+    model: str
+    num_ctx: int
+    anchor: Optional[int] = None # id of the oldest history message in the prompt
+    summary: Optional[dict] = None # summary snapshot in use since the last (re-)anchor
+    backend: Optional[str] = None
+    last_prompt_tokens: int = 0
+    last_eval_tokens: int = 0
+    images: Set[int] = field(default_factory=set) # history ids sent with images since the anchor
+
+
+class PrefixTracker:
+    def __init__(self, low_water: float = 0.5, max_channels: int = 4096):
+        self.low_water: float = low_water
+        self.max_channels: int = max_channels
+        self.channels: "OrderedDict[int, ChannelPrefix]" = OrderedDict()
+
+        self.replies: int = 0
+        self.reanchors: int = 0
+        self.trimmed: int = 0 # prompts that left history out to fit the budget
+        self.dropped_tokens: int = 0
+        self.dropped_messages: int = 0
+        self.prompt_tokens: int = 0
+        self.eval_tokens: int = 0
+
+    async def state(self, channel_id: int, model: str) -> ChannelPrefix:
+        state = self.channels.get(channel_id)
+        if state is None or state.model != model:
+            # New channel or model switch: nothing cached on the host is reusable anyway
+            state = ChannelPrefix(model=model, num_ctx=await get_num_ctx(model), backend=state.backend if state else None)
+            self.channels[channel_id] = state
+            if len(self.channels) > self.max_channels:
+                self.channels.popitem(last=False)
+        self.channels.move_to_end(channel_id)
+        return state
+
+    def reset(self, channel_id: int) -> None:
+        self.channels.pop(channel_id, None)
+
+    def backend(self, channel_id: int) -> Optional[str]:
+        state = self.channels.get(channel_id)
+        return state.backend if state else None
+
+    def bind_backend(self, channel_id: int, backend: Optional[str]) -> None:
+        state = self.channels.get(channel_id)
+        if state is not None and backend:
+            state.backend = backend
+
+    def record_eval(self, channel_id: int, prompt_tokens: int, eval_tokens: Optional[int]) -> None:
+        """prompt_eval_count only counts tokens ollama had to evaluate, so a reused prefix shows up as eval << prompt."""
+        if eval_tokens is None:
+            return
+        self.replies += 1
+        self.prompt_tokens += prompt_tokens
+        self.eval_tokens += eval_tokens
+        state = self.channels.get(channel_id)
+        if state is not None:
+            state.last_prompt_tokens = prompt_tokens
+            state.last_eval_tokens = eval_tokens
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "replies": self.replies,
+            "reanchors": self.reanchors,
+            "trimmed": self.trimmed,
+            "dropped_tokens": self.dropped_tokens,
+            "dropped_messages": self.dropped_messages,
+            "prompt_tokens": self.prompt_tokens,
+            "prompt_eval_tokens": self.eval_tokens,
+            # share of the (estimated) prompt ollama did not have to evaluate again
+            "prefix_reuse": max(0.0, 1 - self.eval_tokens / self.prompt_tokens) if self.prompt_tokens else 0.0,
+        }
+
+
+_model_info: Dict[str, dict] = {}
+
+
+async def get_model_info(
+    model: str
+) -> Optional[dict]:
+    """Context length and vision support of a model, from `ollama show` (cached per model)."""
+    if model in _model_info:
+        return _model_info[model]
+
+    details = {"context_length": None, "vision": False, "image_size": None}
+    try:
+        info = await context.llama.show(model)
+        modelinfo = getattr(info, "modelinfo", None) or {}
+        for key, value in modelinfo.items():
+            if key.endswith(".context_length") and ".vision." not in key and details["context_length"] is None:
+                details["context_length"] = int(value)
+            elif key.endswith(".vision.image_size") and isinstance(value, (int, float)):
+                details["image_size"] = int(value)
+        capabilities = getattr(info, "capabilities", None) or []
+        details["vision"] = "vision" in capabilities or details["image_size"] is not None
+    except Exception:
+        logging.error(f"Error reading model info of model {model}", exc_info=True)
+        return None
+
+    _model_info[model] = details
+    return details
+
+
+async def get_model_context_length(
+    model: str
+) -> Optional[int]:
+    """Max context length the model was trained with."""
+    info = await get_model_info(model)
+    return info["context_length"] if info else None
+
+
+async def get_num_ctx(
+    model: str
+) -> int:
+    # Never ask for more context than the model supports
+    num_ctx = context.llama_num_ctx
+    model_length = await get_model_context_length(model)
+    if model_length:
+        num_ctx = min(num_ctx, model_length)
+    return num_ctx
+
+
+def prompt_header(
+    summary: Optional[dict] = None
+) -> List[dict]:
+    if summary:
+        return [SYSTEM_INSTRUCTION, format_summary(summary)]
+    return [SYSTEM_INSTRUCTION]
+
+
+def fit_to_budget(
+    entries: List[dict], 
+    budget: int, 
+    keep_recent: int = 1, 
+    max_messages: Optional[int] = None, 
+    header: Optional[List[dict]] = None
+) -> PromptContext:
+    """
+    Select history entries ({role, content, tokens}) newest-first until `budget` tokens (or `max_messages`) are used.
+    The newest `keep_recent` entries are always kept, even if they alone exceed the budget.
+    `header` (system instruction, summary) always goes first.
+    """
+    if header is None:
+        header = prompt_header()
+    used = sum(estimate_tokens(m["content"]) for m in header)
+    kept: List[dict] = []
+    dropped_tokens = 0
+    dropped_messages = 0
+    for i, entry in enumerate(reversed(entries)):
+        tokens = entry.get("tokens") or estimate_tokens(entry["content"])
+        fits = used + tokens <= budget and (max_messages is None or i < max_messages)
+        if i < keep_recent or (not dropped_messages and fits):
+            kept.append({"role": entry["role"], "content": entry["content"]})
+            used += tokens
+        else:
+            # Once something is dropped, drop everything older too so the conversation stays contiguous
+            dropped_tokens += tokens
+            dropped_messages += 1
+    kept.reverse()
+
+    return PromptContext(
+        messages=header + kept,
+        num_ctx=0,
+        prompt_tokens=used,
+        dropped_tokens=dropped_tokens,
+        dropped_messages=dropped_messages,
+    )
+
+
+def select_prefix_stable(
+    entries: List[dict], 
+    budget: int, 
+    state: ChannelPrefix, 
+    window: int, 
+    low_water: float, 
+    summary: Optional[dict] = None
+) -> PromptContext:
+    tokens = lambda e: e.get("tokens") or estimate_tokens(e["content"])
+
+    # Keep appending to the current anchor while it is still inside the window and everything fits.
+    # The summary snapshot is only swapped when re-anchoring, so a summary update doesn't break the prefix either.
+    if state.anchor is not None and entries and int(entries[0]["id"]) <= state.anchor:
+        header = prompt_header(state.summary)
+        kept = [e for e in entries if int(e["id"]) >= state.anchor]
+        used = sum(estimate_tokens(m["content"]) for m in header) + sum(tokens(e) for e in kept)
+        if kept and used <= budget:
+            dropped = entries[:len(entries) - len(kept)]
+            return PromptContext(
+                messages=header + [{"role": e["role"], "content": e["content"]} for e in kept],
+                num_ctx=0,
+                prompt_tokens=used,
+                dropped_tokens=sum(tokens(e) for e in dropped),
+                dropped_messages=len(dropped),
+            )
+
+    # (Re-)anchor. A fresh channel that fits keeps everything; otherwise fall back to the low water
+    # mark so the new anchor survives many appended turns. Turns covered by the summary are left out.
+    state.summary = summary
+    header = prompt_header(summary)
+    if summary:
+        entries = [e for e in entries if int(e["id"]) > summary["upto"]]
+    used = sum(estimate_tokens(m["content"]) for m in header) + sum(tokens(e) for e in entries)
+    if state.anchor is None and used <= budget and len(entries) < window:
+        prompt = fit_to_budget(entries, budget, header=header)
+    else:
+        prompt = fit_to_budget(entries, int(budget * low_water), max_messages=max(int(window * low_water), 1), header=header)
+        prompt.reanchored = True
+    kept_count = len(prompt.messages) - len(header)
+    state.anchor = int(entries[-kept_count]["id"]) if kept_count and "id" in entries[-kept_count] else None
+    return prompt
+
+
+def select_with_retrieval(
+    entries: List[dict], 
+    retrieved: List[dict], 
+    budget: int, 
+    recent_turns: int, 
+    summary: Optional[dict] = None
+) -> PromptContext:
+    """
+    The last `recent_turns` entries, plus as many `retrieved` entries (best match first) as still fit,
+    shown oldest first in one system message between the header and the recent turns.
+    """
+    header = prompt_header(summary)
+    if summary:
+        entries = [e for e in entries if int(e["id"]) > summary["upto"]]
+    prompt = fit_to_budget(entries, budget, max_messages=recent_turns, header=header)
+    recent_ids = {int(e["id"]) for e in entries[len(entries) - (len(prompt.messages) - len(header)):]}
+
+    intro = "Earlier messages from this channel that may be relevant:"
+    room = budget - prompt.prompt_tokens - estimate_tokens(intro)
+    picked = []
+    for e in retrieved:
+        tokens = e.get("tokens") or estimate_tokens(e["content"])
+        if int(e["id"]) in recent_ids or tokens > room:
+            continue
+        picked.append(e)
+        room -= tokens
+    if picked:
+        picked.sort(key=lambda e: int(e["id"]))
+        block = {
+            "role": "system",
+            "content": intro + "\n\n" + "\n\n".join(f"[{e['role']}] {e['content']}" for e in picked)
+        }
+        prompt.messages.insert(len(header), block)
+        prompt.prompt_tokens += estimate_tokens(block["content"])
+    prompt.retrieved = len(picked)
+    return prompt
+
+
+async def attach_images(
+    prompt: PromptContext, 
+    entries: List[dict], 
+    model: str, 
+    budget: int, 
+    state: Optional[ChannelPrefix] = None
+) -> None:
+    """Attach the images of the newest `recent_turns` kept turns while the budget allows.
+    Turns already sent with images since the anchor keep them: dropping them would change the cached prefix."""
+    info = await get_model_info(model)
+    if not info or not info["vision"]:
+        return
+    store = context.attachments
+    sticky = state.images if state is not None else set()
+    # The kept turns are the tail of `entries`, in the same order, after the system messages
+    candidates = []
+    for i in range(1, min(len(entries), len(prompt.messages)) + 1):
+        message, entry = prompt.messages[-i], entries[-i]
+        if message["role"] == "system":
+            break
+        message_id = int(entry["id"]) if "id" in entry else None
+        if i > store.recent_turns and message_id not in sticky:
+            continue
+        candidates.extend((message, message_id, url) for url in entry.get("images") or ())
+    # Images already in the prefix get the budget first, then the newest turns
+    wanted = []
+    for candidate in sorted(candidates, key=lambda c: c[1] not in sticky):
+        if prompt.prompt_tokens + store.tokens_per_image > budget:
+            break
+        prompt.prompt_tokens += store.tokens_per_image
+        wanted.append(candidate)
+    attached = set()
+    encoded = await asyncio.gather(*(store.image_b64(url, info["image_size"]) for _, _, url in wanted))
+    for (message, message_id, _), image in zip(wanted, encoded):
+        if image is None:
+            prompt.prompt_tokens -= store.tokens_per_image
+            continue
+        message.setdefault("images", []).append(image)
+        prompt.images += 1
+        if message_id is not None:
+            attached.add(message_id)
+    if state is not None:
+        state.images = attached
+
+
+async def build_prompt(
+    message: discord.Message, 
+    model: str
+) -> PromptContext:
+    state = await context.prefix_tracker.state(message.channel.id, model)
+    num_ctx = state.num_ctx
+    budget = max(num_ctx - context.llama_response_reserve, 0)
+
+    if not context.redis:
+        entries = [{"role": "user", "content": message.content}]
+        prompt = fit_to_budget(entries, budget)
+    elif context.retrieval:
+        # Recent turns + recalled older messages; the recalled set changes per question, so no stable prefix here
+        entries = await get_formatted_history(message.channel.id)
+        summary = await context.summarizer.summary_for(message.channel.id) if context.summarizer else None
+        recent_ids = {int(e["id"]) for e in entries[-context.retrieval.recent_turns:]}
+        try:
+            hits = await context.retrieval.search(message.channel.id, message.content, recent_ids)
+        except Exception:
+            logging.error("Error retrieving relevant messages", exc_info=True)
+            hits = []
+        retrieved = await get_formatted_messages(message.channel.id, hits)
+        prompt = select_with_retrieval(entries, retrieved, budget, context.retrieval.recent_turns, summary)
+        state.anchor = None
+        state.images.clear()
+    else:
+        entries = await get_formatted_history(message.channel.id)
+        summary = await context.summarizer.summary_for(message.channel.id) if context.summarizer else None
+        anchor = state.anchor
+        prompt = select_prefix_stable(entries, budget, state, context.history_window, context.prefix_tracker.low_water, summary)
+        if anchor is None or prompt.reanchored:
+            state.images.clear() # new prefix, nothing cached to keep
+
+    if context.attachments and context.redis:
+        await attach_images(prompt, entries, model, budget, state)
+    prompt.num_ctx = num_ctx
+    prompt.options = {"num_ctx": num_ctx}
+    if prompt.reanchored:
+        context.prefix_tracker.reanchors += 1
+    if prompt.dropped_messages:
+        context.prefix_tracker.trimmed += 1
+        context.prefix_tracker.dropped_tokens += prompt.dropped_tokens
+        context.prefix_tracker.dropped_messages += prompt.dropped_messages
+        if context.metrics:
+            context.metrics.dropped_tokens.observe(prompt.dropped_tokens, model=model)
+    if prompt.reanchored and prompt.dropped_messages:
+        logging.info(
+            f"Prompt for channel {message.channel.id} ({model}) re-anchored: kept {prompt.prompt_tokens}/{budget} tokens, "
+            f"dropped {prompt.dropped_messages} messages (~{prompt.dropped_tokens} tokens)"
+        )
+    return prompt
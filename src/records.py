@@ -0,0 +1,81 @@
+## Encoding of stored message records (the values of `messages:{channel_id}`).
+## v1: JSON object with every field, e.g. {"id": ..., "author_id": ..., "author_name": ..., "role": "user", ...}.
+## v2: compact JSON array [2, author_id, author_name, role, content, tokens, attachments?]. The message id is
+##     the hash field, the timestamp is derived from the snowflake, the role is an index into ROLES and an
+##     empty attachment list is left off. Non-ASCII text is stored as UTF-8 instead of \u escapes.
+## Records stay text because the shared redis client decodes responses and the Lua scripts pass them around
+## as strings. decode_record reads both versions, so old keys keep working until they are re-encoded.
+import json
+import datetime
+from typing import Optional, Union
+
+RECORD_VERSION = 2
+ROLES = ("user", "assistant")
+DISCORD_EPOCH_MS = 1420070400000
+
+
+def snowflake_to_ms(
+    snowflake: Union[int, str]
+) -> int:
+    return (int(snowflake) >> 22) + DISCORD_EPOCH_MS
+
+
+def snowflake_timestamp(
+    snowflake: Union[int, str]
+) -> str:
+    """UTC creation time of a discord ID, in the ISO format v1 records stored."""
+    dt = datetime.datetime.fromtimestamp(snowflake_to_ms(snowflake) / 1000, datetime.timezone.utc)
+    return dt.replace(tzinfo=None).isoformat()
+
+
+def record_version(
+    raw: Union[str, bytes]
+) -> int:
+    if isinstance(raw, bytes):
+        raw = raw.decode()
+    if raw.startswith("["):
+        return int(raw[1:raw.index(",")])
+    return 1
+
+
+def encode_record(
+    record: dict,
+    version: int = RECORD_VERSION
+) -> str:
+    if version == 1:
+        return json.dumps(record)
+    fields = [
+        RECORD_VERSION,
+        int(record["author_id"]),
+        record["author_name"],
+        ROLES.index(record["role"]),
+        record["content"],
+        record.get("tokens"),
+    ]
+    if record.get("attachments"):
+        fields.append(record["attachments"])
+    return json.dumps(fields, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode_record(
+    raw: Union[str, bytes],
+    message_id: Optional[Union[int, str]] = None
+) -> dict:
+    """The v1 dict shape for either version. v2 records need the `message_id` they are stored under."""
+    if isinstance(raw, bytes):
+        raw = raw.decode()
+    data = json.loads(raw)
+    if isinstance(data, dict):
+        return data
+    if data[0] != 2:
+        raise ValueError(f"Unknown record version {data[0]}")
+    return {
+        "id": int(message_id),
+        "author_id": data[1],
+        "author_name": data[2],
+        "role": ROLES[data[3]],
+        "content": data[4],
+        "timestamp": snowflake_timestamp(message_id),
+        "attachments": data[6] if len(data) > 6 else [],
+        "tokens": data[5],
+    }
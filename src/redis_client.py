@@ -0,0 +1,66 @@
+## Factories for the redis clients used by bentebot.
+## The bot itself runs on the asyncio client so no redis round-trip blocks the discord event loop.
+## The sync client is kept around for one-off scripts (migrations, maintenance) that run outside the bot.
+import os
+import time
+from typing import Callable, Optional, Tuple
+import redis
+import redis.asyncio as aredis
+
+
+class TimedRedis(aredis.Redis):
+    """Async client that reports every command's latency to `observer(command, seconds)`."""
+    observer: Optional[Callable[[str, float], None]] = None
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            if self.observer is not None:
+                self.observer(str(args[0]), time.perf_counter() - started)
+
+
+def redis_settings_from_env() -> Optional[Tuple[str, int]]:
+    redis_host = str(os.getenv("REDIS_HOST", ""))
+    redis_port = os.getenv("REDIS_PORT")
+    if redis_host == "" or not redis_port:
+        return None
+    return redis_host, int(redis_port)
+
+
+def create_async_redis(
+    host: str, 
+    port: int, 
+    pool_size: int = 20, 
+    pool_timeout: float = 5.0, 
+    db: int = 0
+) -> TimedRedis:
+    # Blocking pool: when all connections are busy, callers wait (up to pool_timeout) for a free one
+    # instead of opening an unbounded number of sockets during bursts.
+    pool = aredis.BlockingConnectionPool(
+        host=host,
+        port=port,
+        db=db,
+        decode_responses=True,
+        max_connections=pool_size,
+        timeout=pool_timeout,
+    )
+    return TimedRedis(connection_pool=pool)
+
+
+def create_sync_redis(
+    host: str, 
+    port: int, 
+    db: int = 0
+) -> redis.Redis:
+    return redis.Redis(host=host, port=port, db=db, decode_responses=True)
+
+
+def sync_redis_from_env() -> Optional[redis.Redis]:
+    ## Convenience for scripts: build a sync client from the same env vars as main.py
+    settings = redis_settings_from_env()
+    if settings is None:
+        return None
+    host, port = settings
+    return create_sync_redis(host, port)
@@ -1,8 +1,11 @@
-import json, datetime
+import json, asyncio, logging, datetime
 from typing import Optional, List, Union
 from dataclasses import dataclass
 import discord
 import context
+from src.tokens import estimate_tokens
+from src.attachments import is_image_url
+from src.records import RECORD_VERSION, snowflake_to_ms, snowflake_timestamp, encode_record, decode_record, record_version
 
 
 @dataclass
@@ -16,16 +19,182 @@ class StoredMessageData:
     attachments: List[str]
 
 
-def save_message_redis(
+## Channel history layout:
+##  messages:{channel_id} -> HASH   message_id => encoded record (src/records.py)
+##  history:{channel_id}  -> ZSET   message_id scored by its snowflake timestamp (ms), gives chronological order
+##  history_caps          -> HASH   channel_id => per-channel cap overriding context.history_max_messages
+## Retention (src/retention.py):
+##  retention_policies       -> HASH   guild or channel id => JSON policy
+##  archive_pending:{channel_id} -> LIST   records trimmed by the cap, waiting to be written to the archive
+##  retention_hold:{channel_id}  -> STRING set (with a TTL) after a restore, pauses trimming and sweeping
+##  record_encoding              -> STRING record version every stored message has been re-encoded to
+
+SAVE_MESSAGE_SCRIPT = """
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+if redis.call('EXISTS', KEYS[5]) == 1 then
+    return 1
+end
+local cap = tonumber(redis.call('HGET', KEYS[3], ARGV[5]) or ARGV[4])
+if cap and cap > 0 then
+    local excess = redis.call('ZCARD', KEYS[2]) - cap
+    if excess > 0 then
+        local old = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+        if ARGV[6] == '1' then
+            -- Hand the trimmed records to the archive instead of dropping them
+            -- Pushed as "<id>:<record>", v2 records don't carry their id
+            local records = redis.call('HMGET', KEYS[1], unpack(old))
+            for i, record in ipairs(records) do
+                if record then redis.call('RPUSH', KEYS[4], old[i] .. ':' .. record) end
+            end
+        end
+        redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+        redis.call('HDEL', KEYS[1], unpack(old))
+    end
+end
+return 1
+"""
+
+# Oldest messages outside the retention policy (age cutoff, count, bytes), at most ARGV[4] of them
+EXPIRED_MESSAGES_SCRIPT = """
+local total = redis.call('ZCARD', KEYS[2])
+local remove = 0
+if tonumber(ARGV[1]) > 0 then
+    remove = redis.call('ZCOUNT', KEYS[2], '-inf', '(' .. ARGV[1])
+end
+local max_count = tonumber(ARGV[2])
+if max_count > 0 and total - max_count > remove then
+    remove = total - max_count
+end
+local max_bytes = tonumber(ARGV[3])
+if max_bytes > 0 and remove < total then
+    local ids = redis.call('ZREVRANGE', KEYS[2], 0, total - remove - 1)
+    local size = 0
+    for i, id in ipairs(ids) do
+        size = size + redis.call('HSTRLEN', KEYS[1], id)
+        if size > max_bytes then
+            remove = total - (i - 1)
+            break
+        end
+    end
+end
+if remove <= 0 then return {} end
+local ids = redis.call('ZRANGE', KEYS[2], 0, math.min(remove, tonumber(ARGV[4])) - 1)
+local records = redis.call('HMGET', KEYS[1], unpack(ids))
+local out = {}
+for i, id in ipairs(ids) do
+    out[#out + 1] = id
+    out[#out + 1] = records[i] or ''
+end
+return out
+"""
+
+REMOVE_MESSAGES_SCRIPT = """
+redis.call('ZREM', KEYS[2], unpack(ARGV))
+redis.call('HDEL', KEYS[1], unpack(ARGV))
+return 1
+"""
+
+# ARGV: field, expected value, new value triples. Skips fields that changed in the meantime
+REENCODE_RECORDS_SCRIPT = """
+local converted = 0
+for i = 1, #ARGV, 3 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+        converted = converted + 1
+    end
+end
+return converted
+"""
+
+# ARGV: id, score, record triples. Messages still stored are left alone
+RESTORE_MESSAGES_SCRIPT = """
+local restored = 0
+for i = 1, #ARGV, 3 do
+    if redis.call('HSETNX', KEYS[1], ARGV[i], ARGV[i + 2]) == 1 then
+        redis.call('ZADD', KEYS[2], ARGV[i + 1], ARGV[i])
+        restored = restored + 1
+    end
+end
+return restored
+"""
+
+LAST_MESSAGES_SCRIPT = """
+local ids = redis.call('ZRANGE', KEYS[2], -tonumber(ARGV[1]), -1)
+if #ids == 0 then return {} end
+local out = {}
+local records = redis.call('HMGET', KEYS[1], unpack(ids))
+for i, id in ipairs(ids) do
+    out[#out + 1] = id
+    out[#out + 1] = records[i]
+end
+return out
+"""
+
+MESSAGES_SINCE_SCRIPT = """
+-- Messages sharing since_id's millisecond: only the ones after it (ids compared as decimal strings,
+-- snowflakes don't fit a Lua number), then everything from the next millisecond on
+local ids = {}
+local since = ARGV[3]
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], ARGV[1], ARGV[1])) do
+    if #id > #since or (#id == #since and id > since) then
+        ids[#ids + 1] = id
+    end
+end
+local count = tonumber(ARGV[2])
+while #ids > count do table.remove(ids) end
+if #ids < count then
+    for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '(' .. ARGV[1], '+inf', 'LIMIT', 0, count - #ids)) do
+        ids[#ids + 1] = id
+    end
+end
+if #ids == 0 then return {} end
+local out = {}
+local records = redis.call('HMGET', KEYS[1], unpack(ids))
+for i, id in ipairs(ids) do
+    out[#out + 1] = id
+    out[#out + 1] = records[i]
+end
+return out
+"""
+
+UPDATE_RECORDS_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    if redis.call('HEXISTS', KEYS[1], ARGV[i]) == 1 then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+return 1
+"""
+
+_scripts = {}
+
+def _script(source: str):
+    # Register lazily against the current client so the SHA is only computed once per process
+    key = (id(context.redis), source)
+    if key not in _scripts:
+        _scripts[key] = context.redis.register_script(source)
+    return _scripts[key]
+
+
+def _decode_records(
+    message_ids: List[Union[int, str]], 
+    values: List[Optional[str]]
+) -> List[dict]:
+    records = []
+    for message_id, msg in zip(message_ids, values):
+        if not msg:
+            continue # index entry whose record is gone
+        records.append(decode_record(msg, message_id))
+    return records
+
+
+def build_message_record(
     message_id: Union[int, str], 
     message_content: str, 
     author: Union[discord.User, discord.Member], 
-    channel_id: Union[int, str], 
     attachments: Optional[List[discord.Attachment]] = []
-) -> None:
-    if not context.redis:
-        return None
-    
+) -> dict:
     # message_content = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') + '\n\n' + message_content + "\n\nSent by: " + str(author.name)
     
     payload = {
@@ -34,89 +203,251 @@ def save_message_redis(
         "author_name": author.name,
         "role": "assistant" if author.id == context.discord.user.id else "user",
         "content": message_content,
-        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "timestamp": snowflake_timestamp(message_id),
         "attachments": [a.url for a in attachments],
     }
-    context.redis.hset(
-        f"messages:{channel_id}",
-        message_id,
-        json.dumps(payload),
-    )
+    # Cache the token estimate of the formatted prompt entry on the record itself
+    payload["tokens"] = estimate_tokens(format_message(payload)["content"])
+    return payload
+
+
+async def save_message_redis(
+    message_id: Union[int, str], 
+    message_content: str, 
+    author: Union[discord.User, discord.Member], 
+    channel_id: Union[int, str], 
+    attachments: Optional[List[discord.Attachment]] = []
+) -> None:
+    if not context.redis:
+        return None
+    await save_message_records([(channel_id, build_message_record(message_id, message_content, author, attachments))])
+
+
+async def save_message_records(
+    batch: List[tuple]
+) -> None:
+    """Write (channel_id, record) pairs in order, pipelined into one round-trip when there are several."""
+    if not context.redis or not batch:
+        return None
+    archive = "1" if context.retention and context.retention.archive else "0"
+    save = _script(SAVE_MESSAGE_SCRIPT)
+    
+    def call(channel_id, payload, client=None):
+        # Record, index and cap enforcement in one atomic script per message
+        return save(
+            keys=[
+                f"messages:{channel_id}", f"history:{channel_id}", "history_caps",
+                f"archive_pending:{channel_id}", f"retention_hold:{channel_id}",
+            ],
+            args=[payload["id"], encode_record(payload), snowflake_to_ms(payload["id"]), context.history_max_messages, channel_id, archive],
+            client=client,
+        )
     
-def get_messages(
+    if len(batch) == 1:
+        await call(*batch[0])
+    else:
+        async with context.redis.pipeline(transaction=False) as pipe:
+            for channel_id, payload in batch:
+                await call(channel_id, payload, pipe)
+            await pipe.execute()
+    
+    for channel_id, payload in batch:
+        if context.history_cache:
+            context.history_cache.append(channel_id, _to_entry(payload))
+        if context.summarizer:
+            context.summarizer.mark(channel_id)
+        if context.retrieval:
+            # Embedded later in a background batch
+            context.retrieval.queue(channel_id, payload["id"], payload["content"])
+        if context.attachments and payload["attachments"]:
+            # Attachment URLs expire, fetch the images while they are valid
+            context.attachments.prefetch(payload["attachments"])
+
+
+async def get_last_messages(
+    channel_id: int, 
+    count: int
+) -> List[dict]:
+    """Newest `count` stored messages of a channel, oldest first."""
+    if not context.redis or count <= 0:
+        return []
+
+    values = await _script(LAST_MESSAGES_SCRIPT)(
+        keys=[f"messages:{channel_id}", f"history:{channel_id}"],
+        args=[count],
+    )
+    return _decode_records(values[::2], values[1::2])
+
+
+async def get_messages_since(
+    channel_id: int, 
+    since_id: Union[int, str], 
+    count: int = 100
+) -> List[dict]:
+    """Up to `count` stored messages newer than message `since_id`, oldest first."""
+    if not context.redis or count <= 0:
+        return []
+
+    since_id = int(since_id)
+    # Several messages can share the same millisecond; the script keeps only the ones after `since_id` there
+    values = await _script(MESSAGES_SINCE_SCRIPT)(
+        keys=[f"messages:{channel_id}", f"history:{channel_id}"],
+        args=[snowflake_to_ms(since_id), count, since_id],
+    )
+    return _decode_records(values[::2], values[1::2])
+
+
+def format_timestamp(
+    ts: Optional[str]
+) -> str:
+    if not ts:
+        return ""
+    try:
+        dt = datetime.datetime.fromisoformat(ts.replace("Z", ""))
+        return dt.strftime("%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return ts
+
+
+SYSTEM_INSTRUCTION = {
+    "role": "system",
+    "content": (
+        "Messages include metadata like timestamps and sender names. "
+        "Ignore metadata in your reasoning unless it directly affects the prompt."
+        "Respond normally as plain text. "
+        "Do not include timestamps or author tags in your reply."
+    )
+}
+
+
+def format_summary(
+    summary: dict
+) -> dict:
+    return {
+        "role": "system",
+        "content": f"Summary of the earlier conversation in this channel:\n{summary['text']}"
+    }
+
+
+def format_message(
+    record: dict
+) -> dict:
+    ts_str = format_timestamp(record.get("timestamp"))
+    return {
+        "role": record["role"],
+        "content": f"{ts_str} {record['content']}\n\nSent by: {record['author_name']}"
+    }
+
+
+def _to_entry(
+    record: dict
+) -> dict:
+    entry = format_message(record)
+    entry["id"] = record["id"]
+    entry["tokens"] = record.get("tokens")
+    images = [url for url in record.get("attachments") or () if is_image_url(url)]
+    if images:
+        # Attached by the prompt builder for vision models
+        entry["images"] = images
+    return entry
+
+
+async def get_formatted_messages(
+    channel_id: int, 
+    message_ids: List[int]
+) -> List[dict]:
+    """Prompt entries for specific messages, in the given order. Messages that are gone are skipped."""
+    if not context.redis or not message_ids:
+        return []
+    values = await context.redis.hmget(f"messages:{channel_id}", [str(mid) for mid in message_ids])
+    return [_to_entry(record) for record in _decode_records(message_ids, values)]
+
+
+async def get_formatted_history(
+    channel_id: int
+) -> List[dict]:
+    """Recent history as prompt entries ({id, role, content, tokens}), oldest first."""
+    if context.history_cache:
+        cached = context.history_cache.get(channel_id)
+        if cached is not None:
+            return cached
+
+    if context.history_cache:
+        context.history_cache.begin_load(channel_id)
+    entries = None
+    try:
+        raw = await get_last_messages(channel_id, context.history_window)
+
+        entries = []
+        backfill = {}
+        for m in raw:
+            entry = _to_entry(m)
+            if entry["tokens"] is None:
+                # Stored before token estimates were cached on the record; measure once and write it back
+                entry["tokens"] = m["tokens"] = estimate_tokens(entry["content"])
+                backfill[m["id"]] = encode_record(m)
+            entries.append(entry)
+
+        if backfill:
+            # Only rewrite records that still exist, a concurrent save may have trimmed them
+            await _script(UPDATE_RECORDS_SCRIPT)(
+                keys=[f"messages:{channel_id}"],
+                args=[v for pair in backfill.items() for v in pair],
+            )
+    finally:
+        if context.history_cache:
+            context.history_cache.end_load(channel_id, entries)
+    return entries
+
+
+async def get_messages(
     message:discord.Message, 
     format: bool = False
 ) -> List[dict]:
     if not context.redis:
         return [{"role": "assistant" if message.author.id == context.discord.user.id else "user", "content": message.content}]
 
-    # Read stored messages
-    raw = []
-    for msg in context.redis.hvals(f"messages:{message.channel.id}"):
-        if isinstance(msg, bytes):
-            msg = msg.decode()
-        raw.append(json.loads(msg))
-
     if not format:
-        return raw
-    
-    # # Sort by timestamp
-    # raw.sort(key=lambda m: m.get("timestamp", ""))
-
-    formatted = []
-    for m in raw:
-        ts = m.get("timestamp")
-        if ts:
-            try:
-                dt = datetime.fromisoformat(ts.replace("Z", ""))
-                ts_str = dt.strftime("%Y-%m-%d %H:%M:%S")
-            except:
-                ts_str = ts
-        else:
-            ts_str = ""
-
-        formatted.append({
-            "role": m["role"],
-            "content": f"{ts_str} {m['content']}\n\nSent by: {m["author_name"]}"
-        })
-        ## TODO: Take the attachments in the stored messages: "attachments": [a.url for a in attachments]
-        ##          Check if any of them are images.
-        ##          If they are images, we can include it in the chat using `images` argument
-
-    system_instruction = {
-        "role": "system",
-        "content": (
-            "Messages include metadata like timestamps and sender names. "
-            "Ignore metadata in your reasoning unless it directly affects the prompt."
-            "Respond normally as plain text. "
-            "Do not include timestamps or author tags in your reply."
-        )
-    }
-    return [system_instruction] + formatted
+        # Read the most recent window of stored messages, already in chronological order
+        return await get_last_messages(message.channel.id, context.history_window)
+
+    entries = await get_formatted_history(message.channel.id)
+    header = [SYSTEM_INSTRUCTION]
+    summary = await context.summarizer.summary_for(message.channel.id) if context.summarizer else None
+    if summary:
+        # Older turns are represented by the rolling summary
+        header.append(format_summary(summary))
+        entries = [e for e in entries if int(e["id"]) > summary["upto"]]
+
+    formatted = [
+        {"role": e["role"], "content": e["content"]}
+        for e in entries
+    ]
+    return header + formatted
         
         
-def get_message(
+async def get_message(
     channel_id: int, 
     message_id: int
 ) -> Optional[StoredMessageData]:
     if not context.redis:
         return None
 
-    msg_json = context.redis.hget(f"messages:{channel_id}", message_id)
+    msg_json = await context.redis.hget(f"messages:{channel_id}", message_id)
     if msg_json:
-        return json.loads(msg_json)
+        return decode_record(msg_json, message_id)
     
     return None
 
 
-def get_all_message_ids(
+async def get_all_message_ids(
     channel_id: int
 ) -> List[str]:
     if not context.redis:
         return []
 
-    # Get all fields (message IDs) in the hash
-    message_ids = context.redis.hkeys(f"messages:{channel_id}")
+    # Message IDs in chronological order
+    message_ids = await context.redis.zrange(f"history:{channel_id}", 0, -1)
     
     # If your Redis client returns bytes, decode to str
     message_ids = [mid.decode() if isinstance(mid, bytes) else str(mid) for mid in message_ids]
@@ -124,101 +455,322 @@ def get_all_message_ids(
     return message_ids
 
 
-def delete_messages(
+async def delete_messages(
     channel_id: int
 ) -> bool:
     if not context.redis:
         return False
 
-    deleted = context.redis.delete(f"messages:{channel_id}")
+    if context.ingest:
+        context.ingest.discard(channel_id)
+        await context.ingest.flush(channel_id) # waits for a write already in flight
+    deleted = await context.redis.delete(
+        f"messages:{channel_id}", f"history:{channel_id}", f"summary:{channel_id}",
+        f"archive_pending:{channel_id}", f"retention_hold:{channel_id}",
+    )
+    if context.history_cache:
+        context.history_cache.invalidate(channel_id)
+    if context.prefix_tracker:
+        context.prefix_tracker.reset(channel_id)
+    if context.summarizer:
+        context.summarizer.invalidate(channel_id)
+    if context.response_cache:
+        await context.response_cache.invalidate_channel(channel_id)
+    if context.retrieval:
+        await context.retrieval.forget(channel_id)
+    if context.retention:
+        # A wipe also drops the channel's archive
+        await context.retention.forget(channel_id)
     return bool(deleted)
 
 
+async def get_nth_newest_id(
+    channel_id: int, 
+    n: int
+) -> Optional[int]:
+    """ID of the n-th newest stored message (1 = newest), None if the channel has fewer."""
+    if not context.redis or n <= 0:
+        return None
+    ids = await context.redis.zrevrange(f"history:{channel_id}", n - 1, n - 1)
+    return int(ids[0]) if ids else None
 
-    
-def is_superadmin(
-    user_id: int
-) -> bool:
-    if context.super_admin_ids is not None:
-        super_admin_ids = [int(id.strip()) for id in context.super_admin_ids.split(",")]
-        if (user_id in super_admin_ids):
-            return True
-        
-    if context.redis:
-        if context.redis.sismember(f"super_admins", str(user_id)):
-            return True
-    return False
 
-def add_super_admin(
-    user_id: int
+async def get_summary(
+    channel_id: int
+) -> Optional[dict]:
+    if not context.redis:
+        return None
+    data = await context.redis.hgetall(f"summary:{channel_id}")
+    if not data or "text" not in data:
+        return None
+    return {"text": data["text"], "upto": int(data["upto"])}
+
+
+async def save_summary(
+    channel_id: int, 
+    text: str, 
+    upto: int
+) -> None:
+    if not context.redis:
+        return None
+    await context.redis.hset(f"summary:{channel_id}", mapping={
+        "text": text,
+        "upto": upto,
+        "updated": datetime.datetime.utcnow().isoformat(),
+    })
+
+
+async def get_expired_messages(
+    channel_id: int, 
+    cutoff_ms: int = 0, 
+    max_count: int = 0, 
+    max_bytes: int = 0, 
+    batch: int = 500
+) -> List[tuple]:
+    """(id, record) of the oldest messages outside the policy, oldest first. 0 disables a limit."""
+    if not context.redis:
+        return []
+    values = await _script(EXPIRED_MESSAGES_SCRIPT)(
+        keys=[f"messages:{channel_id}", f"history:{channel_id}"],
+        args=[cutoff_ms, max_count, max_bytes, batch],
+    )
+    return [(int(mid), decode_record(raw, mid) if raw else None) for mid, raw in zip(values[::2], values[1::2])]
+
+
+async def remove_messages(
+    channel_id: int, 
+    message_ids: List[Union[int, str]]
+) -> None:
+    if not context.redis or not message_ids:
+        return None
+    await _script(REMOVE_MESSAGES_SCRIPT)(
+        keys=[f"messages:{channel_id}", f"history:{channel_id}"],
+        args=list(message_ids),
+    )
+    if context.history_cache:
+        context.history_cache.invalidate(channel_id)
+
+
+async def restore_messages(
+    channel_id: int, 
+    records: List[dict]
+) -> int:
+    """Put archived records back into the history. Returns how many were missing and restored."""
+    if not context.redis or not records:
+        return 0
+    restored = 0
+    for start in range(0, len(records), 500):
+        args = []
+        for record in records[start:start + 500]:
+            args.extend([record["id"], snowflake_to_ms(record["id"]), encode_record(record)])
+        restored += await _script(RESTORE_MESSAGES_SCRIPT)(
+            keys=[f"messages:{channel_id}", f"history:{channel_id}"],
+            args=args,
+        )
+    if context.history_cache:
+        context.history_cache.invalidate(channel_id)
+    if context.prefix_tracker:
+        context.prefix_tracker.reset(channel_id)
+    return restored
+
+
+async def get_trimmed_records(
+    channel_id: int, 
+    count: int = 500
+) -> List[dict]:
+    """Records the cap trimmed, oldest first. They stay queued until `ack_trimmed_records`."""
+    if not context.redis:
+        return []
+    entries = await context.redis.lrange(f"archive_pending:{channel_id}", 0, count - 1)
+    records = []
+    for entry in entries:
+        message_id, _, raw = entry.partition(":")
+        records.append(decode_record(raw, message_id))
+    return records
+
+
+async def ack_trimmed_records(
+    channel_id: int, 
+    count: int
+) -> None:
+    if context.redis and count:
+        await context.redis.ltrim(f"archive_pending:{channel_id}", count, -1)
+
+
+async def reencode_channel(
+    channel_id: int, 
+    batch: int = 200
+) -> dict:
+    """Rewrite a channel's older records in the current encoding. Returns counts and string bytes before/after."""
+    result = {"records": 0, "converted": 0, "bytes_before": 0, "bytes_after": 0}
+    if not context.redis:
+        return result
+    key = f"messages:{channel_id}"
+    cursor = 0
+    while True:
+        cursor, values = await context.redis.hscan(key, cursor, count=batch)
+        args = []
+        for message_id, raw in values.items():
+            result["records"] += 1
+            result["bytes_before"] += len(raw.encode())
+            if record_version(raw) == RECORD_VERSION:
+                result["bytes_after"] += len(raw.encode())
+                continue
+            encoded = encode_record(decode_record(raw, message_id))
+            result["bytes_after"] += len(encoded.encode())
+            args.extend([message_id, raw, encoded])
+        if args:
+            result["converted"] += await _script(REENCODE_RECORDS_SCRIPT)(keys=[key], args=args)
+        if cursor == 0:
+            return result
+        await asyncio.sleep(0.01) # leave room for the bot's own commands
+
+
+async def reencode_history() -> None:
+    """Background pass converting every stored record to RECORD_VERSION, skipped once it has completed."""
+    if not context.redis:
+        return None
+    try:
+        if await context.redis.get("record_encoding") == str(RECORD_VERSION):
+            return None
+        totals = {"records": 0, "converted": 0, "bytes_before": 0, "bytes_after": 0}
+        for channel_id in await get_channel_ids("messages"):
+            for k, v in (await reencode_channel(channel_id)).items():
+                totals[k] += v
+        await context.redis.set("record_encoding", RECORD_VERSION)
+        if totals["converted"]:
+            logging.info(
+                f"Re-encoded {totals['converted']} of {totals['records']} stored messages to v{RECORD_VERSION}: "
+                f"{totals['bytes_before'] / max(totals['records'], 1):.0f} -> "
+                f"{totals['bytes_after'] / max(totals['records'], 1):.0f} bytes per record"
+            )
+    except Exception:
+        logging.error("Error re-encoding stored messages", exc_info=True)
+
+
+async def get_history_usage(
+    channel_id: int
+) -> dict:
+    if not context.redis:
+        return {"count": 0, "oldest": None}
+    count = await context.redis.zcard(f"history:{channel_id}")
+    oldest = await context.redis.zrange(f"history:{channel_id}", 0, 0)
+    return {"count": count, "oldest": int(oldest[0]) if oldest else None}
+
+
+async def get_channel_ids(
+    prefix: str = "history"
+) -> List[int]:
+    """Channels that have a `{prefix}:{channel_id}` key."""
+    if not context.redis:
+        return []
+    channel_ids = []
+    async for key in context.redis.scan_iter(match=f"{prefix}:*", count=500):
+        key = key.decode() if isinstance(key, bytes) else key
+        suffix = key.split(":", 1)[1]
+        if suffix.isdigit():
+            channel_ids.append(int(suffix))
+    return channel_ids
+
+
+async def get_retention_policies() -> dict:
+    """Guild/channel id => policy dict."""
+    if not context.redis:
+        return {}
+    data = await context.redis.hgetall("retention_policies")
+    return {int(k): json.loads(v) for k, v in data.items()}
+
+
+async def set_retention_policy(
+    scope_id: int, 
+    policy: Optional[dict]
 ) -> bool:
     if not context.redis:
         return False
-    
-    exists = context.redis.sismember("super_admins", str(user_id))
-    if exists:
-        return True
-    
-    context.redis.sadd("super_admins", str(user_id))
+    if policy is None:
+        await context.redis.hdel("retention_policies", str(scope_id))
+    else:
+        await context.redis.hset("retention_policies", str(scope_id), json.dumps(policy))
     return True
 
-def remove_super_admin(
-    user_id: int
+
+async def set_retention_hold(
+    channel_id: int, 
+    seconds: int
+) -> None:
+    if context.redis and seconds > 0:
+        await context.redis.set(f"retention_hold:{channel_id}", 1, ex=seconds)
+
+
+async def is_retention_held(
+    channel_id: int
 ) -> bool:
     if not context.redis:
         return False
-    
-    exists = context.redis.sismember("super_admins", str(user_id))
-    if not exists:
-        return True  # not present
-    
-    context.redis.srem("super_admins", str(user_id))
+    return bool(await context.redis.exists(f"retention_hold:{channel_id}"))
+
+
+async def get_history_cap(
+    channel_id: int
+) -> Optional[int]:
+    """The channel's own cap, None if it uses context.history_max_messages."""
+    if not context.redis:
+        return None
+    cap = await context.redis.hget("history_caps", str(channel_id))
+    return int(cap) if cap is not None else None
+
+
+async def set_history_cap(
+    channel_id: int, 
+    cap: Optional[int]
+) -> bool:
+    if not context.redis:
+        return False
+
+    if cap is None:
+        await context.redis.hdel("history_caps", str(channel_id))
+    else:
+        await context.redis.hset("history_caps", str(channel_id), int(cap))
     return True
 
 
+
+    
+def is_superadmin(
+    user_id: int
+) -> bool:
+    return context.authz.is_superadmin(user_id)
+
+async def add_super_admin(
+    user_id: int
+) -> bool:
+    return await _add_authz_member("super_admins", user_id)
+
+async def remove_super_admin(
+    user_id: int
+) -> bool:
+    return await _remove_authz_member("super_admins", user_id)
+
+
     
     
 def is_admin(
     user_id: int, 
     guild_id: int = None
 ) -> bool:
-    superadmin_check = is_superadmin(user_id)
-    if superadmin_check:
-        return True
-    
-    if context.redis and guild_id is not None:
-        if context.redis.sismember(f"admins:{guild_id}", str(user_id)):
-            return True
-    
-    return False
+    return context.authz.is_admin(user_id, guild_id)
 
-def add_server_admin(
+async def add_server_admin(
     user_id: int, 
     guild_id: int
 ) -> bool:
-    if not context.redis:
-        return False
-    
-    exists = context.redis.sismember(f"admins:{guild_id}", str(user_id))
-    if exists:
-        return True
-    
-    context.redis.sadd(f"admins:{guild_id}", str(user_id))
-    return True
+    return await _add_authz_member(f"admins:{guild_id}", user_id)
 
-def remove_server_admin(
+async def remove_server_admin(
     user_id: int, 
     guild_id: int
 ) -> bool:
-    if not context.redis:
-        return False
-    
-    exists = context.redis.sismember(f"admins:{guild_id}", str(user_id))
-    if not exists:
-        return True  # not present
-        
-    context.redis.srem(f"admins:{guild_id}", str(user_id))
-    return True
+    return await _remove_authz_member(f"admins:{guild_id}", user_id)
 
 
 
@@ -226,42 +778,17 @@ def remove_server_admin(
 def is_dm_allowed(
     user_id: int
 ) -> bool:
-    admin_check = is_admin(user_id)
-    if admin_check:
-        return True
-    
-    
-    if context.redis:
-        if context.redis.sismember(f"dm_whitelist", str(user_id)):
-            return True
-    
-    return False
+    return context.authz.is_dm_allowed(user_id)
 
-def add_dm_whitelist(
+async def add_dm_whitelist(
     user_id: int
 ) -> bool:
-    if not context.redis:
-        return False
-    
-    exists = context.redis.sismember("dm_whitelist", str(user_id))
-    if exists:
-        return True
-    
-    context.redis.sadd("dm_whitelist", str(user_id))
-    return True
+    return await _add_authz_member("dm_whitelist", user_id)
 
-def remove_dm_whitelist(
+async def remove_dm_whitelist(
     user_id: int
 ) -> bool:
-    if not context.redis:
-        return False
-    
-    exists = context.redis.sismember("dm_whitelist", str(user_id))
-    if not exists:
-        return True  # not present
-    
-    context.redis.srem("dm_whitelist", str(user_id))
-    return True
+    return await _remove_authz_member("dm_whitelist", user_id)
     
     
     
@@ -269,42 +796,55 @@ def remove_dm_whitelist(
 def is_trusted_server(
     server_id: int
 ) -> bool:
-    if context.discord_server_ids is not None:
-        discord_server_ids = [int(id.strip()) for id in context.discord_server_ids.split(",")]
-        if (server_id in discord_server_ids):
-            return True
-    
-    if context.redis:
-        if context.redis.sismember(f"trusted_servers", str(server_id)):
-            return True
-        
-    return False
+    return context.authz.is_trusted_server(server_id)
 
-def add_trusted_server(
+async def add_trusted_server(
+    server_id: int
+) -> bool:
+    return await _add_authz_member("trusted_servers", server_id)
+        
+async def remove_trusted_server(
     server_id: int
+) -> bool:
+    return await _remove_authz_member("trusted_servers", server_id)
+
+
+async def _add_authz_member(
+    key: str, 
+    member: int
 ) -> bool:
     if not context.redis:
         return False
     
-    exists = context.redis.sismember("trusted_servers", str(server_id))
-    if exists:
-        return True
-    
-    context.redis.sadd("trusted_servers", str(server_id))
+    await context.redis.sadd(key, str(member))
+    await context.authz.publish("add", key, member)
     return True
-        
-def remove_trusted_server(
-    server_id: int
+
+async def _remove_authz_member(
+    key: str, 
+    member: int
 ) -> bool:
     if not context.redis:
         return False
+    
+    await context.redis.srem(key, str(member))
+    await context.authz.publish("remove", key, member)
+    return True
 
-    exists = context.redis.sismember("trusted_servers", str(server_id))
-    if not exists:
-        return True
 
-    context.redis.srem("trusted_servers", str(server_id))
-    return True
+
+
+async def add_ingest_rule(
+    rule: str, 
+    scope_id: int
+) -> bool:
+    return await _add_authz_member(f"ingest:{rule}", scope_id)
+
+async def remove_ingest_rule(
+    rule: str, 
+    scope_id: int
+) -> bool:
+    return await _remove_authz_member(f"ingest:{rule}", scope_id)
 
 
 
@@ -341,24 +881,47 @@ def remove_trusted_server(
         
 
 
-def set_current_model(
+async def set_current_model(
     channel_id:int, 
     new_model:str
 ) -> bool:
     if context.redis:
-        context.redis.set(f"model:{channel_id}", new_model)
+        await context.redis.set(f"model:{channel_id}", new_model)
         return True
     
     return False
 
-def get_current_model(
+async def get_current_model(
     channel_id:int
 ) -> str:
     if context.redis:
-        model = context.redis.get(f"model:{channel_id}")
+        model = await context.redis.get(f"model:{channel_id}")
         if model:
             if isinstance(model, bytes):
                 model = model.decode()
             return model
     
-    return context.llama_default_model
\ No newline at end of file
+    return context.llama_default_model
+
+async def set_latest_wins(
+    channel_id:int, 
+    enabled:bool
+) -> bool:
+    if context.redis:
+        await context.redis.set(f"latest_wins:{channel_id}", "1" if enabled else "0")
+        return True
+    
+    return False
+
+async def get_latest_wins(
+    channel_id:int
+) -> bool:
+    """Whether a new mention cancels the same user's still running answer in this channel."""
+    if context.redis:
+        value = await context.redis.get(f"latest_wins:{channel_id}")
+        if value is not None:
+            if isinstance(value, bytes):
+                value = value.decode()
+            return value == "1"
+    
+    return context.latest_mention_wins
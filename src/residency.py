@@ -0,0 +1,156 @@
+## Model residency manager.
+## Resolves which model a channel uses (cached, so the hot path doesn't hit redis), preloads models
+## on `/model set` and at startup, picks a keep_alive per model from its recent traffic, and keeps
+## at most `max_large_resident` large models loaded per host by unloading the least recently used.
+## Load/unload events come from the pool's /api/ps probes, cold starts from `load_duration` in the
+## final part of each answer.
+import time
+import asyncio
+import logging
+from collections import OrderedDict, defaultdict, deque
+from typing import Deque, Dict, Optional
+import context
+from src.redis_conn import get_current_model
+
+CHANNEL_CACHE_SIZE = 4096
+TRAFFIC_SAMPLES = 50
+COLD_START_SECONDS = 1.0
+
+
+class ModelResidency:
+    def __init__(self, 
+                 min_keep_alive: float = 300, 
+                 max_keep_alive: float = 3600, 
+                 max_large_resident: int = 1, 
+                 large_model_bytes: int = 8 * 1024 ** 3):
+        self.min_keep_alive: float = min_keep_alive
+        self.max_keep_alive: float = max_keep_alive
+        self.max_large_resident: int = max_large_resident
+        self.large_model_bytes: int = large_model_bytes
+
+        self.channel_models: "OrderedDict[int, str]" = OrderedDict()
+        self.requests: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=TRAFFIC_SAMPLES))
+        self.last_used: Dict[tuple, float] = {} # (backend, model) -> time
+
+        self.loads: Dict[str, int] = defaultdict(int)
+        self.unloads: Dict[str, int] = defaultdict(int)
+        self.cold_starts: Dict[str, int] = defaultdict(int)
+        self.load_seconds: Dict[str, float] = defaultdict(float)
+
+    ## Channel -> model
+
+    async def model_for(self, channel_id: int) -> str:
+        model = self.channel_models.get(channel_id)
+        if model is None:
+            model = await get_current_model(channel_id)
+            self.channel_models[channel_id] = model
+            if len(self.channel_models) > CHANNEL_CACHE_SIZE:
+                self.channel_models.popitem(last=False)
+        else:
+            self.channel_models.move_to_end(channel_id)
+        return model
+
+    def set_channel_model(self, channel_id: int, model: str) -> None:
+        self.channel_models[channel_id] = model
+        self.channel_models.move_to_end(channel_id)
+
+    ## keep_alive policy
+
+    def keep_alive(self, model: str) -> float:
+        """Keep a model loaded for ~3 of its typical gaps between requests, within [min, max]."""
+        times = self.requests.get(model)
+        if not times or len(times) < 2:
+            return self.min_keep_alive
+        gaps = sorted(b - a for a, b in zip(times, list(times)[1:]))
+        typical = gaps[min(int(len(gaps) * 0.9), len(gaps) - 1)]
+        return max(self.min_keep_alive, min(self.max_keep_alive, 3 * typical))
+
+    def record_request(self, model: str, backend: Optional[str] = None) -> None:
+        now = time.time()
+        self.requests[model].append(now)
+        if backend:
+            self.last_used[(backend, model)] = now
+
+    def record_done(self, model: str, part) -> None:
+        # load_duration is in nanoseconds; anything above a second means the model wasn't resident
+        load_seconds = (part.get('load_duration') or 0) / 1e9
+        if load_seconds >= COLD_START_SECONDS:
+            self.cold_starts[model] += 1
+            self.load_seconds[model] += load_seconds
+            if context.metrics:
+                context.metrics.cold_starts.inc(model=model)
+            logging.info(f"Cold start of {model}: {load_seconds:.1f}s load")
+
+    ## Residency
+
+    def is_large(self, backend, model: str) -> bool:
+        return backend.model_sizes.get(model, 0) >= self.large_model_bytes
+
+    async def prepare(self, model: str, backend_name: Optional[str]) -> None:
+        """Make room for `model` on a host before it gets loaded there."""
+        backend = context.llama.by_name.get(backend_name) if backend_name else None
+        if backend is None or model in backend.loaded or not self.is_large(backend, model):
+            return
+        resident = [m for m in backend.loaded if m != model and self.is_large(backend, m)]
+        while len(resident) >= self.max_large_resident > 0:
+            victim = min(resident, key=lambda m: self.last_used.get((backend.name, m), 0))
+            resident.remove(victim)
+            await self.unload(victim, backend.name)
+
+    async def unload(self, model: str, backend_name: str) -> None:
+        try:
+            await context.llama.generate(model=model, prompt='', keep_alive=0, backend=backend_name)
+            backend = context.llama.by_name.get(backend_name)
+            if backend is not None:
+                backend.loaded.discard(model)
+            logging.info(f"Unloaded {model} from {backend_name} to make room")
+        except Exception:
+            logging.error(f"Error unloading {model} from {backend_name}", exc_info=True)
+
+    async def preload(self, model: str) -> None:
+        backend = context.llama.pick(model)
+        if backend is None or model in backend.loaded:
+            return
+        try:
+            await self.prepare(model, backend.name)
+            await context.llama.generate(model=model, prompt='', keep_alive=self.keep_alive(model), backend=backend.name)
+            self.last_used[(backend.name, model)] = time.time()
+            logging.info(f"Preloaded {model} on {backend.name}")
+        except Exception:
+            logging.error(f"Error preloading {model}", exc_info=True)
+
+    async def preload_startup(self) -> None:
+        models = [context.llama_default_model]
+        if context.redis:
+            async for key in context.redis.scan_iter(match="model:*", count=500):
+                model = await context.redis.get(key)
+                if model and model not in models:
+                    models.append(model)
+        # Default model first; the large model cap decides how many of the rest actually stay
+        for model in models:
+            await self.preload(model)
+
+    def on_probe(self, backend, before: set, after: set) -> None:
+        for model in after - before:
+            self.loads[model] += 1
+            if context.metrics:
+                context.metrics.model_loads.inc(model=model, host=backend.name)
+            logging.info(f"Model {model} loaded on {backend.name}")
+        for model in before - after:
+            self.unloads[model] += 1
+            if context.metrics:
+                context.metrics.model_unloads.inc(model=model, host=backend.name)
+            logging.info(f"Model {model} unloaded from {backend.name}")
+
+    def stats(self) -> Dict[str, dict]:
+        models = set(self.loads) | set(self.unloads) | set(self.cold_starts) | set(self.requests)
+        return {
+            model: {
+                "loads": self.loads.get(model, 0),
+                "unloads": self.unloads.get(model, 0),
+                "cold_starts": self.cold_starts.get(model, 0),
+                "cold_start_seconds": round(self.load_seconds.get(model, 0.0), 1),
+                "keep_alive": self.keep_alive(model),
+            }
+            for model in sorted(models)
+        }
@@ -0,0 +1,139 @@
+## Exact-match response cache (opt-in, RESPONSE_CACHE=true).
+## Support channels see the same questions over and over; a finished answer is stored under a hash of
+## the model, the options and the normalized prompt messages (plus a hash of each attached image), so an
+## identical prompt is answered from redis instead of a new generation. Normalizing drops the timestamp and sender metadata, which
+## differ on every message but don't change the question.
+##  - rcache:{scope}:{hash}     cached answer, expires after `ttl`
+##  - rcache_index:{scope}      zset of cached hashes by store time, trimmed to `max_entries`
+##  - rcache_channel:{cid}      keys stored from a channel, so /wipe can drop them
+import re
+import json
+import time
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional
+import discord
+import context
+
+# Matches format_message(): "<timestamp> <content>\n\nSent by: <author>"
+TIMESTAMP_PREFIX = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} ")
+SENDER_SUFFIX = re.compile(r"\n\nSent by: [^\n]*$")
+WHITESPACE = re.compile(r"\s+")
+
+PUT_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[3]) - tonumber(ARGV[2]))
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+redis.call('SADD', KEYS[3], KEYS[1])
+redis.call('EXPIRE', KEYS[3], ARGV[2])
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+    local old = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+    redis.call('DEL', unpack(old))
+end
+return excess
+"""
+
+INVALIDATE_SCRIPT = """
+local keys = redis.call('SMEMBERS', KEYS[1])
+for _, key in ipairs(keys) do
+    redis.call('DEL', key)
+    redis.call('ZREM', 'rcache_index:' .. string.match(key, '^rcache:(.*):[^:]+$'), key)
+end
+redis.call('DEL', KEYS[1])
+return #keys
+"""
+
+
+def normalize_content(
+    content: str
+) -> str:
+    content = TIMESTAMP_PREFIX.sub("", content)
+    content = SENDER_SUFFIX.sub("", content)
+    return WHITESPACE.sub(" ", content).strip().casefold()
+
+
+def fingerprint(
+    model: str,
+    options: Optional[Dict[str, Any]],
+    messages: List[dict]
+) -> str:
+    normalized = []
+    for m in messages:
+        entry = [m["role"], normalize_content(m["content"])]
+        if m.get("images"):
+            # The text is the same whichever image is attached, the answer isn't
+            entry.append([hashlib.sha256(image.encode("ascii")).hexdigest() for image in m["images"]])
+        normalized.append(entry)
+    payload = json.dumps([model, options or {}, normalized], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, ttl: int = 86400, max_entries: int = 10000, scope: str = "guild"):
+        self.ttl: int = ttl
+        self.max_entries: int = max_entries
+        self.scope: str = scope # "guild" or "global"
+        self.scripts: Dict[str, Any] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+        self.stores: int = 0
+        self.evictions: int = 0
+
+    def _script(self, source: str):
+        script = self.scripts.get(source)
+        if script is None:
+            script = self.scripts[source] = context.redis.register_script(source)
+        return script
+
+    def scope_of(self, message: discord.Message) -> str:
+        if self.scope == "global":
+            return "global"
+        if message.guild is not None:
+            return f"guild:{message.guild.id}"
+        return f"dm:{message.channel.id}"
+
+    async def get(self, message: discord.Message, key: str) -> Optional[str]:
+        if not context.redis:
+            return None
+        try:
+            text = await context.redis.get(f"rcache:{self.scope_of(message)}:{key}")
+        except Exception:
+            logging.error("Error reading response cache", exc_info=True)
+            text = None
+        if text:
+            self.hits += 1
+            return text.decode() if isinstance(text, bytes) else text
+        self.misses += 1
+        return None
+
+    async def put(self, message: discord.Message, key: str, text: str) -> None:
+        if not context.redis or not text.strip():
+            return
+        scope = self.scope_of(message)
+        try:
+            excess = await self._script(PUT_SCRIPT)(
+                keys=[f"rcache:{scope}:{key}", f"rcache_index:{scope}", f"rcache_channel:{message.channel.id}"],
+                args=[text, self.ttl, time.time(), self.max_entries],
+            )
+        except Exception:
+            logging.error("Error writing response cache", exc_info=True)
+            return
+        self.stores += 1
+        self.evictions += max(int(excess), 0)
+
+    async def invalidate_channel(self, channel_id: int) -> int:
+        if not context.redis:
+            return 0
+        return int(await self._script(INVALIDATE_SCRIPT)(keys=[f"rcache_channel:{channel_id}"]))
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,245 @@
+## Channel history retention and cold archive.
+## A background sweeper enforces per guild/channel policies (max age, max count, max bytes) on the stored
+## history. Messages that fall outside a policy, and the ones the per-channel cap trims on save, are moved to
+## an append-only archive on disk before they are removed from redis: gzip-compressed NDJSON segments under
+## `directory/<channel_id>/` holding full (v1 shaped) records, one gzip member per write, so a crash can at
+## worst leave a record both archived and still stored. `/retention action:restore` brings an archived range back into redis.
+import os
+import re
+import gzip
+import json
+import time
+import asyncio
+import logging
+import datetime
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional
+import context
+from src.redis_conn import (
+    snowflake_to_ms,
+    get_channel_ids,
+    get_expired_messages,
+    remove_messages,
+    restore_messages,
+    get_trimmed_records,
+    ack_trimmed_records,
+    get_retention_policies,
+    set_retention_hold,
+    is_retention_held
+)
+
+SEGMENT_NAME = re.compile(r"^(\d+)\.ndjson\.gz$")
+
+
+@dataclass
+class RetentionPolicy:
+    max_age_days: float = 0 # 0 = no limit
+    max_count: int = 0
+    max_bytes: int = 0
+
+    def merged(self, override: Optional[dict]) -> "RetentionPolicy":
+        """This policy with the fields set in `override` replaced."""
+        if not override:
+            return self
+        values = asdict(self)
+        values.update({k: v for k, v in override.items() if k in values and v is not None})
+        return RetentionPolicy(**values)
+
+    def is_empty(self) -> bool:
+        return not (self.max_age_days or self.max_count or self.max_bytes)
+
+    def describe(self) -> str:
+        if self.is_empty():
+            return "keep everything"
+        parts = []
+        if self.max_age_days:
+            parts.append(f"{self.max_age_days:g} days")
+        if self.max_count:
+            parts.append(f"{self.max_count} messages")
+        if self.max_bytes:
+            parts.append(f"{self.max_bytes / 1024 / 1024:.1f} MB")
+        return ", ".join(parts)
+
+
+class HistoryArchive:
+    """Append-only compressed NDJSON segments per channel. Blocking, call through asyncio.to_thread."""
+
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024):
+        self.directory: str = directory
+        self.segment_bytes: int = segment_bytes
+
+    def _channel_dir(self, channel_id: int) -> str:
+        return os.path.join(self.directory, str(channel_id))
+
+    def segments(self, channel_id: int) -> List[str]:
+        """Segment paths of a channel, oldest first."""
+        directory = self._channel_dir(channel_id)
+        if not os.path.isdir(directory):
+            return []
+        found = []
+        for name in os.listdir(directory):
+            match = SEGMENT_NAME.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(directory, name)))
+        return [path for _, path in sorted(found)]
+
+    def append(self, channel_id: int, records: List[dict]) -> None:
+        if not records:
+            return
+        segments = self.segments(channel_id)
+        if segments and os.path.getsize(segments[-1]) < self.segment_bytes:
+            path = segments[-1]
+        else:
+            os.makedirs(self._channel_dir(channel_id), exist_ok=True)
+            number = int(SEGMENT_NAME.match(os.path.basename(segments[-1])).group(1)) + 1 if segments else 1
+            path = os.path.join(self._channel_dir(channel_id), f"{number:06d}.ndjson.gz")
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+        with open(path, "ab") as f:
+            f.write(gzip.compress(data))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self, channel_id: int, since_ms: int = 0, until_ms: Optional[int] = None) -> List[dict]:
+        """Archived records whose message time is in [since_ms, until_ms), oldest first, without duplicates."""
+        records: Dict[int, dict] = {}
+        for path in self.segments(channel_id):
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    record = json.loads(line)
+                    ms = snowflake_to_ms(record["id"])
+                    if ms >= since_ms and (until_ms is None or ms < until_ms):
+                        records[int(record["id"])] = record
+        return [records[mid] for mid in sorted(records)]
+
+    def usage(self, channel_id: int) -> dict:
+        segments = self.segments(channel_id)
+        return {"segments": len(segments), "bytes": sum(os.path.getsize(p) for p in segments)}
+
+    def forget(self, channel_id: int) -> None:
+        for path in self.segments(channel_id):
+            os.remove(path)
+
+
+class RetentionSweeper:
+    def __init__(
+        self,
+        archive: HistoryArchive,
+        default: RetentionPolicy,
+        interval: float = 3600,
+        batch: int = 500,
+        hold_seconds: int = 86400,
+        archive_enabled: bool = True
+    ):
+        self.store: HistoryArchive = archive
+        self.default: RetentionPolicy = default
+        self.interval: float = interval
+        self.batch: int = batch
+        self.hold_seconds: int = hold_seconds # restored history is left alone this long
+        self.archive: bool = archive_enabled # False: messages outside the policy are just deleted
+        self.loop_task: Optional[asyncio.Task] = None
+        self.sweeps: int = 0
+        self.archived: int = 0
+        self.restored: int = 0
+        self.last_sweep: Optional[float] = None
+
+    def start(self) -> None:
+        if self.loop_task is None:
+            self.loop_task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logging.error("Error sweeping channel history", exc_info=True)
+
+    def _guild_id(self, channel_id: int) -> Optional[int]:
+        channel = context.discord.get_channel(channel_id) if context.discord else None
+        guild = getattr(channel, "guild", None)
+        return guild.id if guild else None
+
+    def policy_for(self, channel_id: int, policies: dict, guild_id: Optional[int] = None) -> RetentionPolicy:
+        """Default, then the guild's policy, then the channel's; each only replaces the fields it sets."""
+        if guild_id is None:
+            guild_id = self._guild_id(channel_id)
+        return self.default.merged(policies.get(guild_id)).merged(policies.get(channel_id))
+
+    async def sweep(self) -> int:
+        started = time.monotonic()
+        moved = 0
+        for channel_id in await get_channel_ids("archive_pending"):
+            moved += await self.drain_trimmed(channel_id)
+        policies = await get_retention_policies()
+        for channel_id in await get_channel_ids("history"):
+            policy = self.policy_for(channel_id, policies)
+            if policy.is_empty() or await is_retention_held(channel_id):
+                continue
+            try:
+                moved += await self.sweep_channel(channel_id, policy)
+            except Exception:
+                logging.error("Error applying retention to channel %s", channel_id, exc_info=True)
+        self.sweeps += 1
+        self.last_sweep = time.time()
+        if moved:
+            logging.info(f"Retention sweep archived {moved} messages in {time.monotonic() - started:.1f}s")
+        return moved
+
+    async def sweep_channel(self, channel_id: int, policy: RetentionPolicy) -> int:
+        cutoff_ms = int((time.time() - policy.max_age_days * 86400) * 1000) if policy.max_age_days else 0
+        moved = 0
+        while True:
+            expired = await get_expired_messages(channel_id, cutoff_ms, policy.max_count, policy.max_bytes, self.batch)
+            if not expired:
+                return moved
+            if self.archive:
+                # Written (and synced) before the records leave redis
+                await asyncio.to_thread(self.store.append, channel_id, [record for _, record in expired if record])
+            await remove_messages(channel_id, [mid for mid, _ in expired])
+            moved += len(expired)
+            self.archived += len(expired)
+            if len(expired) < self.batch:
+                return moved
+
+    async def drain_trimmed(self, channel_id: int) -> int:
+        """Archive the records the per-channel cap trimmed on save."""
+        moved = 0
+        while True:
+            records = await get_trimmed_records(channel_id, self.batch)
+            if not records:
+                return moved
+            if self.archive:
+                await asyncio.to_thread(self.store.append, channel_id, records)
+            await ack_trimmed_records(channel_id, len(records))
+            moved += len(records)
+            self.archived += len(records)
+
+    async def restore(self, channel_id: int, since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None) -> int:
+        """Copy archived messages from [since, until) back into redis. Returns the number restored."""
+        since_ms = int(since.timestamp() * 1000) if since else 0
+        until_ms = int(until.timestamp() * 1000) if until else None
+        records = await asyncio.to_thread(self.store.read, channel_id, since_ms, until_ms)
+        if not records:
+            return 0
+        # Otherwise the next save or sweep would trim the old messages straight back out
+        await set_retention_hold(channel_id, self.hold_seconds)
+        restored = await restore_messages(channel_id, records)
+        self.restored += restored
+        return restored
+
+    async def usage(self, channel_id: int) -> dict:
+        return await asyncio.to_thread(self.store.usage, channel_id)
+
+    async def forget(self, channel_id: int) -> None:
+        await asyncio.to_thread(self.store.forget, channel_id)
+
+    def stats(self) -> dict:
+        return {
+            "sweeps": self.sweeps,
+            "archived": self.archived,
+            "restored": self.restored,
+            "last_sweep": self.last_sweep,
+        }
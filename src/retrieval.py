@@ -0,0 +1,256 @@
+## Embedding retrieval memory (opt-in, RETRIEVAL=true).
+## Every saved message is queued here and embedded later, in batches, by a background task, never
+## inline in save_message_redis. Vectors live in one float32 matrix per channel, L2-normalized so cosine
+## similarity is a single matrix-vector product, and are persisted as `<channel_id>.npz` under `directory`
+## (the redis client decodes responses, so raw float bytes don't fit there).
+## At answer time only the query is embedded; the prompt builder merges the top-k hits with the last turns.
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+import numpy as np
+import context
+from src.redis_conn import get_last_messages
+
+
+class ChannelVectors:
+    """Message ids and unit vectors of one channel. Rows are appended into a buffer that doubles when full."""
+
+    def __init__(self, dim: int = 0, max_vectors: Optional[int] = None):
+        self.max_vectors: Optional[int] = max_vectors
+        self.dirty: bool = False
+        self._reset(dim)
+
+    def _reset(self, dim: int) -> None:
+        self.dim: int = dim
+        self.count: int = 0
+        self.ids: np.ndarray = np.empty(0, dtype=np.int64)
+        self.vectors: np.ndarray = np.empty((0, dim), dtype=np.float32)
+        self.rows: Dict[int, int] = {}
+
+    @classmethod
+    def from_arrays(cls, ids: np.ndarray, vectors: np.ndarray, max_vectors: Optional[int] = None) -> "ChannelVectors":
+        index = cls(vectors.shape[1], max_vectors)
+        index.ids = ids.astype(np.int64)
+        index.vectors = vectors.astype(np.float32)
+        index.count = len(ids)
+        index.rows = {int(mid): row for row, mid in enumerate(index.ids)}
+        return index
+
+    def add(self, ids: List[int], vectors: np.ndarray) -> None:
+        if self.dim != vectors.shape[1]:
+            # Embedding model changed, the old vectors are not comparable anymore
+            self._reset(vectors.shape[1])
+        for mid, vector in zip(ids, vectors):
+            row = self.rows.get(mid)
+            if row is None:
+                if self.count == len(self.ids):
+                    self._grow()
+                row = self.count
+                self.count += 1
+                self.ids[row] = mid
+                self.rows[mid] = row
+            self.vectors[row] = vector # edited messages are re-embedded in place
+        if self.max_vectors and self.count > self.max_vectors:
+            self._trim(self.max_vectors)
+        self.dirty = True
+
+    def _grow(self) -> None:
+        capacity = max(2 * len(self.ids), 64)
+        ids = np.empty(capacity, dtype=np.int64)
+        vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        ids[:self.count] = self.ids[:self.count]
+        vectors[:self.count] = self.vectors[:self.count]
+        self.ids, self.vectors = ids, vectors
+
+    def _trim(self, keep: int) -> None:
+        # Keep the newest `keep` messages, like the history cap does
+        order = np.argsort(self.ids[:self.count])[-keep:]
+        order.sort()
+        self.ids = self.ids[order].copy()
+        self.vectors = self.vectors[order].copy()
+        self.count = len(order)
+        self.rows = {int(mid): row for row, mid in enumerate(self.ids)}
+
+    def search(self, query: np.ndarray, k: int, exclude: Set[int]) -> List[int]:
+        """Ids of the `k` most similar messages, best first."""
+        if self.count == 0 or k <= 0 or query.shape[0] != self.dim:
+            return []
+        scores = self.vectors[:self.count] @ query
+        if exclude:
+            scores[np.isin(self.ids[:self.count], list(exclude))] = -np.inf
+        k = min(k, self.count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [int(self.ids[i]) for i in top if scores[i] > -np.inf]
+
+    def arrays(self):
+        return self.ids[:self.count], self.vectors[:self.count]
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+class RetrievalMemory:
+    def __init__(
+        self,
+        model: str = "nomic-embed-text",
+        directory: str = "data/vectors",
+        top_k: int = 6,
+        recent_turns: int = 8,
+        batch_size: int = 32,
+        flush_interval: float = 30,
+        max_channels: int = 64,
+        max_vectors: Optional[int] = None
+    ):
+        self.model: str = model
+        self.directory: str = directory
+        self.top_k: int = top_k
+        self.recent_turns: int = recent_turns
+        self.batch_size: int = batch_size
+        self.flush_interval: float = flush_interval
+        self.max_channels: int = max_channels
+        self.max_vectors: Optional[int] = max_vectors
+        self.pending: Dict[int, Dict[int, str]] = {} # channel_id -> {message_id: text}
+        self.channels: "OrderedDict[int, ChannelVectors]" = OrderedDict()
+        self.backfilled: Set[int] = set()
+        self.wakeup: asyncio.Event = asyncio.Event()
+        self.loop_task: Optional[asyncio.Task] = None
+        self.embedded: int = 0
+        self.queries: int = 0
+
+    def queue(self, channel_id: int, message_id: int, text: str) -> None:
+        if not text or not text.strip():
+            return
+        self.pending.setdefault(int(channel_id), {})[int(message_id)] = text
+        self.wakeup.set()
+
+    def start(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        if self.loop_task is None:
+            self.loop_task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_flush = loop.time() + self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=max(next_flush - loop.time(), 0.1))
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            while self.pending:
+                channel_id = next(iter(self.pending))
+                batch = self.pending.pop(channel_id)
+                if len(batch) > self.batch_size:
+                    # Put the rest back at the end so one busy channel can't starve the others
+                    rest = dict(list(batch.items())[self.batch_size:])
+                    batch = dict(list(batch.items())[:self.batch_size])
+                    self.pending[channel_id] = rest
+                try:
+                    await self._ingest(channel_id, batch)
+                except Exception:
+                    logging.error(f"Error embedding messages for channel {channel_id}", exc_info=True)
+            if loop.time() >= next_flush:
+                await self.flush()
+                next_flush = loop.time() + self.flush_interval
+
+    async def _ingest(self, channel_id: int, batch: Dict[int, str]) -> None:
+        vectors = await self.embed(list(batch.values()))
+        index = await self.channel(channel_id)
+        index.add(list(batch.keys()), vectors)
+        self.embedded += len(batch)
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        result = await context.llama.embed(model=self.model, input=texts, keep_alive=context.residency.keep_alive(self.model))
+        return normalize(np.asarray(result["embeddings"], dtype=np.float32))
+
+    def _path(self, channel_id: int) -> str:
+        return os.path.join(self.directory, f"{channel_id}.npz")
+
+    def _load(self, channel_id: int) -> ChannelVectors:
+        path = self._path(channel_id)
+        if os.path.exists(path):
+            try:
+                with np.load(path) as data:
+                    if str(data["model"]) == self.model:
+                        return ChannelVectors.from_arrays(data["ids"], data["vectors"], self.max_vectors)
+            except Exception:
+                logging.error(f"Error loading vector index {path}", exc_info=True)
+        return ChannelVectors(max_vectors=self.max_vectors)
+
+    def _save(self, channel_id: int, ids: np.ndarray, vectors: np.ndarray) -> None:
+        path = self._path(channel_id)
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, ids=ids, vectors=vectors, model=np.array(self.model))
+        os.replace(tmp, path)
+
+    async def _persist(self, channel_id: int, index: ChannelVectors) -> None:
+        # Copy on the loop thread; the index keeps changing while the file is written
+        ids, vectors = index.arrays()
+        index.dirty = False
+        await asyncio.to_thread(self._save, channel_id, ids.copy(), vectors.copy())
+
+    async def channel(self, channel_id: int) -> ChannelVectors:
+        index = self.channels.get(channel_id)
+        if index is None:
+            index = await asyncio.to_thread(self._load, channel_id)
+            self.channels[channel_id] = index
+            while len(self.channels) > self.max_channels:
+                old_id, old = self.channels.popitem(last=False)
+                if old.dirty:
+                    await self._persist(old_id, old)
+            if channel_id not in self.backfilled:
+                self.backfilled.add(channel_id)
+                asyncio.create_task(self.backfill(channel_id, index))
+        self.channels.move_to_end(channel_id)
+        return index
+
+    async def backfill(self, channel_id: int, index: ChannelVectors) -> None:
+        """Queue stored messages that were saved before retrieval was enabled (or before a crash)."""
+        try:
+            records = await get_last_messages(channel_id, self.max_vectors or context.history_max_messages)
+        except Exception:
+            logging.error(f"Error backfilling vector index for channel {channel_id}", exc_info=True)
+            return
+        for record in records:
+            if int(record["id"]) not in index.rows:
+                self.queue(channel_id, record["id"], record.get("content", ""))
+
+    async def flush(self) -> None:
+        for channel_id, index in list(self.channels.items()):
+            if index.dirty:
+                try:
+                    await self._persist(channel_id, index)
+                except Exception:
+                    logging.error(f"Error saving vector index for channel {channel_id}", exc_info=True)
+
+    async def search(self, channel_id: int, text: str, exclude: Set[int]) -> List[int]:
+        if not text or not text.strip():
+            return []
+        index = await self.channel(channel_id)
+        if index.count == 0:
+            return []
+        self.queries += 1
+        query = await self.embed([text])
+        return index.search(query[0], self.top_k, exclude)
+
+    async def forget(self, channel_id: int) -> None:
+        self.channels.pop(channel_id, None)
+        self.pending.pop(channel_id, None)
+        self.backfilled.discard(channel_id)
+        path = self._path(channel_id)
+        if os.path.exists(path):
+            await asyncio.to_thread(os.remove, path)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": sum(len(p) for p in self.pending.values()),
+            "loaded_channels": len(self.channels),
+            "embedded": self.embedded,
+            "queries": self.queries,
+        }
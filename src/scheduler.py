@@ -0,0 +1,246 @@
+## Bounded generation scheduler.
+## Every mention used to start its own stream against ollama; a burst of mentions then made the host
+## time-slice dozens of streams and every answer got slow. Jobs now wait here for a slot:
+##  - at most `limit` concurrent generations per backend
+##  - round robin across channels, and across users within a channel (FIFO per user)
+##  - admins/superadmins go through a separate priority lane that is always served first
+## Waiting jobs get a "queued, position N" reply that is kept up to date and removed once they start.
+import time
+import asyncio
+import logging
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Callable, Deque, Dict, List, Optional
+import discord
+
+
+class Job:
+    def __init__(self, message: discord.Message, priority: bool, model: Optional[str] = None):
+        self.message: discord.Message = message
+        self.channel_id: int = message.channel.id
+        self.user_id: int = message.author.id
+        self.priority: bool = priority
+        self.model: Optional[str] = model
+        self.backend: Optional[str] = None # chosen when the job is dispatched
+        self.enqueued_at: float = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.ready: asyncio.Future = asyncio.get_running_loop().create_future()
+
+        self.status_message: Optional[discord.Message] = None
+        self.shown_position: Optional[int] = None
+
+    @property
+    def wait_time(self) -> float:
+        return (self.started_at or time.monotonic()) - self.enqueued_at
+
+
+class Lane:
+    """Waiting jobs grouped channel -> user -> FIFO. The least recently served channel goes first, and within it the least recently served user."""
+    MAX_SERVED_ENTRIES = 4096
+
+    def __init__(self):
+        self.channels: Dict[int, Dict[int, Deque[Job]]] = {}
+        self.size: int = 0
+        self.tick: int = 0
+        # channel_id / (channel_id, user_id) -> tick of last service, kept after a channel empties so it can't cut in line
+        self.served: "OrderedDict[object, int]" = OrderedDict()
+
+    def push(self, job: Job) -> None:
+        users = self.channels.setdefault(job.channel_id, {})
+        users.setdefault(job.user_id, deque()).append(job)
+        self.size += 1
+
+    def remove(self, job: Job) -> bool:
+        users = self.channels.get(job.channel_id)
+        if not users or job not in users.get(job.user_id, ()):
+            return False
+        users[job.user_id].remove(job)
+        self._cleanup(self.channels, job.channel_id, job.user_id)
+        self.size -= 1
+        return True
+
+    def pop_next(self, can_run: Callable[[Job], bool]) -> Optional[Job]:
+        for channel_id, user_id in self._candidates(self.channels, self.served):
+            job = self.channels[channel_id][user_id][0]
+            if not can_run(job):
+                continue
+            self.channels[channel_id][user_id].popleft()
+            self.size -= 1
+            self.tick += 1
+            self._mark(self.served, channel_id, user_id, self.tick)
+            self._cleanup(self.channels, channel_id, user_id)
+            if len(self.served) > self.MAX_SERVED_ENTRIES:
+                self.served.popitem(last=False)
+            return job
+        return None
+
+    def order(self) -> List[Job]:
+        """Jobs in the order they would be served if every backend had capacity."""
+        channels = {cid: {uid: deque(jobs) for uid, jobs in users.items()} for cid, users in self.channels.items()}
+        served = dict(self.served)
+        tick = self.tick
+        ordered = []
+        while channels:
+            channel_id, user_id = next(self._candidates(channels, served))
+            ordered.append(channels[channel_id][user_id].popleft())
+            tick += 1
+            self._mark(served, channel_id, user_id, tick)
+            self._cleanup(channels, channel_id, user_id)
+        return ordered
+
+    @staticmethod
+    def _candidates(channels: dict, served: dict):
+        # sorted() is stable, so never-served channels/users keep their arrival order
+        for channel_id in sorted(channels, key=lambda c: served.get(c, -1)):
+            users = channels[channel_id]
+            for user_id in sorted(users, key=lambda u: served.get((channel_id, u), -1)):
+                yield channel_id, user_id
+
+    @staticmethod
+    def _mark(served: dict, channel_id: int, user_id: int, tick: int) -> None:
+        for key in (channel_id, (channel_id, user_id)):
+            served[key] = tick
+            if isinstance(served, OrderedDict):
+                served.move_to_end(key)
+
+    @staticmethod
+    def _cleanup(channels: dict, channel_id: int, user_id: int) -> None:
+        users = channels[channel_id]
+        if not users[user_id]:
+            del users[user_id]
+        if not users:
+            del channels[channel_id]
+
+
+class GenerationScheduler:
+    def __init__(self, limit: int = 2, limits: Optional[Dict[str, int]] = None, status_interval: float = 3.0):
+        self.default_limit: int = limit
+        self.limits: Dict[str, int] = limits or {}
+        self.status_interval: float = status_interval
+        # Backends that can run a job, best first. The first one with a free slot gets it.
+        self.backend_for: Callable[[Job], List[str]] = lambda job: ["default"]
+
+        self.running: Dict[str, int] = defaultdict(int)
+        self.priority_lane: Lane = Lane()
+        self.normal_lane: Lane = Lane()
+        self.status_task: Optional[asyncio.Task] = None
+
+        self.wait_times: Deque[tuple] = deque(maxlen=2000) # (finished waiting at, seconds waited)
+        self.submitted: int = 0
+        self.started: int = 0
+        self.max_depth: int = 0
+
+    def limit(self, backend: str) -> int:
+        return self.limits.get(backend, self.default_limit)
+
+    def has_capacity(self, job: Job) -> bool:
+        for backend in self.backend_for(job):
+            if self.running[backend] < self.limit(backend):
+                job.backend = backend
+                return True
+        return False
+
+    @property
+    def depth(self) -> int:
+        return self.priority_lane.size + self.normal_lane.size
+
+    def waiting(self) -> List[Job]:
+        return self.priority_lane.order() + self.normal_lane.order()
+
+    @asynccontextmanager
+    async def slot(self, message: discord.Message, priority: bool = False, model: Optional[str] = None):
+        job = Job(message, priority, model)
+        (self.priority_lane if priority else self.normal_lane).push(job)
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        self._dispatch()
+
+        try:
+            if not job.ready.done():
+                self._ensure_status_loop()
+                await self._show_status(job)
+            await job.ready
+        except asyncio.CancelledError:
+            if job.ready.done() and not job.ready.cancelled():
+                self._release(job) # got the slot in the same tick we were cancelled
+            else:
+                (self.priority_lane if priority else self.normal_lane).remove(job)
+            await self._clear_status(job)
+            raise
+
+        try:
+            # Inside the try: a cancel while the status message is deleted must still free the slot
+            await self._clear_status(job)
+            yield job
+        finally:
+            self._release(job)
+
+    def _dispatch(self) -> None:
+        for lane in (self.priority_lane, self.normal_lane):
+            while True:
+                job = lane.pop_next(self.has_capacity)
+                if job is None:
+                    break
+                self.running[job.backend] += 1
+                job.started_at = time.monotonic()
+                self.wait_times.append((time.time(), job.wait_time))
+                self.started += 1
+                job.ready.set_result(True)
+
+    def _release(self, job: Job) -> None:
+        self.running[job.backend] -= 1
+        self._dispatch()
+
+    def _ensure_status_loop(self) -> None:
+        if self.status_task is None or self.status_task.done():
+            self.status_task = asyncio.create_task(self._status_loop())
+
+    async def _status_loop(self) -> None:
+        while self.depth:
+            await asyncio.sleep(self.status_interval)
+            for position, job in enumerate(self.waiting(), start=1):
+                if job.status_message is not None and job.shown_position != position:
+                    try:
+                        await job.status_message.edit(content=self._status_text(position))
+                        job.shown_position = position
+                    except discord.HTTPException:
+                        logging.error("Error updating queue position", exc_info=True)
+
+    def _status_text(self, position: int) -> str:
+        return f"⏳ Queued, position {position}"
+
+    async def _show_status(self, job: Job) -> None:
+        position = self.waiting().index(job) + 1 if not job.ready.done() else None
+        if position is None:
+            return
+        try:
+            job.status_message = await job.message.reply(self._status_text(position), mention_author=False)
+            job.shown_position = position
+        except discord.HTTPException:
+            logging.error("Error sending queue position", exc_info=True)
+
+    async def _clear_status(self, job: Job) -> None:
+        if job.status_message is None:
+            return
+        status_message, job.status_message = job.status_message, None
+        try:
+            await status_message.delete()
+        except discord.HTTPException:
+            pass
+
+    def stats(self, window: float = 3600) -> Dict[str, float]:
+        cutoff = time.time() - window
+        waits = sorted(w for t, w in self.wait_times if t >= cutoff)
+        def pct(p: float) -> float:
+            return waits[min(int(p * len(waits)), len(waits) - 1)] if waits else 0.0
+        return {
+            "depth": self.depth,
+            "priority_depth": self.priority_lane.size,
+            "max_depth": self.max_depth,
+            "running": sum(self.running.values()),
+            "submitted": self.submitted,
+            "started": self.started,
+            "wait_p50": pct(0.5),
+            "wait_p95": pct(0.95),
+            "wait_max": waits[-1] if waits else 0.0,
+        }
@@ -0,0 +1,156 @@
+## Rolling summary of old channel history.
+## Messages older than the newest `keep_recent` are folded, `max_batch` at a time, into one summary per
+## channel (`summary:{channel_id}` in redis: text + the id of the last message it covers). Prompts then send
+## the summary instead of those turns. Work only happens while the generation scheduler is idle; a summary
+## still generating when a reply gets queued is cancelled and retried later. Since the watermark is stored
+## with the text, a restart (or a cancel) simply picks up where it stopped.
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import Callable, Optional, Set
+import context
+from src.redis_conn import (
+    format_message,
+    get_messages_since,
+    get_nth_newest_id,
+    get_summary,
+    save_summary
+)
+
+SUMMARY_PROMPT = """You maintain a running summary of a Discord channel conversation so it can be continued later.
+Rewrite the summary so it also covers the new messages. Keep names, decisions, open questions, facts users shared about themselves and anything the assistant promised.
+Drop small talk. Answer with the summary only, at most {max_words} words.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}"""
+
+BUSY_POLL_SECONDS = 0.25 # how quickly a running summary gives way to a reply
+
+
+class HistorySummarizer:
+    MAX_CACHED_CHANNELS = 1024
+
+    def __init__(
+        self,
+        keep_recent: int = 40,
+        min_batch: int = 20,
+        max_batch: int = 60,
+        interval: float = 30,
+        max_words: int = 250,
+        model: Optional[str] = None
+    ):
+        self.keep_recent: int = keep_recent
+        self.min_batch: int = min_batch
+        self.max_batch: int = max(max_batch, min_batch)
+        self.interval: float = interval
+        self.max_words: int = max_words
+        self.model: Optional[str] = model
+        self.generate: Optional[Callable] = None # set by the bot, ollama_conn.generate
+        self.dirty: Set[int] = set()
+        self.summaries: "OrderedDict[int, Optional[dict]]" = OrderedDict()
+        self.loop_task: Optional[asyncio.Task] = None
+        self.runs: int = 0
+        self.summarized_messages: int = 0
+        self.yielded: int = 0
+
+    def mark(self, channel_id: int) -> None:
+        self.dirty.add(channel_id)
+
+    def invalidate(self, channel_id: int) -> None:
+        self.summaries.pop(channel_id, None)
+        self.dirty.discard(channel_id)
+
+    async def summary_for(self, channel_id: int) -> Optional[dict]:
+        if channel_id in self.summaries:
+            self.summaries.move_to_end(channel_id)
+            return self.summaries[channel_id]
+        summary = await get_summary(channel_id)
+        self._remember(channel_id, summary)
+        return summary
+
+    def _remember(self, channel_id: int, summary: Optional[dict]) -> None:
+        self.summaries[channel_id] = summary
+        self.summaries.move_to_end(channel_id)
+        while len(self.summaries) > self.MAX_CACHED_CHANNELS:
+            self.summaries.popitem(last=False)
+
+    def is_idle(self) -> bool:
+        scheduler = context.scheduler
+        return scheduler is None or (scheduler.depth == 0 and sum(scheduler.running.values()) == 0)
+
+    def start(self) -> None:
+        if self.loop_task is None:
+            self.loop_task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            while self.dirty and self.is_idle():
+                channel_id = self.dirty.pop()
+                try:
+                    # A channel with a large backlog is folded in several passes, yielding to replies in between
+                    if await self.summarize_channel(channel_id):
+                        self.dirty.add(channel_id)
+                except Exception:
+                    logging.error("Error summarizing channel %s", channel_id, exc_info=True)
+
+    async def summarize_channel(self, channel_id: int) -> bool:
+        """Fold one batch of aged messages into the summary. Returns True if there may be more to fold."""
+        boundary = await get_nth_newest_id(channel_id, self.keep_recent)
+        if boundary is None:
+            return False
+        summary = await self.summary_for(channel_id)
+        upto = summary["upto"] if summary else 0
+        aged = [r for r in await get_messages_since(channel_id, upto, self.max_batch) if int(r["id"]) < boundary]
+        if len(aged) < self.min_batch:
+            return False
+
+        prompt = SUMMARY_PROMPT.format(
+            max_words=self.max_words,
+            summary=summary["text"] if summary else "(none yet)",
+            messages="\n\n".join(format_message(r)["content"] for r in aged),
+        )
+        model = self.model or context.llama_default_model
+        generation = asyncio.create_task(self._generate(prompt, model))
+        while not generation.done():
+            await asyncio.wait({generation}, timeout=BUSY_POLL_SECONDS)
+            if not generation.done() and not self.is_idle():
+                # A reply is waiting or running: give the backend back and fold this batch later
+                generation.cancel()
+                try:
+                    await generation
+                except asyncio.CancelledError:
+                    pass
+                self.yielded += 1
+                return True
+        text = generation.result().strip()
+        if not text:
+            # generate() logs and swallows errors; keep the old watermark, the next message in the channel retries
+            return False
+
+        new_upto = int(aged[-1]["id"])
+        await save_summary(channel_id, text, new_upto)
+        self._remember(channel_id, {"text": text, "upto": new_upto})
+        self.runs += 1
+        self.summarized_messages += len(aged)
+        return len(aged) == self.max_batch
+
+    async def _generate(self, prompt: str, model: str) -> str:
+        text = ""
+        # aclosing: a cancel closes the upstream stream right away
+        async with aclosing(self.generate(prompt, model=model, keep_alive=context.residency.keep_alive(model))) as stream:
+            async for part in stream:
+                text += part["response"]
+        return text
+
+    def stats(self) -> dict:
+        return {
+            "pending_channels": len(self.dirty),
+            "runs": self.runs,
+            "summarized_messages": self.summarized_messages,
+            "yielded": self.yielded,
+        }
@@ -0,0 +1,15 @@
+## Cheap token estimates for prompt budgeting.
+## We don't ship the models' tokenizers, so this is a heuristic: ~4 characters per token for
+## latin text plus a fixed per-message overhead for the chat template (role markers etc).
+import math
+
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(
+    text: str
+) -> int:
+    if not text:
+        return MESSAGE_OVERHEAD_TOKENS
+    return math.ceil(len(text) / CHARS_PER_TOKEN) + MESSAGE_OVERHEAD_TOKENS